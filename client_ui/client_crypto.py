@@ -1,6 +1,7 @@
 import os
 import uuid
 import json
+import struct
 import requests
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import padding
@@ -12,6 +13,64 @@ ORCHESTRATOR_URL = os.environ.get("ORCHESTRATOR_URL", "http://localhost:8080")
 CLIENT_ID = os.environ.get("CLIENT_ID", "ClientA")
 DATA_FILE = os.environ.get("DATA_FILE", "train.csv")  # local dataset file
 WORKFLOW_ID = None
+SEGMENT_SIZE = int(os.environ.get("SEGMENT_SIZE", 1024 * 1024))  # plaintext bytes per AES-GCM segment
+
+# Segmented dataset container (must match the executor's reader):
+#   header  = MAGIC(4) || VERSION(1) || SEGMENT_SIZE(4, big-endian) || NONCE_PREFIX(7)
+#   segment = AES-GCM(dek, nonce = NONCE_PREFIX || INDEX(4, big-endian) || LAST(1), aad = header)
+SEGMENTED_MAGIC = b"CCRS"
+SEGMENTED_VERSION = 1
+GCM_TAG_LEN = 16
+
+class SegmentedEncryptor:
+    """
+    File-like view over a plaintext stream that yields the segmented ciphertext as it is
+    read, so `requests` can upload it with a known Content-Length without buffering it.
+    """
+
+    def __init__(self, dek, plaintext, plaintext_len, segment_size=SEGMENT_SIZE):
+        self._aesgcm = AESGCM(dek)
+        self._src = plaintext
+        self._remaining = plaintext_len
+        self._segment_size = segment_size
+        self._prefix = os.urandom(7)
+        self._header = SEGMENTED_MAGIC + struct.pack(">BI", SEGMENTED_VERSION, segment_size) + self._prefix
+        self._segments = max(1, -(-plaintext_len // segment_size))
+        self._length = len(self._header) + plaintext_len + self._segments * GCM_TAG_LEN
+        self._index = 0
+        self._buf = self._header
+        self._pos = 0
+
+    def __len__(self):
+        return self._length
+
+    def _next_segment(self):
+        chunk = self._src.read(min(self._segment_size, self._remaining))
+        if len(chunk) != min(self._segment_size, self._remaining):
+            raise RuntimeError("Dataset changed size while it was being encrypted")
+        self._remaining -= len(chunk)
+        last = self._index == self._segments - 1
+        nonce = self._prefix + struct.pack(">IB", self._index, 1 if last else 0)
+        self._index += 1
+        return self._aesgcm.encrypt(nonce, chunk, self._header)
+
+    def read(self, size=-1):
+        if self._pos == len(self._buf):
+            if self._index == self._segments:
+                return b""
+            self._buf, self._pos = self._next_segment(), 0
+        end = len(self._buf) if size is None or size < 0 else self._pos + size
+        out = self._buf[self._pos:end]
+        self._pos += len(out)
+        return out
+
+def _stream_size(f):
+    """ Remaining bytes in a seekable file-like object, leaving its position unchanged. """
+    pos = f.tell()
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(pos)
+    return size - pos
 
 def get_executor_pubkey():
     """Fetch executor pubkey from orchestrator (which proxies executor attestation)."""
@@ -31,37 +90,31 @@ def encrypt_and_upload(workflow_id, pubkey, local_file, filename, owner):
     # Generate DEK
     dek = AESGCM.generate_key(bit_length=256)
 
-    # Encrypt dataset
-    aesgcm = AESGCM(dek)
-    nonce = os.urandom(12)
-    if hasattr(local_file, "read"):
-        plaintext = local_file.read()
-    else:
-        with open(local_file, "rb") as f:
-            plaintext = f.read()
-    ciphertext = nonce + aesgcm.encrypt(nonce, plaintext, None)
-
     # Wrap DEK with enclave pubkey
     wrapped_dek = pubkey.encrypt(
         dek,
         padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
     )
 
-    # Ask orchestrator for signed upload URLs (ciphertext + key), including dataset_id
-    resp_cipher = requests.post(
-        f"{ORCHESTRATOR_URL}/upload-url",
-        params={"workflow_id": workflow_id, "dataset_id": dataset_id, "filename": filename, "file_type": "dataset", "owner": owner}
-    ).json()
-    cipher_url, cipher_gcs = resp_cipher["upload_url"], resp_cipher["gcs_path"]
-
-    resp_dek = requests.post(
-        f"{ORCHESTRATOR_URL}/upload-url",
-        params={"workflow_id": workflow_id, "dataset_id": dataset_id, "filename": filename, "file_type": "key", "owner": owner}
-    ).json()
-    dek_url, dek_gcs = resp_dek["upload_url"], resp_dek["gcs_path"]
-
-    # Upload ciphertext
-    put1 = requests.put(cipher_url, data=ciphertext, headers={"Content-Type": "application/octet-stream"})
+    # Ask orchestrator for signed upload URLs (ciphertext + key), including dataset_id, in one call
+    resp = requests.post(
+        f"{ORCHESTRATOR_URL}/upload-urls",
+        json=[{"workflow_id": workflow_id, "dataset_id": dataset_id, "filename": filename, "file_type": file_type, "owner": owner}
+              for file_type in ("dataset", "key")]
+    )
+    if resp.status_code != 200:
+        raise RuntimeError(f"Signed upload URL request failed: {resp.text}")
+    body = resp.json()
+    if "error" in body:   # metadata could not be recorded
+        raise RuntimeError(f"Signed upload URL request failed: {body['error']}")
+    (cipher_url, cipher_gcs), (dek_url, dek_gcs) = [(u["upload_url"], u["gcs_path"]) for u in body["urls"]]
+
+    # Encrypt and upload ciphertext as a stream of segments
+    if hasattr(local_file, "read"):
+        put1 = _put_encrypted(cipher_url, dek, local_file)
+    else:
+        with open(local_file, "rb") as f:
+            put1 = _put_encrypted(cipher_url, dek, f)
     if put1.status_code != 200:
         raise RuntimeError(f"Ciphertext upload failed: {put1.text}")
 
@@ -83,6 +136,10 @@ def encrypt_and_upload(workflow_id, pubkey, local_file, filename, owner):
         "upload_status_dek": put2.status_code
     }
 
+def _put_encrypted(url, dek, plaintext_file):
+    body = SegmentedEncryptor(dek, plaintext_file, _stream_size(plaintext_file))
+    return requests.put(url, data=body, headers={"Content-Type": "application/octet-stream"})
+
 if __name__ == "__main__":
     pubkey = get_executor_pubkey()
     result = encrypt_and_upload(WORKFLOW_ID, pubkey, DATA_FILE, CLIENT_ID)
@@ -2,13 +2,33 @@ import streamlit as st
 import requests
 import client_crypto
 import uuid
-import time
 import pandas as pd    
 import json              
 from io import StringIO 
 
 API_URL = "http://localhost:8080"  # change if deployed
 
+def wait_for_run(run_id, workflow_id, log_box):
+    """ Long-polls the run status and refreshes the live logs until the run is DONE or FAILED. """
+    logs, cursor = [], 0
+    while True:
+        resp_run = requests.get(f"{API_URL}/runs/{run_id}", params={"wait": 2}, timeout=30)
+        resp_logs = requests.get(f"{API_URL}/logs/{workflow_id}", params={"since": cursor})
+        if resp_logs.status_code == 200:
+            page = resp_logs.json()
+            if page.get("cursor", cursor) < cursor:
+                logs = []  # the executor's log for this workflow was reset
+            logs.extend(page.get("logs", []))
+            cursor = page.get("cursor", cursor)
+            log_box.text_area("Live Logs", "\n".join(logs), height=300)
+        else:
+            log_box.text_area("Live Logs", "⚠️ Failed to fetch logs", height=300)
+        if resp_run.status_code != 200:
+            return {"status": "FAILED", "error": resp_run.text}
+        run = resp_run.json()
+        if run["status"] in ("DONE", "FAILED"):
+            return run
+
 st.set_page_config(page_title="Cleanroom", layout="wide")
 
 page_bg = """
@@ -81,25 +101,16 @@ with tab1:
             st.write("### 📜 Execution Logs")
             log_box = st.empty()
 
-            # Poll orchestrator logs
-            # while True:
-            resp = requests.get(f"{API_URL}/logs/{st.session_state.workflow_id}")
-            if resp.status_code == 200:
-                logs = resp.json().get("logs", [])
-                log_text = "\n".join(logs)
-                log_box.text_area("Live Logs", log_text, height=300, key="solo_log_area")
+            # Poll run status + orchestrator logs until the run finishes
+            if resp.status_code == 202:
+                run_info = wait_for_run(resp.json()["run_id"], st.session_state.workflow_id, log_box)
+            elif resp.status_code == 429:
+                run_info = {"status": "FAILED", "error": f"Executor is busy, retry in {resp.headers.get('Retry-After', '?')}s"}
             else:
-                log_box.text_area("Live Logs", "⚠️ Failed to fetch logs", height=300, key="solo_log_area_error")
-                # break
-
-                # Optional: stop polling if execution is complete
-                # if any("Notebook executed" in l for l in logs):
-                #     break
+                run_info = {"status": "FAILED", "error": resp.text}
 
-                time.sleep(2)  # poll every 2 seconds
-                
-            if resp.status_code == 200:
-                result_info = resp.json()
+            if run_info["status"] == "DONE":
+                result_info = run_info
                 st.success("Workflow executed successfully ✅")
                 st.write("Executed Notebook:", result_info["executed_notebook"])
                 st.write("Result JSON:", result_info["result_json_paths"])
@@ -117,7 +128,7 @@ with tab1:
                     print("No Models found")
 
                 # Extract result info
-                result_data = resp.json()
+                result_data = run_info
                 workflow_id = result_data.get("workflow_id") or st.session_state.workflow_id
 
                 st.subheader("📦 Workflow Results")
@@ -222,7 +233,7 @@ with tab1:
                                     else:
                                         st.warning("Download link was not available for this file.")
             else:
-                st.error(f"Execution failed: {resp.text}")
+                st.error(f"Execution failed: {run_info.get('error')}")
 
 # ------------------------------
 # COLLABORATION MODE (COMPLETE)
@@ -311,31 +322,22 @@ with tab2:
 
                 if resp.status_code == 403:
                     st.warning("⚠️ Workflow not yet approved by all collaborators.")
-                elif resp.status_code != 200:
+                elif resp.status_code == 429:
+                    st.warning(f"⏳ Executor is busy, retry in {resp.headers.get('Retry-After', '?')}s.")
+                elif resp.status_code != 202:
                     st.error(f"Execution failed: {resp.text}")
                 else:
                     st.success("Workflow execution started ✅")
                     st.write("### 📜 Execution Logs")
                     log_box = st.empty()
 
-                    # Poll orchestrator logs
-                    while True:
-                        resp_logs = requests.get(f"{API_URL}/logs/{workflow_to_run}")
-                        if resp_logs.status_code == 200:
-                            logs = resp_logs.json().get("logs", [])
-                            log_text = "\n".join(logs)
-                            log_box.text_area("Live Logs", log_text, height=300)
-                        else:
-                            log_box.text_area("Live Logs", "⚠️ Failed to fetch logs", height=300)
-                            break
-
-                        if any("Notebook executed" in l for l in logs):
-                            break
-
-                        time.sleep(2)  # poll every 2s
+                    # Poll run status + orchestrator logs until the run finishes
+                    result_info = wait_for_run(resp.json()["run_id"], workflow_to_run, log_box)
+                    if result_info["status"] != "DONE":
+                        st.error(f"Execution failed: {result_info.get('error')}")
+                        st.stop()
 
                     # --- After execution ---
-                    result_info = resp.json()
                     st.success("Workflow executed successfully ✅")
                     st.write("Executed Notebook:", result_info.get("executed_notebook"))
                     st.write("Result:", result_info.get("result_json_paths"))
@@ -3,8 +3,10 @@ import {
   Workflow,
   WorkflowResult,
   ExecutionResult,
+  RunStatus,
   AttestationResponse,
   WorkflowLogs,
+  RunProfile,
   ApiResponse
 } from '@/types';
 
@@ -130,14 +132,31 @@ export const workflowApi = {
       params.append('collaborators', collaborator);
     });
 
+    // The orchestrator queues the run (202) and we long-poll its status until it finishes
     const response = await api.post(`/workflows/${workflowId}/run`, null, { params });
+    const { run_id: runId } = response.data as RunStatus;
+
+    for (;;) {
+      const status = await workflowApi.getRunStatus(runId, 20);
+      if (status.status === 'DONE') {
+        return status;
+      }
+      if (status.status === 'FAILED') {
+        throw new Error(status.error || 'Workflow execution failed');
+      }
+    }
+  },
+
+  // Get run status (optionally long-polling up to `wait` seconds for completion)
+  getRunStatus: async (runId: string, wait: number = 0): Promise<RunStatus> => {
+    const response = await api.get(`/runs/${runId}`, { params: { wait } });
     return response.data;
   },
 
   // Get workflow results
   getWorkflowResults: async (
     workflowId: string
-  ): Promise<{ workflow_id: string; results: WorkflowResult[] }> => {
+  ): Promise<{ workflow_id: string; results: WorkflowResult[]; profile: RunProfile | null }> => {
     const response = await api.get(`/workflows/${workflowId}/result`);
     return response.data;
   },
@@ -165,6 +184,20 @@ export const uploadApi = {
     return response.data;
   },
 
+  // Get signed upload URLs for several files in one request
+  getUploadUrls: async (
+    items: {
+      workflow_id: string;
+      dataset_id: string;
+      filename: string;
+      file_type: 'dataset' | 'key';
+      owner: string;
+    }[]
+  ): Promise<{ upload_url: string; gcs_path: string; id: string }[]> => {
+    const response = await api.post('/upload-urls', items);
+    return response.data.urls;
+  },
+
   // Get signed download URL
   getDownloadUrl: async (
     gcsPath: string
@@ -187,12 +220,28 @@ export const attestationApi = {
   },
 };
 
+// Logs already fetched per workflow, so each poll only asks for lines after the cursor
+const logCache: Record<string, { logs: string[]; cursor: number }> = {};
+
 // Logs API
 export const logsApi = {
-  // Get workflow logs
+  // Get workflow logs (fetched incrementally, returned in full)
   getWorkflowLogs: async (workflowId: string): Promise<WorkflowLogs> => {
-    const response = await api.get(`/logs/${workflowId}`);
-    return response.data;
+    const cached = logCache[workflowId] || { logs: [], cursor: 0 };
+    const response = await api.get(`/logs/${workflowId}`, { params: { since: cached.cursor } });
+    const page: WorkflowLogs = response.data;
+    const logs = page.cursor !== undefined && page.cursor < cached.cursor
+      ? page.logs // the executor's log for this workflow was reset
+      : cached.logs.concat(page.logs);
+    logCache[workflowId] = { logs, cursor: page.cursor ?? cached.cursor };
+    return { ...page, logs };
+  },
+
+  // Server-Sent Events stream of log lines
+  streamWorkflowLogs: (workflowId: string, onLine: (line: string) => void): EventSource => {
+    const source = new EventSource(`${API_BASE_URL}/logs/${workflowId}/stream`);
+    source.onmessage = (event) => onLine(event.data);
+    return source;
   },
 };
 
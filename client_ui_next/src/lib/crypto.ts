@@ -20,27 +20,61 @@ async function generateAESKey(): Promise<CryptoKey> {
   );
 }
 
-// Generate a random nonce for AES-GCM
-function generateNonce(): Uint8Array {
-  return crypto.getRandomValues(new Uint8Array(12)); // 96 bits
+// Plaintext bytes per AES-GCM segment (same default as the Python client)
+const SEGMENT_SIZE = 1024 * 1024;
+
+// Segmented dataset container (must match the executor's reader):
+//   header  = MAGIC(4) || VERSION(1) || SEGMENT_SIZE(4, big-endian) || NONCE_PREFIX(7)
+//   segment = AES-GCM(dek, nonce = NONCE_PREFIX || INDEX(4, big-endian) || LAST(1), aad = header)
+const SEGMENTED_MAGIC = [0x43, 0x43, 0x52, 0x53]; // "CCRS"
+const SEGMENTED_VERSION = 1;
+
+// Build the container header with a fresh random nonce prefix
+function segmentedHeader(segmentSize: number): Uint8Array {
+  const header = new Uint8Array(16);
+  const view = new DataView(header.buffer);
+  header.set(SEGMENTED_MAGIC, 0);
+  view.setUint8(4, SEGMENTED_VERSION);
+  view.setUint32(5, segmentSize);
+  header.set(crypto.getRandomValues(new Uint8Array(7)), 9);
+  return header;
 }
 
-// Encrypt data with AES-GCM using Web Crypto API
-async function encryptAESGCM(
-  data: ArrayBuffer,
+// Nonce of one segment: the header's prefix, the segment index and the final-segment flag
+function segmentNonce(header: Uint8Array, index: number, last: boolean): Uint8Array {
+  const nonce = new Uint8Array(12);
+  const view = new DataView(nonce.buffer);
+  nonce.set(header.subarray(9, 16), 0);
+  view.setUint32(7, index);
+  view.setUint8(11, last ? 1 : 0);
+  return nonce;
+}
+
+// Encrypt a file into the segmented format, reading one segment of it at a time
+async function encryptSegmented(
+  file: Blob,
   key: CryptoKey,
-  nonce: Uint8Array
-): Promise<ArrayBuffer> {
-  const encrypted = await crypto.subtle.encrypt(
-    {
-      name: 'AES-GCM',
-      iv: nonce as BufferSource,
-    },
-    key,
-    data
-  );
+  segmentSize: number = SEGMENT_SIZE
+): Promise<Blob> {
+  const header = segmentedHeader(segmentSize);
+  const segments = Math.max(1, Math.ceil(file.size / segmentSize));
+  const parts: BlobPart[] = [header as BlobPart];
+
+  for (let index = 0; index < segments; index++) {
+    const chunk = await file.slice(index * segmentSize, (index + 1) * segmentSize).arrayBuffer();
+    const encrypted = await crypto.subtle.encrypt(
+      {
+        name: 'AES-GCM',
+        iv: segmentNonce(header, index, index === segments - 1) as BufferSource,
+        additionalData: header as BufferSource,
+      },
+      key,
+      chunk
+    );
+    parts.push(encrypted);
+  }
 
-  return encrypted;
+  return new Blob(parts, { type: 'application/octet-stream' });
 }
 
 // Export AES key to raw bytes for RSA encryption
@@ -48,17 +82,16 @@ async function exportAESKey(key: CryptoKey): Promise<ArrayBuffer> {
   return await crypto.subtle.exportKey('raw', key);
 }
 
-// Encrypt file with AES-GCM and wrap key with RSA
+// Encrypt file with segmented AES-GCM and wrap key with RSA
 async function encryptAndWrapKey(
-  fileData: ArrayBuffer,
+  file: Blob,
   publicKeyPem: string
-): Promise<{ ciphertext: ArrayBuffer; wrappedKey: Uint8Array; nonce: Uint8Array }> {
-  // Generate AES key and nonce
+): Promise<{ ciphertext: Blob; wrappedKey: Uint8Array }> {
+  // Generate AES key
   const aesKey = await generateAESKey();
-  const nonce = generateNonce();
 
-  // Encrypt file data with AES-GCM
-  const ciphertext = await encryptAESGCM(fileData, aesKey, nonce);
+  // Encrypt file data segment by segment
+  const ciphertext = await encryptSegmented(file, aesKey);
 
   // Export AES key to raw bytes
   const aesKeyBytes = await exportAESKey(aesKey);
@@ -81,7 +114,6 @@ async function encryptAndWrapKey(
   return {
     ciphertext: ciphertext,
     wrappedKey: Uint8Array.from(atob(wrappedKey), c => c.charCodeAt(0)),
-    nonce: nonce,
   };
 }
 
@@ -96,34 +128,31 @@ export async function encryptAndUploadDataset(
     const attestation = await attestationApi.getExecutorPubkey();
     const publicKeyPem = attestation.public_key_pem;
 
-    // Read file data
-    const fileData = await file.arrayBuffer();
-
     // Generate dataset ID
     const datasetId = crypto.randomUUID();
 
-    // Encrypt file and wrap key
-    const { ciphertext, wrappedKey, nonce } = await encryptAndWrapKey(
-      fileData,
+    // Encrypt file (segmented format, as done in Python version) and wrap key
+    const { ciphertext, wrappedKey } = await encryptAndWrapKey(
+      file,
       publicKeyPem
     );
 
-    // Combine nonce + ciphertext (as done in Python version)
-    const encryptedData = new Uint8Array(nonce.length + ciphertext.byteLength);
-    encryptedData.set(nonce, 0);
-    encryptedData.set(new Uint8Array(ciphertext), nonce.length);
-
     // Get signed URLs for uploading
-    const [cipherResponse, keyResponse] = await Promise.all([
-      uploadApi.getUploadUrl(workflowId, datasetId, file.name, 'dataset', owner),
-      uploadApi.getUploadUrl(workflowId, datasetId, file.name, 'key', owner),
-    ]);
+    const [cipherResponse, keyResponse] = await uploadApi.getUploadUrls(
+      (['dataset', 'key'] as const).map((fileType) => ({
+        workflow_id: workflowId,
+        dataset_id: datasetId,
+        filename: file.name,
+        file_type: fileType,
+        owner,
+      }))
+    );
 
     // Upload encrypted data and wrapped key
     await Promise.all([
       apiUtils.uploadToSignedUrl(
         cipherResponse.upload_url,
-        encryptedData.buffer,
+        ciphertext,
         'application/octet-stream'
       ),
       apiUtils.uploadToSignedUrl(
@@ -23,11 +23,45 @@ export interface WorkflowResult {
   download_url?: string;
 }
 
+export interface ResultFile {
+  path: string;
+  size: number | null;
+  content_type: string | null;
+  sha256: string | null;
+  crc32c: string | null;
+}
+
+export interface CellProfile {
+  index: number;
+  duration: number | null;
+  status: string | null;
+  peak_memory_bytes: number | null;
+  first_line: string;
+}
+
+export interface RunProfile {
+  total_seconds: number;
+  peak_memory_bytes: number | null;
+  slowest_cells: number[];
+  cells: CellProfile[];
+}
+
 export interface ExecutionResult {
   status: string;
   executed_notebook?: string;
   result_json_paths?: string[];
   model_gcs_path?: string;
+  result_files?: ResultFile[];
+  profile?: RunProfile | null;
+}
+
+export type RunState = 'QUEUED' | 'DOWNLOADING' | 'EXECUTING' | 'UPLOADING' | 'DONE' | 'FAILED';
+
+export interface RunStatus extends ExecutionResult {
+  run_id: string;
+  workflow_id: string;
+  status: RunState;
+  error?: string | null;
 }
 
 // Dataset and Upload Types
@@ -51,6 +85,8 @@ export interface AttestationResponse {
 // Log Types
 export interface WorkflowLogs {
   logs: string[];
+  cursor?: number;
+  truncated?: boolean;
 }
 
 // File Types
@@ -1,25 +1,105 @@
 import os
-import io
+import asyncio
 import uuid
 import json
+import copy
+import struct
+import hashlib
+import shutil
 import tempfile
 import logging
-from typing import List, Dict, Any
-
-from fastapi import FastAPI, HTTPException, Body
+import heapq
+import itertools
+import multiprocessing
+import queue
+from typing import List, Dict, Any, Optional
+
+from fastapi import FastAPI, HTTPException, Body, Query, Request, Header
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel
 from google.cloud import storage
+from google.api_core.exceptions import PreconditionFailed
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import nbformat
-import papermill as pm
-from collections import defaultdict
+import notebook_runner
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import threading, time
+import requests
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+import psutil
 from google.oauth2 import service_account
 
 # ---------- Configuration ----------
 RESULTS_BUCKET = os.environ.get("RESULTS_BUCKET", "yellowsense-technologies-cleanroom")
+# Size of each ranged GCS read when streaming ciphertexts (bounds download memory per dataset)
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+# Max datasets fetched/unwrapped/decrypted at the same time for one workflow
+DATASET_FETCH_CONCURRENCY = int(os.environ.get("DATASET_FETCH_CONCURRENCY", 4))
+# Where decrypted datasets are staged: "memory" (tmpfs, falls back to disk when over budget) or "disk"
+PLAINTEXT_STAGING = os.environ.get("PLAINTEXT_STAGING", "memory")
+PLAINTEXT_TMPFS_DIR = os.environ.get("PLAINTEXT_TMPFS_DIR", "/dev/shm")
+# Memory kept free for kernels and the executor itself when admitting memory-backed staging
+PLAINTEXT_MEMORY_HEADROOM = int(os.environ.get("PLAINTEXT_MEMORY_HEADROOM", 2 * 1024 * 1024 * 1024))
+# Optional columnar copy of each staged CSV for the notebook: "" (off), "arrow" (IPC file) or "parquet"
+COLUMNAR_FORMAT = os.environ.get("COLUMNAR_FORMAT", "")
+COLUMNAR_BLOCK_SIZE = int(os.environ.get("COLUMNAR_BLOCK_SIZE", 16 * 1024 * 1024))   # CSV bytes per record batch
+# Max workflows executed side by side; each notebook runs in its own worker process
+MAX_PARALLEL_RUNS = int(os.environ.get("MAX_PARALLEL_RUNS", max(1, (os.cpu_count() or 2) // 2)))
+# Default execution engine: "papermill" (kernel, executed notebook with outputs) or "script"
+# (compiled cells in a plain subprocess, JSON execution record); runs may choose their own
+EXECUTION_ENGINE = os.environ.get("EXECUTION_ENGINE", "papermill")
+EXECUTION_ENGINES = ("papermill", "script")
+SCRIPT_MEMORY_LIMIT_BYTES = int(os.environ.get("SCRIPT_MEMORY_LIMIT_BYTES", 0))   # address-space cap per script run; 0 = none
+# Warm kernel pool per notebook worker: size 0 disables pooling (cold kernel per run)
+KERNEL_POOL_SIZE = int(os.environ.get("KERNEL_POOL_SIZE", 1))
+KERNEL_WARM_IMPORTS = [m for m in os.environ.get("KERNEL_WARM_IMPORTS", "pandas,numpy,sklearn,lightgbm,imblearn").split(",") if m]
+KERNEL_MAX_USES = int(os.environ.get("KERNEL_MAX_USES", 1))              # runs per kernel before it is discarded
+KERNEL_MAX_AGE_SECONDS = float(os.environ.get("KERNEL_MAX_AGE_SECONDS", 3600))  # idle kernels older than this are replaced
+# Workflow log retention: per-workflow ring buffer, global size cap and idle TTL
+LOG_MAX_LINES_PER_WORKFLOW = int(os.environ.get("LOG_MAX_LINES_PER_WORKFLOW", 5000))
+LOG_MAX_TOTAL_BYTES = int(os.environ.get("LOG_MAX_TOTAL_BYTES", 64 * 1024 * 1024))
+LOG_MAX_LINE_CHARS = int(os.environ.get("LOG_MAX_LINE_CHARS", 4096))
+LOG_TTL_SECONDS = int(os.environ.get("LOG_TTL_SECONDS", 24 * 3600))
+# In-memory cache of unwrapped DEKs (keyed by SHA-256 of the wrapped DEK); size 0 disables it
+DEK_CACHE_SIZE = int(os.environ.get("DEK_CACHE_SIZE", 256))
+DEK_CACHE_TTL_SECONDS = float(os.environ.get("DEK_CACHE_TTL_SECONDS", 3600))
+# Encrypted local cache of staged datasets, keyed by ciphertext generation/checksum; 0 disables it
+DATASET_CACHE_DIR = os.environ.get("DATASET_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ccr-dataset-cache"))
+DATASET_CACHE_MAX_BYTES = int(os.environ.get("DATASET_CACHE_MAX_BYTES", 10 * 1024 * 1024 * 1024))
+# Admission control: each run's memory footprint is estimated as
+#   RUN_BASE_MEMORY_BYTES + workload multiplier * total ciphertext bytes
+# (the multiplier covers staged plaintext, dataframes and training) and runs only start while
+# their footprints fit ADMISSION_MEMORY_BUDGET_BYTES and a run slot (MAX_PARALLEL_RUNS) is free.
+ADMISSION_MEMORY_BUDGET_BYTES = int(os.environ.get("ADMISSION_MEMORY_BUDGET_BYTES", int(psutil.virtual_memory().total * 0.8)))
+RUN_BASE_MEMORY_BYTES = int(os.environ.get("RUN_BASE_MEMORY_BYTES", 512 * 1024 * 1024))
+WORKLOAD_MEMORY_MULTIPLIER = float(os.environ.get("WORKLOAD_MEMORY_MULTIPLIER", 4.0))
+WORKLOAD_MEMORY_MULTIPLIERS = json.loads(os.environ.get("WORKLOAD_MEMORY_MULTIPLIERS", "{}"))   # {workload gs uri: multiplier}
+ADMISSION_POLICY = os.environ.get("ADMISSION_POLICY", "fifo")   # fifo | priority
+ADMISSION_MAX_QUEUED = int(os.environ.get("ADMISSION_MAX_QUEUED", 32))   # beyond this /execute answers 429
+# Checkpointed runs: encrypted snapshots of failed runs, kept so they can be resumed
+CHECKPOINT_DIR = os.environ.get("CHECKPOINT_DIR", os.path.join(tempfile.gettempdir(), "ccr-checkpoints"))
+CHECKPOINT_RETENTION_SECONDS = int(os.environ.get("CHECKPOINT_RETENTION_SECONDS", 24 * 3600))
+CHECKPOINT_TAG = "checkpoint"   # workload cells with this tag are followed by a state snapshot
+# Memoized result sets: a run whose fingerprint (workload generation, injected parameters,
+# ciphertext and wrapped-DEK checksums) matches a completed run returns that run's results;
+# size 0 disables memoization
+RESULT_MEMO_SIZE = int(os.environ.get("RESULT_MEMO_SIZE", 128))
+RESULT_MEMO_TTL_SECONDS = float(os.environ.get("RESULT_MEMO_TTL_SECONDS", 7 * 24 * 3600))
+# How long finished runs stay queryable through /runs/{run_id}
+RUN_RETENTION_SECONDS = int(os.environ.get("RUN_RETENTION_SECONDS", 3600))
+# Result upload from the injected uploader cell: parallel result files, streamed model archive
+RESULT_UPLOAD_CONCURRENCY = int(os.environ.get("RESULT_UPLOAD_CONCURRENCY", 8))
+MODEL_ARCHIVE_FORMAT = os.environ.get("MODEL_ARCHIVE_FORMAT", "zip")   # zip | tar | gztar
+MODEL_ARCHIVE_COMPRESSION_LEVEL = int(os.environ.get("MODEL_ARCHIVE_COMPRESSION_LEVEL", 6))  # 0-9
+# The workload notebook every run executes
+FIXED_WORKLOAD_GCS = "gs://yellowsense-technologies-cleanroom/workloads/fraud-detector.ipynb"
+# On-disk copy of prepared workload notebooks, keyed by GCS object generation and injected-cell version
+WORKLOAD_CACHE_DIR = os.environ.get("WORKLOAD_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ccr-workload-cache"))
 # Optionally restrict allowed GCS buckets/prefixes for security
 ALLOWED_SOURCE_BUCKETS = None  # set to list like ["client-a-bucket", "client-b-bucket"] if desired
 
@@ -35,28 +115,178 @@ storage_client = storage.Client(credentials=creds)
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("tee-executor")
 
-# Store logs in memory: { workflow_id: [log lines] }
-WORKFLOW_LOGS = defaultdict(list)
-LOG_LOCK = threading.Lock()
+class _WorkflowLog:
+    def __init__(self, max_lines: int):
+        self.lines = deque(maxlen=max_lines)   # (seq, line)
+        self.next_seq = 1
+        self.updated_at = time.monotonic()
+
+def _remove_waiter(waiters: Dict[str, list], key: str, waiter):
+    """ Drops a finished long-poll from waiters[key], and the key once nobody waits on it. Call under the owner's lock. """
+    pending = waiters.get(key)
+    if pending and waiter in pending:
+        pending.remove(waiter)
+    if key in waiters and not waiters[key]:
+        del waiters[key]
+
+class WorkflowLogStore:
+    """
+    Bounded in-memory store for workflow logs.
+
+    Each workflow keeps a ring buffer of its latest lines, tagged with sequence numbers
+    that only ever increase, so readers resume from a cursor instead of re-reading
+    everything. Workflows idle for longer than the TTL are dropped. When the global byte cap
+    is exceeded, the oldest lines of the least recently written workflows go first.
+    """
+
+    def __init__(self, max_lines: int, max_bytes: int, ttl: float):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._logs: "OrderedDict[str, _WorkflowLog]" = OrderedDict()   # least recently written first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._waiters: Dict[str, list] = defaultdict(list)   # workflow_id -> [(event loop, asyncio.Event)]
+
+    def append(self, workflow_id: str, line: str):
+        line = line[:LOG_MAX_LINE_CHARS]
+        with self._lock:
+            wl = self._logs.get(workflow_id)
+            if wl is None:
+                wl = self._logs[workflow_id] = _WorkflowLog(self.max_lines)
+            self._logs.move_to_end(workflow_id)
+            if len(wl.lines) == wl.lines.maxlen:
+                self._bytes -= len(wl.lines[0][1])
+            wl.lines.append((wl.next_seq, line))
+            wl.next_seq += 1
+            wl.updated_at = time.monotonic()
+            self._bytes += len(line)
+            self._evict()
+            waiters = self._waiters.pop(workflow_id, [])
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # the waiting request's loop is gone
+
+    def _evict(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._logs:
+            workflow_id, wl = next(iter(self._logs.items()))
+            if wl.updated_at >= cutoff:
+                break
+            self._bytes -= sum(len(line) for _, line in wl.lines)
+            del self._logs[workflow_id]
+            self._waiters.pop(workflow_id, None)
+        while self._bytes > self.max_bytes and self._logs:
+            workflow_id, wl = next(iter(self._logs.items()))
+            if wl.lines:
+                self._bytes -= len(wl.lines.popleft()[1])
+            else:
+                del self._logs[workflow_id]
+                self._waiters.pop(workflow_id, None)
+
+    def read(self, workflow_id: str, since: int = 0):
+        """
+        Returns (entries, cursor, truncated): the (seq, line) entries after `since`, the
+        cursor to pass next time, and whether lines after `since` were already evicted.
+        """
+        with self._lock:
+            wl = self._logs.get(workflow_id)
+            if wl is None:
+                return [], 0, False
+            if since >= wl.next_seq:
+                since = 0  # the workflow's log was evicted and restarted since the cursor was issued
+            first_seq = wl.lines[0][0] if wl.lines else wl.next_seq
+            entries = list(wl.lines)[max(0, since + 1 - first_seq):]
+            return entries, wl.next_seq - 1, since + 1 < first_seq
+
+    async def wait(self, workflow_id: str, since: int, timeout: float) -> bool:
+        """ Waits until the workflow has lines after `since`; returns False on timeout. """
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            wl = self._logs.get(workflow_id)
+            if wl is not None and wl.next_seq - 1 != since:
+                return True
+            self._waiters[workflow_id].append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                _remove_waiter(self._waiters, workflow_id, waiter)
+
+LOG_STORE = WorkflowLogStore(LOG_MAX_LINES_PER_WORKFLOW, LOG_MAX_TOTAL_BYTES, LOG_TTL_SECONDS)
 
 def append_log(workflow_id, msg):
-    with LOG_LOCK:
-        WORKFLOW_LOGS[workflow_id].append(msg)
+    LOG_STORE.append(workflow_id, msg)
     log.info(msg)  # still send to console
 
-def tail_pm_logs(log_file, workflow_id):
-    """ Continuously read papermill logs while notebook executes. """
-    try:
-        with open(log_file, "r") as f:
-            f.seek(0, io.SEEK_END)  # Start from end of file
-            while True:
-                line = f.readline()
-                if line:
-                    append_log(workflow_id, f"[pm] {line.strip()}")
-                else:
-                    time.sleep(0.5)
-    except Exception as e:
-        append_log(workflow_id, f"[pm-logger-error] {e}")
+# ---------- Metrics ----------
+PHASE_SECONDS = Histogram(
+    "executor_phase_seconds", "Time spent in each phase of a run", ["phase"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+RUNS_TOTAL = Counter("executor_runs_total", "Finished runs by outcome", ["status"])
+RUNS_REJECTED_TOTAL = Counter("executor_runs_rejected_total", "Runs refused by admission control", ["reason"])
+ADMISSION_QUEUED = Gauge("executor_admission_queued_runs", "Admitted runs waiting for memory or a run slot")
+ADMISSION_MEMORY_RESERVED = Gauge("executor_admission_memory_reserved_bytes", "Estimated memory of running runs")
+RESULT_MEMO_LOOKUPS_TOTAL = Counter("executor_result_memo_lookups_total", "Memoized result lookups by outcome", ["outcome"])
+DATASETS_STAGED_TOTAL = Counter("executor_datasets_staged_total", "Datasets staged by source", ["source"])
+DATASET_BYTES_TOTAL = Counter("executor_dataset_bytes_total", "Plaintext bytes staged by source", ["source"])
+
+class RunTimings:
+    """
+    Per-run phase timings. Every measurement is observed into PHASE_SECONDS and summed per
+    phase for the run's result; dataset phases are also kept per dataset.
+    """
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.datasets: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, seconds: float):
+        PHASE_SECONDS.labels(phase).observe(seconds)
+        with self._lock:
+            self.phases[phase] = round(self.phases.get(phase, 0.0) + seconds, 4)
+
+    @contextmanager
+    def phase(self, phase: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - t0)
+
+    def record_dataset(self, name: str, owner: str, source: str, size: int, phases: Dict[str, float]):
+        for phase, seconds in phases.items():
+            self.record(phase, seconds)
+        DATASETS_STAGED_TOTAL.labels(source).inc()
+        DATASET_BYTES_TOTAL.labels(source).inc(size)
+        with self._lock:
+            self.datasets.append({"name": name, "owner": owner, "source": source, "bytes": size,
+                                  **{phase: round(seconds, 4) for phase, seconds in phases.items()}})
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"phases": dict(self.phases), "datasets": list(self.datasets)}
+
+class _TimedReader:
+    """ Wraps a file-like source and accumulates the time spent waiting in read(). """
+
+    def __init__(self, src):
+        self._src = src
+        self.seconds = 0.0
+
+    def read(self, n: int = -1) -> bytes:
+        t0 = time.perf_counter()
+        try:
+            return self._src.read(n)
+        finally:
+            self.seconds += time.perf_counter() - t0
 
 # ---------- FastAPI app ----------
 app = FastAPI(title="TEE Executor (Confidential VM)")
@@ -73,11 +303,21 @@ _pub_pem = _priv_key.public_key().public_bytes(
 # ---------- Storage client ----------
 # storage_client = storage.Client()
 
+# Size the shared GCS connection pool for the parallel dataset stage (requests defaults to 10
+# pooled connections, which would otherwise be discarded and re-handshaked under load): every
+# running run stages DATASET_FETCH_CONCURRENCY objects at once and uploads its executed
+# notebook, while /execute fetches the metadata of the next run's datasets.
+_gcs_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=max(10, MAX_PARALLEL_RUNS * (DATASET_FETCH_CONCURRENCY + 1) + DATASET_FETCH_CONCURRENCY),
+)
+storage_client._http.mount("https://", _gcs_adapter)
+
 
 # ---------- Pydantic models ----------
 class DatasetSpec(BaseModel):
     owner: str
-    ciphertext_gcs: str           # gs://bucket/path/to/ciphertext (nonce||ciphertext format)
+    ciphertext_gcs: str           # gs://bucket/path/to/ciphertext (segmented container or legacy nonce||ciphertext)
     wrapped_dek_gcs: str          # gs://bucket/path/to/wrapped_dek (bytes)
 
 class ExecuteRequest(BaseModel):
@@ -86,7 +326,12 @@ class ExecuteRequest(BaseModel):
     datasets: List[DatasetSpec]   # list of datasets (owner + ciphertext + wrapped dek)
     result_base: str              # gs://bucket/results/<workflow_id>/result  (no extension)
     executed_notebook_base: str   # gs://bucket/results/<workflow_id>/executed  (no extension)
-
+    run_id: Optional[str] = None          # caller-chosen run id (generated if omitted)
+    priority: int = 0                     # higher runs first when ADMISSION_POLICY=priority
+    checkpoint: bool = False              # snapshot state after "checkpoint" cells so a failed run can resume
+    force: bool = False                   # re-execute even if a memoized result set matches
+    engine: Optional[str] = None          # "papermill" | "script" (default EXECUTION_ENGINE)
+    callback_url: Optional[str] = None    # POSTed the final run record when the run is DONE/FAILED
 
 
 # ---------- Utility helpers ----------
@@ -109,6 +354,39 @@ def download_blob_bytes(gs_uri: str) -> bytes:
     data = b.download_as_bytes()
     return data
 
+def open_blob_reader(gs_uri: str, generation: Optional[int] = None):
+    """
+    Opens a GCS object as a buffered, chunked reader instead of downloading it whole.
+    If generation is given, reads fail should the object be replaced meanwhile.
+    """
+    bucket, obj = parse_gs_uri(gs_uri)
+    if ALLOWED_SOURCE_BUCKETS and bucket not in ALLOWED_SOURCE_BUCKETS:
+        raise HTTPException(status_code=403, detail=f"Bucket {bucket} not allowed")
+    kwargs = {"if_generation_match": generation} if generation is not None else {}
+    return storage_client.bucket(bucket).blob(obj).open("rb", chunk_size=DOWNLOAD_CHUNK_SIZE, **kwargs)
+
+def get_blob_metadata(gs_uri: str):
+    """ Fetches an object's metadata (size, generation, checksums) without its content. """
+    bucket, obj = parse_gs_uri(gs_uri)
+    if ALLOWED_SOURCE_BUCKETS and bucket not in ALLOWED_SOURCE_BUCKETS:
+        raise HTTPException(status_code=403, detail=f"Bucket {bucket} not allowed")
+    blob = storage_client.bucket(bucket).get_blob(obj)
+    if blob is None:
+        raise HTTPException(status_code=404, detail=f"{gs_uri} not found")
+    return blob
+
+def fetch_dataset_metadata(datasets: List["DatasetSpec"], wrapped_keys: bool = False) -> Dict[str, Any]:
+    """
+    Metadata of every ciphertext (and wrapped DEK, if asked), fetched concurrently, as
+    {gs uri: blob}. Fetched once per run and shared by admission, memoization, the staging
+    reservation and staging itself.
+    """
+    uris = list(dict.fromkeys(
+        uri for ds in datasets for uri in ((ds.ciphertext_gcs, ds.wrapped_dek_gcs) if wrapped_keys else (ds.ciphertext_gcs,))
+    ))
+    with ThreadPoolExecutor(max_workers=max(1, DATASET_FETCH_CONCURRENCY)) as pool:
+        return dict(zip(uris, pool.map(get_blob_metadata, uris)))
+
 def upload_blob_from_file(gs_uri: str, local_path: str):
     bucket, obj = parse_gs_uri(gs_uri)
     blob = storage_client.bucket(bucket).blob(obj)
@@ -141,6 +419,551 @@ def list_result_blob_under_prefix(result_base: str):
     candidates = [b for b in blobs if not b.name.endswith('/')]
     return candidates
 
+# ---------- Segmented dataset format ----------
+# Datasets are uploaded as a versioned, chunked AES-GCM container so that neither the
+# client nor the executor has to hold a whole dataset in memory:
+#
+#   header  = MAGIC(4) || VERSION(1) || SEGMENT_SIZE(4, big-endian) || NONCE_PREFIX(7)
+#   segment = AES-GCM(dek, nonce = NONCE_PREFIX || INDEX(4, big-endian) || LAST(1), aad = header)
+#
+# The segment index and the final-segment flag are bound through the nonce and the header
+# through the AAD, so segments cannot be reordered, dropped, truncated or spliced.
+# Objects that do not start with MAGIC are the legacy single-shot nonce||ciphertext format.
+SEGMENTED_MAGIC = b"CCRS"
+SEGMENTED_VERSION = 1
+SEGMENTED_HEADER_LEN = 16
+GCM_NONCE_LEN = 12
+GCM_TAG_LEN = 16
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+
+def _segment_nonce(prefix: bytes, index: int, last: bool) -> bytes:
+    if index > 0xFFFFFFFF:
+        raise ValueError("Too many segments in dataset")
+    return prefix + struct.pack(">IB", index, 1 if last else 0)
+
+def _read_exact(f, n: int) -> bytes:
+    """ Reads up to n bytes, only returning fewer at end of stream. """
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = f.read(n - len(buf))
+        if not chunk:
+            break
+        buf += chunk
+    return bytes(buf)
+
+def decrypt_dataset_stream(src, dek: bytes, dst_path: str, tee=None) -> int:
+    """
+    Decrypts a dataset read from the file-like `src` into dst_path, one segment at a time.
+    Falls back to the legacy single-shot format for objects without the segmented header.
+    If given, tee is also called with every authenticated plaintext chunk.
+    Returns the number of plaintext bytes written.
+    """
+    aesgcm = AESGCM(dek)
+    header = _read_exact(src, SEGMENTED_HEADER_LEN)
+
+    if header[:4] != SEGMENTED_MAGIC:
+        data = header + src.read()
+        plaintext = aesgcm.decrypt(data[:GCM_NONCE_LEN], data[GCM_NONCE_LEN:], None)
+        with open(dst_path, "wb") as f:
+            f.write(plaintext)
+        if tee:
+            tee(plaintext)
+        return len(plaintext)
+
+    if len(header) < SEGMENTED_HEADER_LEN:
+        raise ValueError("Truncated dataset header")
+    version, segment_size = struct.unpack(">BI", header[4:9])
+    if version != SEGMENTED_VERSION:
+        raise ValueError(f"Unsupported dataset format version {version}")
+    if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+        raise ValueError(f"Invalid dataset segment size {segment_size}")
+    prefix = header[9:]
+
+    # Read one segment ahead so we know which one carries the final-segment flag.
+    enc_segment_size = segment_size + GCM_TAG_LEN
+    written, index = 0, 0
+    current = _read_exact(src, enc_segment_size)
+    with open(dst_path, "wb") as out:
+        while True:
+            nxt = _read_exact(src, enc_segment_size) if len(current) == enc_segment_size else b""
+            last = not nxt
+            if len(current) < GCM_TAG_LEN:
+                raise ValueError("Truncated dataset segment")
+            plaintext = aesgcm.decrypt(_segment_nonce(prefix, index, last), current, header)
+            out.write(plaintext)
+            if tee:
+                tee(plaintext)
+            written += len(plaintext)
+            if last:
+                return written
+            current, index = nxt, index + 1
+
+class SegmentedWriter:
+    """
+    Writes plaintext to `f` in the segmented container format. A segment is only sealed once
+    data for the next one arrives, so close() can mark the real final segment.
+    """
+
+    def __init__(self, f, key: bytes, segment_size: int = 1024 * 1024):
+        self._f = f
+        self._aesgcm = AESGCM(key)
+        self._segment_size = segment_size
+        self._prefix = os.urandom(7)
+        self._header = SEGMENTED_MAGIC + struct.pack(">BI", SEGMENTED_VERSION, segment_size) + self._prefix
+        self._index = 0
+        self._buf = bytearray()
+        f.write(self._header)
+
+    def _seal(self, chunk: bytes, last: bool):
+        self._f.write(self._aesgcm.encrypt(_segment_nonce(self._prefix, self._index, last), bytes(chunk), self._header))
+        self._index += 1
+
+    def write(self, data: bytes):
+        self._buf += data
+        while len(self._buf) > self._segment_size:
+            self._seal(self._buf[:self._segment_size], last=False)
+            del self._buf[:self._segment_size]
+
+    def close(self):
+        self._seal(self._buf, last=True)
+        self._buf = bytearray()
+
+# ---------- Dataset cache ----------
+class DatasetCache:
+    """
+    Executor-local cache of staged datasets, so reruns over unchanged ciphertexts skip the
+    GCS download. Entries are re-encrypted with a key that only ever lives in this process's
+    memory; the directory is wiped on start because nothing in it is readable after a
+    restart. Entries are keyed by object generation, checksum and DEK, so a replaced
+    source object misses and its older entry is dropped. Least recently used entries are
+    evicted once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.derived_hits = 0     # lookups of derived artifacts (columnar copies), counted apart
+        self.derived_misses = 0
+        self._key = AESGCM.generate_key(bit_length=256)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()   # entry id -> (gs uri, size), LRU first
+        self._lock = threading.Lock()
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def entry_id(gs_uri: str, blob, dek: bytes) -> str:
+        checksum = blob.crc32c or blob.md5_hash or ""
+        material = f"{gs_uri}#{blob.generation}:{checksum}:".encode("utf-8") + hashlib.sha256(dek).digest()
+        return hashlib.sha256(material).hexdigest()
+
+    @staticmethod
+    def derived_id(entry_id: str, kind: str) -> str:
+        """ Id for an artifact derived from an entry's plaintext, e.g. its columnar copy. """
+        return hashlib.sha256(f"{entry_id}:{kind}".encode("utf-8")).hexdigest()
+
+    def _path(self, entry_id: str) -> str:
+        return os.path.join(self.directory, entry_id)
+
+    def stage(self, entry_id: str, dst_path: str, derived: bool = False) -> Optional[int]:
+        """
+        Decrypts a cached entry into dst_path; returns its size, or None on a miss. derived
+        marks lookups of derived_id entries, which have their own hit/miss counters.
+        """
+        with self._lock:
+            if entry_id not in self._entries:
+                if derived:
+                    self.derived_misses += 1
+                else:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            if derived:
+                self.derived_hits += 1
+            else:
+                self.hits += 1
+        try:
+            with open(self._path(entry_id), "rb") as src:
+                return decrypt_dataset_stream(src, self._key, dst_path)
+        except (OSError, ValueError) as e:   # evicted meanwhile or corrupted: treat as a miss
+            log.warning(f"Dataset cache entry {entry_id[:12]} unusable: {e}")
+            self._remove(entry_id)
+            return None
+
+    def writer(self, entry_id: str):
+        """ Returns (write, commit, abort) callables that fill a new entry. """
+        tmp_path = f"{self._path(entry_id)}.{uuid.uuid4().hex}.tmp"
+        f = open(tmp_path, "wb")
+        seg = SegmentedWriter(f, self._key)
+
+        def commit(gs_uri: str):
+            seg.close()
+            f.close()
+            size = os.path.getsize(tmp_path)
+            if size > self.max_bytes:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, self._path(entry_id))
+            with self._lock:
+                stale = [eid for eid, (uri, _) in self._entries.items() if uri == gs_uri and eid != entry_id]
+                self._entries[entry_id] = (gs_uri, size)
+                self._entries.move_to_end(entry_id)
+                total = sum(sz for _, sz in self._entries.values())
+                for eid in list(self._entries):
+                    if total <= self.max_bytes:
+                        break
+                    if eid != entry_id and eid not in stale:
+                        stale.append(eid)
+                        total -= self._entries[eid][1]
+            for eid in stale:
+                self._remove(eid)
+
+        def abort():
+            f.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return seg.write, commit, abort
+
+    def store_file(self, entry_id: str, path: str, gs_uri: str):
+        """ Adds the plaintext file at path as entry_id. """
+        write, commit, abort = self.writer(entry_id)
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    write(chunk)
+            commit(gs_uri)
+        except BaseException:
+            abort()
+            raise
+
+    def _remove(self, entry_id: str):
+        with self._lock:
+            self._entries.pop(entry_id, None)
+        try:
+            os.remove(self._path(entry_id))
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": sum(sz for _, sz in self._entries.values()),
+                    "hits": self.hits, "misses": self.misses,
+                    "derived_hits": self.derived_hits, "derived_misses": self.derived_misses}
+
+DATASET_CACHE = DatasetCache(DATASET_CACHE_DIR, DATASET_CACHE_MAX_BYTES) if DATASET_CACHE_MAX_BYTES > 0 else None
+
+# ---------- Dataset staging ----------
+class DekCache:
+    """
+    Memory-only LRU cache from SHA-256(wrapped DEK) to the unwrapped DEK, so reruns over the
+    same datasets skip the RSA-OAEP decrypt. Entries expire after `ttl` seconds and the whole
+    cache is dropped whenever the enclave key it was filled under changes.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()   # digest -> (dek, expires_at)
+        self._key_id = None
+        self._lock = threading.Lock()
+
+    def _check_key(self, key_id: str):
+        if key_id != self._key_id:
+            self._entries.clear()
+            self._key_id = key_id
+
+    def get(self, key_id: str, wrapped_dek: bytes) -> Optional[bytes]:
+        digest = hashlib.sha256(wrapped_dek).digest()
+        with self._lock:
+            self._check_key(key_id)
+            entry = self._entries.get(digest)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(digest, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key_id: str, wrapped_dek: bytes, dek: bytes):
+        if self.max_entries <= 0:
+            return
+        digest = hashlib.sha256(wrapped_dek).digest()
+        with self._lock:
+            self._check_key(key_id)
+            self._entries[digest] = (dek, time.monotonic() + self.ttl)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+DEK_CACHE = DekCache(DEK_CACHE_SIZE, DEK_CACHE_TTL_SECONDS)
+
+def unwrap_dek(wrapped_dek_bytes: bytes) -> bytes:
+    # The public key identifies the keypair: a rotated key invalidates every cached DEK
+    key_id = _pub_pem
+    dek = DEK_CACHE.get(key_id, wrapped_dek_bytes)
+    if dek is None:
+        dek = _priv_key.decrypt(
+            wrapped_dek_bytes,
+            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+        )
+        DEK_CACHE.put(key_id, wrapped_dek_bytes, dek)
+    return dek
+
+def _stage_dataset(workflow_id: str, ds: "DatasetSpec", local_path: str, timings: Optional[RunTimings] = None,
+                   blob=None):
+    """
+    Downloads the wrapped DEK, unwraps it and streams the decrypted dataset to local_path,
+    from the local dataset cache when the ciphertext is unchanged. The DEK is always
+    fetched, so an owner deleting it still revokes access to cached copies. blob is the
+    ciphertext's metadata from when the run was queued; that version is staged, or the
+    current one if it has since been replaced in GCS and is not cached.
+    """
+    t0 = time.perf_counter()
+    wrapped_dek_bytes = download_blob_bytes(ds.wrapped_dek_gcs)
+    t1 = time.perf_counter()
+    dek = unwrap_dek(wrapped_dek_bytes)
+    t2 = time.perf_counter()
+
+    size, source, entry_id, reader = None, "download+decrypt", None, None
+    for attempt in range(2):
+        if blob is None:
+            blob = get_blob_metadata(ds.ciphertext_gcs)
+        try:
+            if DATASET_CACHE:
+                entry_id = DatasetCache.entry_id(ds.ciphertext_gcs, blob, dek)
+                size = DATASET_CACHE.stage(entry_id, local_path)
+                if size is not None:
+                    source = "cache"
+                else:
+                    write, commit, abort = DATASET_CACHE.writer(entry_id)
+                    try:
+                        with open_blob_reader(ds.ciphertext_gcs, generation=blob.generation) as src:
+                            reader = _TimedReader(src)
+                            size = decrypt_dataset_stream(reader, dek, local_path, tee=write)
+                        commit(ds.ciphertext_gcs)
+                    except BaseException:
+                        abort()
+                        raise
+            else:
+                with open_blob_reader(ds.ciphertext_gcs, generation=blob.generation) as src:
+                    reader = _TimedReader(src)
+                    size = decrypt_dataset_stream(reader, dek, local_path)
+            break
+        except PreconditionFailed:
+            # Replaced while the run was queued: stage the current version
+            if attempt:
+                raise
+            blob, reader = None, None
+    t3 = time.perf_counter()
+    append_log(
+        workflow_id,
+        f"Staged dataset {os.path.basename(local_path)} for owner={ds.owner} ({size} bytes): "
+        f"key fetch {t1 - t0:.2f}s, unwrap {t2 - t1:.2f}s, {source} {t3 - t2:.2f}s"
+    )
+    if timings:
+        phases = {"dataset_key_fetch": t1 - t0, "dek_unwrap": t2 - t1}
+        if reader is None:
+            phases["dataset_cache_restore"] = t3 - t2
+        else:
+            # Download and decryption are interleaved; split by time spent waiting on GCS reads
+            phases["dataset_download"] = reader.seconds
+            phases["dataset_decrypt"] = t3 - t2 - reader.seconds
+        timings.record_dataset(os.path.basename(local_path), ds.owner, "cache" if reader is None else "gcs", size, phases)
+    return entry_id
+
+def convert_csv_to_columnar(csv_path: str, out_path: str, fmt: str):
+    """
+    Streams csv_path into an Arrow IPC file or a Parquet file one record batch at a time.
+    The schema is inferred from the first block; a later block that does not fit it fails
+    the conversion.
+    """
+    import pyarrow as pa   # only needed when COLUMNAR_FORMAT is set
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+
+    reader = pacsv.open_csv(csv_path, read_options=pacsv.ReadOptions(block_size=COLUMNAR_BLOCK_SIZE))
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(out_path, reader.schema)
+        write = lambda batch: writer.write_table(pa.Table.from_batches([batch]))
+    else:
+        writer = pa.ipc.new_file(out_path, reader.schema)
+        write = writer.write_batch
+    try:
+        for batch in reader:
+            write(batch)
+    finally:
+        writer.close()
+
+def read_columnar_schema(path: str, fmt: str) -> Dict[str, str]:
+    """ Reads just the schema (file footer) of a converted dataset as {column: arrow type}. """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if fmt == "parquet":
+        schema = pq.read_schema(path)
+    else:
+        with pa.memory_map(path) as source:
+            schema = pa.ipc.open_file(source).schema
+    return {field.name: str(field.type) for field in schema}
+
+def _convert_dataset(workflow_id: str, ds: "DatasetSpec", local_path: str, entry_id: Optional[str],
+                     timings: Optional[RunTimings] = None):
+    """
+    Produces the columnar copy of a staged CSV next to it, reusing a cached conversion of the
+    same dataset version. Returns (file name, schema), or None if the dataset is not
+    converted; a failed conversion leaves the notebook with the CSV only.
+    """
+    if not COLUMNAR_FORMAT or not local_path.lower().endswith(".csv"):
+        return None
+    t0 = time.perf_counter()
+    out_path = f"{local_path}.{COLUMNAR_FORMAT}"
+    cache_id = DatasetCache.derived_id(entry_id, COLUMNAR_FORMAT) if DATASET_CACHE and entry_id else None
+    source = "cache"
+    try:
+        if cache_id is None or DATASET_CACHE.stage(cache_id, out_path, derived=True) is None:
+            source = "converted"
+            convert_csv_to_columnar(local_path, out_path, COLUMNAR_FORMAT)
+            if cache_id:
+                DATASET_CACHE.store_file(cache_id, out_path, f"{ds.ciphertext_gcs}#{COLUMNAR_FORMAT}")
+        schema = read_columnar_schema(out_path, COLUMNAR_FORMAT)
+    except Exception as e:
+        append_log(workflow_id, f"Columnar conversion of {os.path.basename(local_path)} failed, keeping CSV only: {e}")
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        return None
+    elapsed = time.perf_counter() - t0
+    if timings:
+        timings.record("columnar_conversion", elapsed)
+    append_log(
+        workflow_id,
+        f"Columnar {COLUMNAR_FORMAT} copy of {os.path.basename(local_path)} ({source}, {len(schema)} columns) "
+        f"in {elapsed:.2f}s"
+    )
+    return os.path.basename(out_path), schema
+
+def _stage_and_convert(workflow_id: str, ds: "DatasetSpec", local_path: str, timings: Optional[RunTimings] = None,
+                       blob=None):
+    entry_id = _stage_dataset(workflow_id, ds, local_path, timings, blob)
+    return _convert_dataset(workflow_id, ds, local_path, entry_id, timings)
+
+def stage_datasets(workflow_id: str, datasets: List["DatasetSpec"], workdir: str,
+                   staging_dir: Optional[str] = None, timings: Optional[RunTimings] = None,
+                   blob_metadata: Optional[Dict[str, Any]] = None):
+    """
+    Fetches, unwraps and decrypts all datasets on a bounded thread pool, so downloads of
+    one dataset overlap with decryption of the others. Plaintext is written to staging_dir
+    (default: workdir) and linked into workdir. Returns (plaintext paths grouped by owner,
+    in request order; {plaintext name: {"path", "schema"}} of columnar copies), with all
+    paths relative to workdir. blob_metadata: fetch_dataset_metadata of datasets, if known.
+    """
+    staging_dir = staging_dir or workdir
+    blob_metadata = blob_metadata or {}
+    # Pick local filenames up front so parallel writers never share a path
+    local_names = []
+    for ds in datasets:
+        _, obj_path = parse_gs_uri(ds.ciphertext_gcs)
+        filename = os.path.basename(obj_path)  # preserve "my_data.csv"
+        if filename in local_names:
+            filename = f"{ds.owner}_{len(local_names)}_{filename}"
+        local_names.append(filename)
+        append_log(workflow_id, f"Processing dataset for owner={ds.owner}")
+
+    t0 = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=max(1, DATASET_FETCH_CONCURRENCY), thread_name_prefix=f"stage-{workflow_id[:8]}")
+    try:
+        futures = [
+            pool.submit(_stage_and_convert, workflow_id, ds, os.path.join(staging_dir, name), timings,
+                        blob_metadata.get(ds.ciphertext_gcs))
+            for ds, name in zip(datasets, local_names)
+        ]
+        converted = [fut.result() for fut in futures]
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    append_log(workflow_id, f"Staged {len(datasets)} dataset(s) in {time.perf_counter() - t0:.2f}s")
+
+    columnar = {
+        name: {"path": conv[0], "schema": conv[1]}
+        for name, conv in zip(local_names, converted) if conv
+    }
+    if staging_dir != workdir:
+        for name in local_names + [c["path"] for c in columnar.values()]:
+            os.symlink(os.path.join(staging_dir, name), os.path.join(workdir, name))
+
+    plaintext_paths = {}
+    for ds, name in zip(datasets, local_names):
+        plaintext_paths.setdefault(ds.owner, []).append(name)
+    return plaintext_paths, columnar
+
+# ---------- Plaintext staging area ----------
+# Decrypted datasets go to a per-run directory on tmpfs so plaintext never reaches
+# persistent disk, the notebook can mmap it, and teardown is a single rmtree.
+_staging_lock = threading.Lock()
+_staging_reserved = 0   # bytes promised to runs currently staged in memory
+
+def _memory_staging_budget() -> int:
+    """ Free tmpfs space, capped by MemAvailable minus headroom, less what other runs reserved. """
+    try:
+        st = os.statvfs(PLAINTEXT_TMPFS_DIR)
+    except (OSError, AttributeError):
+        return 0
+    budget = st.f_bavail * st.f_frsize
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f}
+        budget = min(budget, meminfo["MemAvailable"] - PLAINTEXT_MEMORY_HEADROOM)
+    except (OSError, KeyError, ValueError, IndexError):
+        pass
+    return budget - _staging_reserved
+
+def _estimate_plaintext_bytes(datasets: List["DatasetSpec"], blob_metadata: Optional[Dict[str, Any]] = None) -> int:
+    """
+    Ciphertext sizes from object metadata; plaintext is never larger. Doubled when a
+    columnar copy is staged next to each dataset.
+    """
+    blob_metadata = blob_metadata or fetch_dataset_metadata(datasets)
+    total = sum(blob_metadata[ds.ciphertext_gcs].size or 0 for ds in datasets)
+    return total * 2 if COLUMNAR_FORMAT else total
+
+def reserve_plaintext_staging(workflow_id: str, datasets: List["DatasetSpec"],
+                              blob_metadata: Optional[Dict[str, Any]] = None):
+    """
+    Returns (staging_dir, reserved_bytes). staging_dir is None when plaintext should be
+    staged on disk inside the workdir: disk mode, no tmpfs, or not enough memory.
+    """
+    global _staging_reserved
+    if PLAINTEXT_STAGING != "memory" or not os.path.isdir(PLAINTEXT_TMPFS_DIR):
+        return None, 0
+    needed = _estimate_plaintext_bytes(datasets, blob_metadata)
+    with _staging_lock:
+        budget = _memory_staging_budget()
+        if needed > budget:
+            append_log(workflow_id, f"Staging datasets on disk: {needed} bytes exceeds memory budget of {max(budget, 0)} bytes")
+            return None, 0
+        _staging_reserved += needed
+    staging_dir = tempfile.mkdtemp(prefix=f"wf_{workflow_id}_", dir=PLAINTEXT_TMPFS_DIR)
+    append_log(workflow_id, f"Staging datasets in memory ({needed} bytes reserved)")
+    return staging_dir, needed
+
+def release_plaintext_staging(staging_dir: Optional[str], reserved: int):
+    global _staging_reserved
+    if staging_dir:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    with _staging_lock:
+        _staging_reserved -= reserved
+
 # ---------- Attestation endpoint ----------
 @app.get("/attestation")
 def get_attestation():
@@ -185,17 +1008,500 @@ def get_attestation_token(pub_pem: str) -> str:
     return fake_token
 
 
-# Updated 'execute' function with os.chdir()
-@app.post("/execute")
-def execute(req: ExecuteRequest = Body(...)):
+# ---------- Result memoization ----------
+def run_fingerprint(req: "ExecuteRequest", blob_metadata: Optional[Dict[str, Any]] = None):
     """
-    Main execution API. Expects:
+    Returns (fingerprint, workload generation) for req: SHA-256 over the workload generation,
+    everything inject_params derives from the request and the checksums of every ciphertext
+    and wrapped DEK. Runs with equal fingerprints execute the same notebook on the same inputs.
+    """
+    _, generation = get_prepared_workload(FIXED_WORKLOAD_GCS)
+    blob_metadata = blob_metadata or fetch_dataset_metadata(req.datasets, wrapped_keys=True)
+    checksums = [[{"size": blob.size, "md5": blob.md5_hash, "crc32c": blob.crc32c}
+                  for blob in (blob_metadata[ds.ciphertext_gcs], blob_metadata[ds.wrapped_dek_gcs])]
+                 for ds in req.datasets]
+    material = {
+        "workload": [FIXED_WORKLOAD_GCS, generation],
+        "params": {
+            "result_base": req.result_base,
+            "executed_notebook_base": req.executed_notebook_base,
+            "columnar_format": COLUMNAR_FORMAT,
+            "engine": req.engine or EXECUTION_ENGINE,
+            "model_archive_format": MODEL_ARCHIVE_FORMAT,
+        },
+        "datasets": [{"owner": ds.owner, "ciphertext_gcs": ds.ciphertext_gcs, "checksums": c}
+                     for ds, c in zip(req.datasets, checksums)],
+    }
+    digest = hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+    return digest, generation
+
+def _result_objects(result: Dict[str, Any]) -> List[str]:
+    paths = [result["executed_notebook_path"], result.get("profile_path")] + list(result["result_paths"])
+    if result.get("model_gcs_path"):
+        paths.append(result["model_gcs_path"])
+    return [p for p in paths if p]
+
+def _object_generation(gs_uri: str) -> Optional[int]:
+    bucket, obj = parse_gs_uri(gs_uri)
+    blob = storage_client.bucket(bucket).get_blob(obj)
+    return blob.generation if blob is not None else None
+
+class ResultMemo:
+    """
+    LRU of completed result sets by run fingerprint. Entries expire after `ttl` seconds, and
+    a hit is only served while every stored object still has the generation it had when the
+    run finished, so results overwritten by a later run of the workflow are never returned.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """ The memoized entry ({"run_id", "result", ...}) for fingerprint, or None. """
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is not None and entry["expires_at"] < time.time():
+                self._entries.pop(fingerprint)
+                entry = None
+        fresh = entry is not None and all(
+            _object_generation(path) == generation for path, generation in entry["generations"].items()
+        )
+        with self._lock:
+            if not fresh:
+                if entry is not None and self._entries.get(fingerprint) is entry:
+                    self._entries.pop(fingerprint)
+                self.misses += 1
+                return None
+            if fingerprint in self._entries:
+                self._entries.move_to_end(fingerprint)
+            self.hits += 1
+            return entry
+
+    def put(self, fingerprint: str, run_id: str, result: Dict[str, Any]):
+        generations = {path: _object_generation(path) for path in _result_objects(result)}
+        if None in generations.values():
+            return   # something was already removed; nothing safe to memoize
+        now = time.time()
+        with self._lock:
+            self._entries[fingerprint] = {"run_id": run_id, "result": result, "generations": generations,
+                                          "created_at": now, "expires_at": now + self.ttl}
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+RESULT_MEMO = ResultMemo(RESULT_MEMO_SIZE, RESULT_MEMO_TTL_SECONDS) if RESULT_MEMO_SIZE > 0 else None
+
+# ---------- Run queue ----------
+# /execute only enqueues a run and returns its id; callers follow it through
+# /runs/{run_id} (optionally long-polling) or get the final record POSTed to callback_url.
+RUN_TERMINAL_STATES = ("DONE", "FAILED")
+RUNS: Dict[str, Dict[str, Any]] = {}
+RUN_WAITERS: Dict[str, list] = defaultdict(list)   # run_id -> [(event loop, asyncio.Event)] of pending long-polls
+RUN_LOCK = threading.Lock()
+_run_pool = ThreadPoolExecutor(max_workers=MAX_PARALLEL_RUNS, thread_name_prefix="run")
+
+# Notebooks execute in separate worker processes (own cwd, own papermill/kernel state).
+# spawn keeps the workers free of the executor's threads, locks and key material.
+# Every run slot has its own single-worker pool and log pipe, so a worker killed for
+# memory only breaks the run it was executing.
+PM_OUTPUT_DONE: Dict[str, threading.Event] = {}   # run_id -> set once the worker has closed its stdout
+
+def _forward_notebook_output(log_reader):
+    """
+    Drains a slot's log pipe into the log store. Blocks on the pipe, so lines land as soon
+    as the kernel prints them; exits at end of stream, once the worker is gone and the slot
+    has closed its copy of the write end (a message cut short by a killed worker also ends it).
+    """
+    while True:
+        try:
+            item = log_reader.recv()
+        except (EOFError, OSError):
+            log_reader.close()
+            return
+        run_id, workflow_id, line = item
+        if line is None:
+            done = PM_OUTPUT_DONE.get(run_id)
+            if done:
+                done.set()
+            continue
+        append_log(workflow_id, f"[pm] {line.rstrip()}")
+
+def _reap_worker_processes(worker_pid: int):
+    """
+    Kills the pooled kernels and script subprocesses a dead worker left behind. They run in
+    their own sessions, so they are found by the worker pid notebook_runner puts in their env.
+    """
+    for proc in psutil.process_iter():
+        try:
+            if proc.environ().get(notebook_runner.WORKER_PID_ENV) == str(worker_pid):
+                proc.kill()
+        except psutil.Error:
+            pass
+
+class NotebookSlot:
+    """ One run slot: a single-worker spawn pool plus the log pipe its worker writes to. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pool = None
+        self._log_writer = None
+        self._worker_pid = None
+        self._start()
+
+    def _start(self):
+        ctx = multiprocessing.get_context("spawn")
+        log_reader, self._log_writer = ctx.Pipe(duplex=False)
+        threading.Thread(target=_forward_notebook_output, args=(log_reader,), daemon=True).start()
+        self.pool = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=ctx,
+            initializer=notebook_runner.init_worker,
+            initargs=(KERNEL_POOL_SIZE, "python3", KERNEL_WARM_IMPORTS, KERNEL_MAX_USES, KERNEL_MAX_AGE_SECONDS,
+                      self._log_writer),
+        )
+        self._worker_pid = None
+
+    def warm_up(self):
+        # Start the worker (and its warm kernels) now rather than on the first run
+        future = self.pool.submit(notebook_runner.warm_up)
+        future.add_done_callback(self._record_worker_pid)
+
+    def _record_worker_pid(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self._worker_pid = future.result()
+
+    def submit(self, *task):
+        with self._lock:
+            return self.pool, self.pool.submit(*task)
+
+    def reset(self, broken_pool: ProcessPoolExecutor):
+        """ Replaces broken_pool, unless the slot has already moved on to a newer pool. """
+        with self._lock:
+            if self.pool is not broken_pool:
+                return
+            broken_pool.shutdown(wait=False, cancel_futures=True)
+            if self._worker_pid is not None:
+                _reap_worker_processes(self._worker_pid)
+            # Retire the pipe with the pool rather than writing to it: a killed worker may have
+            # died mid-message. Closing our write end lets its forwarder reach end of stream.
+            self._log_writer.close()
+            self._start()
+            self.warm_up()
+
+    def shutdown(self):
+        with self._lock:
+            # Waiting lets the worker exit normally and shut down its pooled kernels
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self._log_writer.close()
+
+_notebook_slots = None
+
+@app.on_event("startup")
+def _spawn_notebook_workers():
+    global _notebook_slots
+    _notebook_slots = queue.Queue()
+    for _ in range(MAX_PARALLEL_RUNS):
+        slot = NotebookSlot()
+        slot.warm_up()
+        _notebook_slots.put(slot)
+
+@app.on_event("shutdown")
+def _stop_notebook_workers():
+    while _notebook_slots is not None and not _notebook_slots.empty():
+        _notebook_slots.get_nowait().shutdown()
+
+def execute_notebook_isolated(run_id: str, workflow_id: str, prepared_nb_path: str,
+                              executed_nb_path: str, workdir: str, engine: str = "papermill") -> Dict[str, Any]:
+    """
+    Runs the notebook in a free slot's worker process and waits for it; a crashed worker
+    resets only that slot. Kernel output is streamed into the workflow log while it runs, and
+    is fully forwarded before this returns. Returns the worker's kernel-acquire / execution
+    timings. With engine="script", executed_nb_path receives a JSON execution record instead.
+    """
+    done = PM_OUTPUT_DONE[run_id] = threading.Event()
+    if engine == "script":
+        task = (notebook_runner.run_script, prepared_nb_path, executed_nb_path, workdir, run_id, workflow_id,
+                SCRIPT_MEMORY_LIMIT_BYTES)
+    else:
+        task = (notebook_runner.run_notebook, prepared_nb_path, executed_nb_path, workdir, run_id, workflow_id)
+    # One slot per run thread (_run_pool has MAX_PARALLEL_RUNS threads), so this never waits long
+    slot = _notebook_slots.get()
+    try:
+        pool, future = slot.submit(*task)
+        try:
+            timings = future.result()
+        except BrokenProcessPool:
+            slot.reset(pool)
+            raise RuntimeError("Notebook worker process died (out of memory or killed)")
+        # The worker closed its stdout before returning; wait for the forwarder to catch up
+        done.wait(timeout=10)
+        return timings
+    finally:
+        _notebook_slots.put(slot)
+        PM_OUTPUT_DONE.pop(run_id, None)
+
+def set_run_status(run_id: str, status: str, **fields) -> Dict[str, Any]:
+    with RUN_LOCK:
+        run = RUNS[run_id]
+        run.update(fields, status=status, updated_at=time.time())
+        snapshot = dict(run)
+        waiters = RUN_WAITERS.pop(run_id, []) if status in RUN_TERMINAL_STATES else []
+    for loop, event in waiters:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            pass  # the waiting request's loop is gone
+    return snapshot
+
+def _prune_runs():
+    cutoff = time.time() - RUN_RETENTION_SECONDS
+    with RUN_LOCK:
+        for run_id in [r for r, run in RUNS.items() if run["status"] in RUN_TERMINAL_STATES and run["updated_at"] < cutoff]:
+            RUNS.pop(run_id, None)
+            RUN_WAITERS.pop(run_id, None)
+
+def _notify_callback(callback_url: str, run: Dict[str, Any], attempts: int = 3):
+    for attempt in range(attempts):
+        try:
+            requests.post(callback_url, json=run, timeout=10).raise_for_status()
+            return
+        except Exception as e:
+            log.warning(f"Run callback to {callback_url.split('?')[0]} failed (attempt {attempt + 1}): {e}")
+            time.sleep(2 ** attempt)
+
+# ---------- Admission control ----------
+class AdmissionController:
+    """
+    Starts runs only while their estimated memory footprints fit the budget and a run slot
+    is free. Waiting runs are queued FIFO, or highest priority first (FIFO among equals);
+    only the head of the queue may start, so a large run is never starved by smaller ones.
+    A full queue is refused so callers back off instead of piling up work.
+    """
+
+    def __init__(self, memory_budget: int, slots: int, max_queued: int, by_priority: bool):
+        self.memory_budget = memory_budget
+        self.slots = slots
+        self.max_queued = max_queued
+        self.by_priority = by_priority
+        self._queue = []   # heap of (sort key, seq, footprint, start callable)
+        self._seq = itertools.count()
+        self._running = 0
+        self._memory_reserved = 0
+        self._avg_run_seconds = 60.0   # moving average, used for Retry-After
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> int:
+        """ Seconds until a queue slot is likely to free up. """
+        return int(min(600, max(5, self._avg_run_seconds * (len(self._queue) + 1) / max(1, self.slots))))
+
+    def submit(self, footprint: int, priority: int, start):
+        """ Queues start(); raises 413 if the run can never fit and 429 if the queue is full. """
+        if footprint > self.memory_budget:
+            RUNS_REJECTED_TOTAL.labels("too_large").inc()
+            raise HTTPException(status_code=413, detail=f"Run needs ~{footprint} bytes of memory, "
+                                                        f"more than the executor's budget of {self.memory_budget}")
+        with self._lock:
+            if len(self._queue) >= self.max_queued:
+                RUNS_REJECTED_TOTAL.labels("queue_full").inc()
+                raise HTTPException(status_code=429, detail="Executor is at capacity, retry later",
+                                    headers={"Retry-After": str(self.retry_after())})
+            heapq.heappush(self._queue, (-priority if self.by_priority else 0, next(self._seq), footprint, start))
+            ADMISSION_QUEUED.set(len(self._queue))
+        self._dispatch()
+
+    def finished(self, footprint: int, seconds: float):
+        with self._lock:
+            self._running -= 1
+            self._memory_reserved -= footprint
+            self._avg_run_seconds = 0.8 * self._avg_run_seconds + 0.2 * seconds
+        self._dispatch()
+
+    def _dispatch(self):
+        ready = []
+        with self._lock:
+            while self._queue and self._running < self.slots \
+                    and self._memory_reserved + self._queue[0][2] <= self.memory_budget:
+                _, _, footprint, start = heapq.heappop(self._queue)
+                self._running += 1
+                self._memory_reserved += footprint
+                ready.append(start)
+            ADMISSION_QUEUED.set(len(self._queue))
+            ADMISSION_MEMORY_RESERVED.set(self._memory_reserved)
+        for start in ready:
+            start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"queued": len(self._queue), "running": self._running, "slots": self.slots,
+                    "memory_reserved_bytes": self._memory_reserved, "memory_budget_bytes": self.memory_budget,
+                    "policy": "priority" if self.by_priority else "fifo"}
+
+ADMISSION = AdmissionController(ADMISSION_MEMORY_BUDGET_BYTES, MAX_PARALLEL_RUNS, ADMISSION_MAX_QUEUED,
+                                by_priority=ADMISSION_POLICY == "priority")
+
+def estimate_run_footprint(datasets: List[DatasetSpec], blob_metadata: Optional[Dict[str, Any]] = None) -> int:
+    """ Memory a run is expected to need, from its ciphertext sizes and the workload's multiplier. """
+    blob_metadata = blob_metadata or fetch_dataset_metadata(datasets)
+    ciphertext_bytes = sum(blob_metadata[ds.ciphertext_gcs].size or 0 for ds in datasets)
+    multiplier = WORKLOAD_MEMORY_MULTIPLIERS.get(FIXED_WORKLOAD_GCS, WORKLOAD_MEMORY_MULTIPLIER)
+    return int(RUN_BASE_MEMORY_BYTES + multiplier * ciphertext_bytes)
+
+def _run_worker(run_id: str, req: ExecuteRequest, footprint: int = 0, resume: Optional[Dict[str, Any]] = None,
+                memo_key: Optional[tuple] = None, blob_metadata: Optional[Dict[str, Any]] = None):
+    t0 = time.time()
+    with RUN_LOCK:
+        PHASE_SECONDS.labels("queue_wait").observe(t0 - RUNS[run_id]["submitted_at"])
+    try:
+        result = run_workflow(run_id, req, resume, blob_metadata)
+        run = set_run_status(run_id, "DONE", result=result)
+        if memo_key and memo_key[1] == result["workload_generation"]:
+            try:
+                RESULT_MEMO.put(memo_key[0], run_id, result)
+            except Exception as e:
+                log.warning(f"Failed to memoize results of run {run_id}: {e}")
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        log.exception("Execution failed")
+        append_log(req.workflow_id, f"Execution failed: {detail}")
+        run = set_run_status(run_id, "FAILED", error=detail)
+    RUNS_TOTAL.labels(run["status"]).inc()
+    ADMISSION.finished(footprint, time.time() - t0)
+    if req.callback_url:
+        _notify_callback(req.callback_url, run)
+
+@app.post("/execute", status_code=202)
+async def execute(req: ExecuteRequest = Body(...)):
+    """
+    Main execution API. Queues the run and returns 202 with its run_id right away. Expects:
       - datasets: list of DatasetSpec (each owner may contribute multiple datasets)
       - result_base: gs://bucket/results/<workflow_id>/result
       - executed_notebook_base: gs://bucket/results/<workflow_id>/executed
     NOTE: workload is now fixed (bundled inside the executor).
+    Answers 429 with Retry-After when the admission queue is full.
+    """
+    return await _enqueue_run(req.run_id or str(uuid.uuid4()), req)
+
+class ResumeRequest(BaseModel):
+    run_id: Optional[str] = None          # id for the resumed run (generated if omitted)
+    callback_url: Optional[str] = None
+
+@app.post("/runs/{run_id}/resume", status_code=202)
+async def resume_run(run_id: str, body: ResumeRequest = Body(ResumeRequest())):
+    """
+    Queues a new run that continues failed checkpointed run `run_id` from its last good
+    checkpoint. Datasets are staged again (from the local dataset cache when enabled).
+    """
+    checkpoint = CHECKPOINTS.get(run_id)
+    if checkpoint is None:
+        raise HTTPException(status_code=404, detail=f"No checkpoint for run {run_id}")
+    new_run_id = body.run_id or str(uuid.uuid4())
+    req = ExecuteRequest(**{**dict(checkpoint["request"]), "run_id": new_run_id,
+                            "callback_url": body.callback_url, "checkpoint": True})
+    return await _enqueue_run(new_run_id, req, resume=checkpoint)
+
+async def _enqueue_run(run_id: str, req: ExecuteRequest, resume: Optional[Dict[str, Any]] = None):
+    _prune_runs()
+    if (req.engine or EXECUTION_ENGINE) not in EXECUTION_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Unknown engine {req.engine!r}; expected one of {EXECUTION_ENGINES}")
+    with RUN_LOCK:
+        if run_id in RUNS:
+            raise HTTPException(status_code=409, detail=f"Run {run_id} already exists")
+    memo_key = None
+    # One concurrent metadata fetch serves memoization, admission, the staging reservation and staging
+    blob_metadata = await asyncio.to_thread(fetch_dataset_metadata, req.datasets, bool(RESULT_MEMO and not resume))
+    if RESULT_MEMO and not resume:
+        memo_key = await asyncio.to_thread(run_fingerprint, req, blob_metadata)
+        if not req.force:
+            memoized = await asyncio.to_thread(RESULT_MEMO.get, memo_key[0])
+            RESULT_MEMO_LOOKUPS_TOTAL.labels("hit" if memoized else "miss").inc()
+            if memoized:
+                return _finish_memoized_run(run_id, req, memoized)
+    footprint = estimate_run_footprint(req.datasets, blob_metadata)
+    now = time.time()
+    with RUN_LOCK:
+        if run_id in RUNS:
+            raise HTTPException(status_code=409, detail=f"Run {run_id} already exists")
+        RUNS[run_id] = {
+            "run_id": run_id,
+            "workflow_id": req.workflow_id,
+            "status": "QUEUED",
+            "submitted_at": now,
+            "updated_at": now,
+            "result": None,
+            "error": None,
+        }
+    try:
+        ADMISSION.submit(footprint, req.priority,
+                         lambda: _run_pool.submit(_run_worker, run_id, req, footprint, resume, memo_key, blob_metadata))
+    except HTTPException:
+        with RUN_LOCK:
+            RUNS.pop(run_id, None)
+        raise
+    append_log(req.workflow_id, f"Queued run {run_id} for workflow {req.workflow_id} (estimated footprint {footprint} bytes)")
+    return {"run_id": run_id, "workflow_id": req.workflow_id, "status": "QUEUED"}
+
+def _finish_memoized_run(run_id: str, req: ExecuteRequest, memoized: Dict[str, Any]):
+    """ Records run_id as DONE with a memoized result set, without queueing it. """
+    now = time.time()
+    with RUN_LOCK:
+        if run_id in RUNS:
+            raise HTTPException(status_code=409, detail=f"Run {run_id} already exists")
+        RUNS[run_id] = {"run_id": run_id, "workflow_id": req.workflow_id, "status": "QUEUED",
+                        "submitted_at": now, "updated_at": now, "result": None, "error": None}
+    result = dict(memoized["result"], memoized_from=memoized["run_id"])
+    run = set_run_status(run_id, "DONE", result=result)
+    RUNS_TOTAL.labels("DONE").inc()
+    append_log(req.workflow_id, f"Run {run_id}: inputs unchanged since run {memoized['run_id']}, "
+                                f"returning its results (rerun with force=true to execute again)")
+    if req.callback_url:
+        threading.Thread(target=_notify_callback, args=(req.callback_url, run), daemon=True).start()
+    return {"run_id": run_id, "workflow_id": req.workflow_id, "status": "DONE", "memoized_from": memoized["run_id"]}
+
+@app.get("/admission")
+def get_admission():
+    """ Current admission queue, running runs and reserved memory. """
+    return ADMISSION.stats()
+
+@app.get("/runs/{run_id}")
+async def get_run(run_id: str, wait: float = Query(0, ge=0, le=60, description="Seconds to long-poll for completion")):
+    """ Status of a run: QUEUED/DOWNLOADING/EXECUTING/UPLOADING/DONE/FAILED, plus result_paths once DONE. """
+    waiter = None
+    with RUN_LOCK:
+        run = RUNS.get(run_id)
+        if run is None:
+            raise HTTPException(status_code=404, detail="Run not found")
+        if wait and run["status"] not in RUN_TERMINAL_STATES:
+            waiter = (asyncio.get_running_loop(), asyncio.Event())
+            RUN_WAITERS[run_id].append(waiter)
+    if waiter:
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with RUN_LOCK:
+                _remove_waiter(RUN_WAITERS, run_id, waiter)
+    with RUN_LOCK:
+        return dict(RUNS.get(run_id, run))
+
+def run_workflow(run_id: str, req: ExecuteRequest, resume: Optional[Dict[str, Any]] = None,
+                 blob_metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Executes one queued run end to end and returns its result record. With resume (a
+    CheckpointStore record), execution restarts after that run's last good checkpoint.
+    blob_metadata is the dataset metadata fetched when the run was queued.
     """
     workflow_id = req.workflow_id
+    set_run_status(run_id, "DOWNLOADING")
     log.info(f"Starting execution for workflow {workflow_id}")
     append_log(workflow_id, f"Starting execution for workflow {workflow_id}")
 
@@ -203,102 +1509,105 @@ def execute(req: ExecuteRequest = Body(...)):
     workdir = tempfile.mkdtemp(prefix=f"wf_{workflow_id}_")
     log.info(f"Workdir: {workdir}")
     append_log(workflow_id, f"Workdir: {workdir}")
-
-    # Store the original working directory
-    original_cwd = os.getcwd()
+    staging_dir, staging_reserved = None, 0
+    timings = RunTimings()
+    t_start = time.perf_counter()
 
     try:
-        # Change the working directory so the notebook can find the files
-        os.chdir(workdir)
-
-        # 2) download fixed workload from GCS into workdir
-        fixed_workload_gcs = "gs://yellowsense-technologies-cleanroom/workloads/fraud-detector.ipynb"
-        bucket, obj = parse_gs_uri(fixed_workload_gcs)
-        workload_local = os.path.join(workdir, "fraud-detector.ipynb")
-        storage_client.bucket(bucket).blob(obj).download_to_filename(workload_local)
-
-        log.info(f"Downloaded fixed workload to {workload_local}")
-        append_log(workflow_id, f"Downloaded fixed workload to {workload_local}")
-        
-        # 3) decrypt all datasets
-        plaintext_paths = {}
-        for ds in req.datasets:
-            owner = ds.owner
-            log.info(f"Processing dataset for owner={owner}")
-            append_log(workflow_id, f"Processing dataset for owner={owner}")
-            wrapped_dek_bytes = download_blob_bytes(ds.wrapped_dek_gcs)
-            ciphertext_bytes = download_blob_bytes(ds.ciphertext_gcs)
-
-            # unwrap DEK
-            dek = _priv_key.decrypt(
-                wrapped_dek_bytes,
-                padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
-            )
-
-            # AES-GCM decrypt
-            nonce, ct = ciphertext_bytes[:12], ciphertext_bytes[12:]
-            aesgcm = AESGCM(dek)
-            plaintext = aesgcm.decrypt(nonce, ct, None)
-
-            # get original filename from GCS object path
-            _, obj_path = parse_gs_uri(ds.ciphertext_gcs)
-            filename = os.path.basename(obj_path)  # preserve "my_data.csv"
-
-            # write plaintext directly into workdir (same folder as workload)
-            # The files are now saved in the new CWD
-            local_path = filename
-            with open(local_path, "wb") as f:
-                f.write(plaintext)
-
-            # store paths grouped by owner
-            plaintext_paths.setdefault(owner, []).append(local_path)
-            log.info(f"Wrote plaintext dataset for {owner} to {local_path}")
-
-        # 4) inject parameters & result uploader
-        # Note: The paths injected are now relative to the workdir, which is the CWD.
+        # 2) fetch fixed workload (revalidated against GCS, parsed and prepared once per generation)
+        with timings.phase("workload_fetch"):
+            workload_nb, generation = get_prepared_workload(FIXED_WORKLOAD_GCS)
+        log.info(f"Using workload {FIXED_WORKLOAD_GCS}#{generation}")
+        append_log(workflow_id, f"Using workload {FIXED_WORKLOAD_GCS} (generation {generation})")
+        if resume and resume["generation"] != generation:
+            raise HTTPException(status_code=409, detail="Workload changed since the checkpoint was taken; rerun from scratch")
+
+        # 3) fetch, unwrap and decrypt all datasets concurrently (into tmpfs when it fits)
+        with timings.phase("staging_reservation"):
+            staging_dir, staging_reserved = reserve_plaintext_staging(workflow_id, req.datasets, blob_metadata)
+        with timings.phase("dataset_staging"):
+            plaintext_paths, columnar = stage_datasets(workflow_id, req.datasets, workdir, staging_dir, timings,
+                                                       blob_metadata)
+
+        # 4) inject parameters (the result uploader is already part of the cached workload)
+        # Note: The paths injected are relative to the workdir, which is the notebook's CWD.
         prepared_nb_path = os.path.join(workdir, "prepared_workload.ipynb")
-        inject_params_and_result_uploader(
-            input_nb=workload_local,
-            output_nb=prepared_nb_path,
-            dataset_local_paths=plaintext_paths,
-            result_base=req.result_base
-        )
+        with timings.phase("notebook_prepare"):
+            checkpoints_dir = None
+            if req.checkpoint or resume:
+                # Snapshots hold plaintext-derived state: keep them next to the staged datasets
+                checkpoints_dir = os.path.join(staging_dir or workdir, "checkpoints")
+                os.makedirs(checkpoints_dir)
+                if staging_dir:
+                    os.symlink(checkpoints_dir, os.path.join(workdir, "checkpoints"))
+                if resume:
+                    CHECKPOINTS.restore(resume["run_id"], os.path.join(checkpoints_dir, "restore.pkl"))
+                    append_log(workflow_id, f"Resuming run {resume['run_id']} after workload cell {resume['cell_index']}")
+            inject_params(
+                workload_nb=workload_nb,
+                output_nb=prepared_nb_path,
+                dataset_local_paths=plaintext_paths,
+                result_base=req.result_base,
+                columnar=columnar,
+                checkpoint=checkpoints_dir is not None,
+                resume_after=resume["cell_index"] if resume else None,
+            )
         log.info("Prepared notebook with injected parameters + uploader")
 
-        # 5) execute notebook with papermill (kernel_name=None runs in-process)
-        executed_nb_local = "executed.ipynb" # path is relative now
-        stdout_log = "pm_output.log" # path is relative now
-        
-        # Ensure the log file exists before tailing
-        open(stdout_log, "w").close()
-
-        # Start background thread to stream logs
-        threading.Thread(
-            target=tail_pm_logs,
-            args=(stdout_log, workflow_id),
-            daemon=True
-        ).start()
-
-        log.info("Executing notebook (this runs inside the TEE process)")
-
-        # Open log file handle and stream papermill output into it
-        with open(stdout_log, "w", buffering=1, encoding="utf-8") as stdout_f:
-            pm.execute_notebook(
-                input_path=prepared_nb_path,
-                output_path=executed_nb_local,
-                kernel_name="python3",
-                stdout_file=stdout_f,  # file handle instead of string path
+        # 5) execute notebook with papermill (or the script engine) in an isolated worker process
+        engine = req.engine or EXECUTION_ENGINE
+        executed_ext = ".json" if engine == "script" else ".ipynb"   # script runs produce an execution record
+        executed_nb_local = os.path.join(workdir, "executed" + executed_ext)
+
+        log.info(f"Executing notebook with the {engine} engine (this runs inside the TEE, in a dedicated worker process)")
+        set_run_status(run_id, "EXECUTING")
+        try:
+            worker_timings = execute_notebook_isolated(run_id, workflow_id, prepared_nb_path, executed_nb_local,
+                                                       workdir, engine)
+        except Exception:
+            if checkpoints_dir:
+                cell_index = CHECKPOINTS.save(run_id, req, generation, checkpoints_dir)
+                if cell_index is not None:
+                    append_log(workflow_id, f"Saved checkpoint after workload cell {cell_index}; "
+                                            f"resume with POST /runs/{run_id}/resume")
+            raise
+        timings.record("notebook_execution", worker_timings["execution_seconds"])
+        if engine == "script":
+            timings.record("notebook_compile", worker_timings["compile_seconds"])
+            append_log(
+                workflow_id,
+                f"Compiled in {worker_timings['compile_seconds']:.2f}s, executed in {worker_timings['execution_seconds']:.2f}s (script engine)"
             )
-        
+        else:
+            timings.record("kernel_acquire", worker_timings["kernel_acquire_seconds"])
+            append_log(
+                workflow_id,
+                f"Kernel acquired in {worker_timings['kernel_acquire_seconds']:.2f}s "
+                f"({'warm' if worker_timings['kernel_warm'] else 'cold'}), executed in {worker_timings['execution_seconds']:.2f}s"
+            )
+
         log.info("Notebook executed")
         append_log(workflow_id, "Notebook executed")
 
         # 6) upload executed notebook
-        executed_target = req.executed_notebook_base + ".ipynb"
-        upload_blob_from_file(executed_target, executed_nb_local)
+        set_run_status(run_id, "UPLOADING")
+        executed_target = req.executed_notebook_base + executed_ext
+        with timings.phase("executed_notebook_upload"):
+            upload_blob_from_file(executed_target, executed_nb_local)
         log.info(f"Uploaded executed notebook to {executed_target}")
 
-        # 7) locate result.* file
+        # Per-cell profile (papermill cell timings + sampled kernel memory) next to the notebook
+        profile = worker_timings["profile"]
+        profile_target = req.executed_notebook_base + "_profile.json"
+        profile_local = os.path.join(workdir, "profile.json")
+        with open(profile_local, "w", encoding="utf-8") as f:
+            json.dump(profile, f)
+        upload_blob_from_file(profile_target, profile_local)
+        if profile["slowest_cells"]:
+            slowest = next(c for c in profile["cells"] if c["index"] == profile["slowest_cells"][0])
+            append_log(workflow_id, f"Slowest cell: #{slowest['index']} ({slowest['duration']:.2f}s) {slowest['first_line']}")
+
+        # 7) read the uploader's manifest instead of listing the result prefix
         # candidates = list_result_blob_under_prefix(req.result_base)
         # if not candidates:
         #     raise HTTPException(status_code=500, detail="No result file found in results prefix after execution")
@@ -321,44 +1630,284 @@ def execute(req: ExecuteRequest = Body(...)):
         #     "format": ext
         # }
 
-        candidates = list_result_blob_under_prefix(req.result_base)
-        if not candidates:
+        t_discovery = time.perf_counter()
+        manifest = read_result_manifest(workdir, req.result_base)
+        if manifest is None:
+            # Workload ran without the uploader's manifest; fall back to listing the prefix
+            candidates = list_result_blob_under_prefix(req.result_base)
+            manifest = {
+                "result_base": req.result_base,
+                "files": [{"path": f"gs://{blob.bucket.name}/{blob.name}", "size": blob.size,
+                           "content_type": blob.content_type, "sha256": None, "crc32c": blob.crc32c}
+                          for blob in candidates],
+                "model": None,
+            }
+        timings.record("result_discovery", time.perf_counter() - t_discovery)
+        if not manifest["files"]:
             append_log(workflow_id, "Execution finished, but no result files were found in the 'results/' output directory.")
             raise HTTPException(status_code=500, detail="Notebook executed, but no result files were uploaded.")
 
-        # Create a list of all found GCS paths
-        result_gcs_paths = [f"gs://{blob.bucket.name}/{blob.name}" for blob in candidates]
+        # Create a list of all uploaded GCS paths
+        result_gcs_paths = [entry["path"] for entry in manifest["files"]]
         log.info(f"Found {len(result_gcs_paths)} result file(s): {result_gcs_paths}")
         append_log(workflow_id, f"Found {len(result_gcs_paths)} result file(s).")
 
         return {
             "status": "success",
             "workflow_id": workflow_id,
+            "workload_generation": generation,
+            "engine": engine,
             "executed_notebook_path": executed_target,
-            "result_paths": result_gcs_paths  # <-- Key is now plural: "result_paths"
+            "result_paths": result_gcs_paths,  # <-- Key is now plural: "result_paths"
+            "model_gcs_path": manifest["model"]["path"] if manifest["model"] else None,
+            "result_manifest": manifest,
+            "kernel_acquire_seconds": worker_timings["kernel_acquire_seconds"],
+            "execution_seconds": worker_timings["execution_seconds"],
+            "timings": timings.as_dict(),
+            "profile_path": profile_target,
+            "profile": profile,
         }
 
-    except Exception as e:
-        log.exception("Execution failed")
-        raise HTTPException(status_code=500, detail=str(e))
+    except Exception:
+        # A failed resume stays resumable from the last good snapshot until it writes a newer one
+        if resume and CHECKPOINTS.get(run_id) is None:
+            cell_index = CHECKPOINTS.carry_over(resume["run_id"], run_id, req)
+            if cell_index is not None:
+                append_log(workflow_id, f"Kept checkpoint after workload cell {cell_index}; "
+                                        f"resume with POST /runs/{run_id}/resume")
+        raise
     finally:
+        release_plaintext_staging(staging_dir, staging_reserved)
+        shutil.rmtree(workdir, ignore_errors=True)
+        timings.record("run_total", time.perf_counter() - t_start)
+
+# ---------- Checkpoints ----------
+# In checkpoint mode a snapshot cell follows every workload cell tagged CHECKPOINT_TAG. It
+# pickles the kernel's user variables (or the cell's "checkpoint_vars" metadata list) into
+# checkpoints/<workload cell index>.pkl. When such a run fails, the newest snapshot is
+# encrypted into CHECKPOINT_DIR under a key that only lives in this process; a resumed run
+# restores it and executes only the cells after that checkpoint.
+_CHECKPOINT_SAVE_TEMPLATE = """
+# Checkpoint injected by executor (DO NOT MODIFY)
+def _ccr_checkpoint(index, names):
+    import os, types
+    try:
+        import cloudpickle as pickler
+    except ImportError:
+        import pickle as pickler
+    g = globals()
+    skip = {{"In", "Out", "get_ipython", "exit", "quit"}}
+    names = names or [n for n in list(g) if not n.startswith("_") and n not in skip]
+    state, modules = {{}}, {{}}
+    for name in names:
+        value = g.get(name)
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
         try:
-            # Change back to the original working directory
-            os.chdir(original_cwd)
-            for root, _, files in os.walk(workdir):
-                for name in files:
-                    os.remove(os.path.join(root, name))
-            os.rmdir(workdir)
-        except Exception:
-            pass
-
-def inject_params_and_result_uploader(input_nb: str, output_nb: str,
-                                      dataset_local_paths: List[str], result_base: str):
+            state[name] = pickler.dumps(value)
+        except Exception as e:
+            print(f"Checkpoint {{index}}: skipping {{name}} ({{type(e).__name__}})")
+    tmp = os.path.join("checkpoints", f"{{index}}.pkl.tmp")
+    with open(tmp, "wb") as f:
+        pickler.dump({{"modules": modules, "state": state}}, f)
+    os.replace(tmp, os.path.join("checkpoints", f"{{index}}.pkl"))
+_ccr_checkpoint({index}, {names!r})
+del _ccr_checkpoint
+"""
+
+_CHECKPOINT_RESTORE_SOURCE = """
+# Checkpoint restore injected by executor (DO NOT MODIFY)
+def _ccr_restore():
+    import importlib, pickle
+    with open("checkpoints/restore.pkl", "rb") as f:
+        snapshot = pickle.load(f)
+    for name, module in snapshot["modules"].items():
+        globals()[name] = importlib.import_module(module)
+    for name, blob in snapshot["state"].items():
+        try:
+            globals()[name] = pickle.loads(blob)
+        except Exception as e:
+            print(f"Restore: could not load {name} ({type(e).__name__})")
+_ccr_restore()
+del _ccr_restore
+"""
+
+def apply_checkpointing(nb, resume_after: Optional[int] = None):
+    """
+    Adds snapshot cells after the workload's checkpoint cells. With resume_after, drops the
+    workload cells up to and including that index and restores its snapshot instead.
+    The last cell (the result uploader) is kept as is.
+    """
+    workload_cells, uploader = nb.cells[:-1], nb.cells[-1]
+    cells = []
+    if resume_after is not None:
+        cells.append(nbformat.v4.new_code_cell(source=_CHECKPOINT_RESTORE_SOURCE))
+    for index, cell in enumerate(workload_cells):
+        if resume_after is not None and index <= resume_after:
+            continue
+        cells.append(cell)
+        if cell.cell_type == "code" and CHECKPOINT_TAG in cell.metadata.get("tags", []):
+            names = list(cell.metadata.get("checkpoint_vars", [])) or None
+            cells.append(nbformat.v4.new_code_cell(source=_CHECKPOINT_SAVE_TEMPLATE.format(index=index, names=names)))
+    nb.cells = cells + [uploader]
+    return nb
+
+class CheckpointStore:
+    """ Encrypted snapshots of failed checkpointed runs, with the request needed to resume them. """
+
+    def __init__(self, directory: str, retention: float):
+        self.directory = directory
+        self.retention = retention
+        self._key = AESGCM.generate_key(bit_length=256)
+        self._records: Dict[str, Dict[str, Any]] = {}   # run_id -> record
+        self._lock = threading.Lock()
+        shutil.rmtree(directory, ignore_errors=True)   # unreadable without the previous process's key
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, run_id: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(run_id.encode("utf-8")).hexdigest())
+
+    def save(self, run_id: str, req: "ExecuteRequest", generation: int, checkpoints_dir: str) -> Optional[int]:
+        """ Encrypts the newest snapshot in checkpoints_dir; returns its cell index, or None if there is none. """
+        indexes = [int(name[:-4]) for name in os.listdir(checkpoints_dir)
+                   if name.endswith(".pkl") and name[:-4].isdigit()] if os.path.isdir(checkpoints_dir) else []
+        if not indexes:
+            return None
+        cell_index = max(indexes)
+        path = self._path(run_id)
+        with open(os.path.join(checkpoints_dir, f"{cell_index}.pkl"), "rb") as src, open(path, "wb") as dst:
+            writer = SegmentedWriter(dst, self._key)
+            for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                writer.write(chunk)
+            writer.close()
+        with self._lock:
+            self._records[run_id] = {"request": req, "generation": generation, "cell_index": cell_index,
+                                     "created_at": time.time()}
+        self.prune()
+        return cell_index
+
+    def carry_over(self, from_run_id: str, run_id: str, req: "ExecuteRequest") -> Optional[int]:
+        """
+        Makes from_run_id's snapshot the checkpoint of run_id too, for a resumed run that failed
+        before writing a newer one; returns its cell index, or None if it has expired.
+        """
+        with self._lock:
+            record = self._records.get(from_run_id)
+        if record is None:
+            return None
+        try:
+            shutil.copyfile(self._path(from_run_id), self._path(run_id))
+        except OSError:
+            return None
+        with self._lock:
+            self._records[run_id] = dict(record, request=req, created_at=time.time())
+        return record["cell_index"]
+
+    def get(self, run_id: str) -> Optional[Dict[str, Any]]:
+        self.prune()
+        with self._lock:
+            record = self._records.get(run_id)
+            return dict(record, run_id=run_id) if record else None
+
+    def restore(self, run_id: str, dst_path: str):
+        with open(self._path(run_id), "rb") as src:
+            decrypt_dataset_stream(src, self._key, dst_path)
+
+    def prune(self):
+        cutoff = time.time() - self.retention
+        with self._lock:
+            expired = [r for r, rec in self._records.items() if rec["created_at"] < cutoff]
+            for run_id in expired:
+                self._records.pop(run_id)
+        for run_id in expired:
+            try:
+                os.remove(self._path(run_id))
+            except OSError:
+                pass
+
+CHECKPOINTS = CheckpointStore(CHECKPOINT_DIR, CHECKPOINT_RETENTION_SECONDS)
+
+# ---------- Workload cache ----------
+# Prepared workloads (parsed, validated, uploader cell appended) are kept in memory and on
+# disk per GCS object generation and version of the injected cells. Each run only does a
+# metadata call to revalidate.
+_workload_cache: Dict[str, Any] = {}   # gs uri -> (generation, prepared NotebookNode)
+_workload_cache_lock = threading.Lock()
+_injected_cells_digest = None
+
+def _workload_cache_prefix(gs_uri: str) -> str:
+    return hashlib.sha256(gs_uri.encode("utf-8")).hexdigest()[:16] + "-"
+
+def _injected_cells_version() -> str:
     """
-    Reads input notebook, injects a parameters cell and a result uploader cell.
-    Ensures a `model/` folder is created for trained models.
+    Digest of the cells add_result_uploader appends (their code and the settings baked into
+    them), so notebooks prepared by an older executor are never served from the disk cache.
     """
-    nb = nbformat.read(input_nb, as_version=4)
+    global _injected_cells_digest
+    if _injected_cells_digest is None:
+        nb = nbformat.v4.new_notebook()
+        add_result_uploader(nb)
+        sources = "\0".join(cell.source for cell in nb.cells)
+        _injected_cells_digest = hashlib.sha256(sources.encode("utf-8")).hexdigest()[:16]
+    return _injected_cells_digest
+
+def get_prepared_workload(gs_uri: str):
+    """
+    Returns (notebook, generation) for the current version of the workload at gs_uri,
+    with the result uploader cell appended. Callers must not mutate the notebook.
+    """
+    bucket, obj = parse_gs_uri(gs_uri)
+    blob = storage_client.bucket(bucket).get_blob(obj)  # metadata only
+    if blob is None:
+        raise HTTPException(status_code=404, detail=f"Workload {gs_uri} not found")
+    generation = blob.generation
+
+    with _workload_cache_lock:
+        cached = _workload_cache.get(gs_uri)
+        if cached and cached[0] == generation:
+            return cached[1], generation
+
+        path = os.path.join(WORKLOAD_CACHE_DIR,
+                            f"{_workload_cache_prefix(gs_uri)}{generation}-{_injected_cells_version()}.ipynb")
+        if os.path.exists(path):
+            nb = nbformat.read(path, as_version=4)
+        else:
+            os.makedirs(WORKLOAD_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                # Pin the generation we validated so a concurrent overwrite cannot slip in
+                blob.download_to_filename(tmp_path, if_generation_match=generation)
+                nb = nbformat.read(tmp_path, as_version=4)
+                nbformat.validate(nb)
+                add_result_uploader(nb)
+                nbformat.write(nb, tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            # Drop older generations of the same workload
+            for name in os.listdir(WORKLOAD_CACHE_DIR):
+                if name.startswith(_workload_cache_prefix(gs_uri)) and name != os.path.basename(path):
+                    os.remove(os.path.join(WORKLOAD_CACHE_DIR, name))
+            log.info(f"Cached workload {gs_uri}#{generation} at {path}")
+
+        _workload_cache[gs_uri] = (generation, nb)
+        return nb, generation
+
+def inject_params(workload_nb, output_nb: str, dataset_local_paths: List[str], result_base: str,
+                  columnar: Optional[Dict[str, Any]] = None, checkpoint: bool = False,
+                  resume_after: Optional[int] = None):
+    """
+    Writes a copy of the prepared workload with a parameters cell injected at the top.
+    Ensures a `model/` folder is created for trained models. Columnar copies, if any, are
+    passed as client_columnar_paths / client_columnar_schemas keyed by the CSV's name.
+    With checkpoint, snapshot cells are added (see apply_checkpointing).
+    """
+    columnar = columnar or {}
+    nb = copy.deepcopy(workload_nb)
+    if checkpoint:
+        apply_checkpointing(nb, resume_after)
 
     # Parameters cell
     dataset_list_py = "[" + ", ".join([f'r"{p}"' for p in dataset_local_paths]) + "]"
@@ -368,6 +1917,15 @@ result_base = r"{result_base}"
 
 SA_KEY_PATH = f"{SA_KEY_PATH}"
 
+# Memory-mappable columnar copies of the CSVs ({COLUMNAR_FORMAT or "disabled"}), keyed by CSV name
+client_columnar_paths = {({name: c["path"] for name, c in columnar.items()})!r}
+client_columnar_schemas = {({name: c["schema"] for name, c in columnar.items()})!r}
+
+# Result uploader settings
+result_upload_concurrency = {RESULT_UPLOAD_CONCURRENCY}
+model_archive_format = "{MODEL_ARCHIVE_FORMAT}"
+model_archive_compresslevel = {MODEL_ARCHIVE_COMPRESSION_LEVEL}
+
 # Ensure a model directory exists for saving artifacts
 import os
 os.makedirs("results", exist_ok=True)
@@ -377,10 +1935,35 @@ os.makedirs("model", exist_ok=True)
     params_cell.metadata["tags"] = ["parameters"]
     nb.cells.insert(0, params_cell)
 
-    # Uploader cell
+    with open(output_nb, "w", encoding="utf-8") as f:
+        nbformat.write(nb, f)
+
+RESULT_MANIFEST_NAME = "result_manifest.json"   # written into the workdir by the uploader cell
+
+def read_result_manifest(workdir: str, result_base: str) -> Optional[Dict[str, Any]]:
+    """
+    Loads the manifest written by the result uploader cell, or None if the run produced none.
+    Entries outside result_base are dropped so the notebook cannot point results elsewhere.
+    """
+    path = os.path.join(workdir, RESULT_MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    prefix = result_base.rstrip("/") + "/"
+    model = manifest.get("model")
+    return {
+        "result_base": result_base,
+        "files": [entry for entry in manifest.get("files", []) if entry.get("path", "").startswith(prefix)],
+        "model": model if model and model.get("path", "").startswith(result_base + "_model.") else None,
+    }
+
+def add_result_uploader(nb):
+    """ Appends the result uploader cell; it reads result_base / SA_KEY_PATH from the parameters cell. """
     uploader_source = r'''
 # Dynamic result uploader injected by executor (DO NOT MODIFY)
-import os, shutil
+import os, json, hashlib, mimetypes, zipfile, tarfile, gzip
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
 from google.oauth2 import service_account
 
@@ -396,45 +1979,140 @@ bucket_name, blob_path = result_base[5:].split("/", 1)
 bucket = storage_client.bucket(bucket_name)
 
 # ---- Upload everything inside results/ ----
+# Every upload is recorded in a manifest the executor reads locally, so it never has to
+# list the bucket to discover what was produced.
+def _describe(local_path, gcs_target, blob):
+    digest = hashlib.sha256()
+    with open(local_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return {
+        "path": gcs_target,
+        "size": os.path.getsize(local_path),
+        "content_type": blob.content_type,
+        "sha256": digest.hexdigest(),
+        "crc32c": blob.crc32c,
+    }
+
+def _upload_result(local_path):
+    rel_path = os.path.relpath(local_path, results_dir)
+    gcs_target = result_base.rstrip("/") + "/" + rel_path.replace("\\", "/")
+    blob = bucket.blob(gcs_target[5 + len(bucket_name) + 1:])
+    blob.upload_from_filename(local_path, content_type=mimetypes.guess_type(local_path)[0] or "application/octet-stream")
+    return _describe(local_path, gcs_target, blob)
+
+manifest = {"result_base": result_base, "files": [], "model": None}
+
 results_dir = "results"
 if os.path.isdir(results_dir):
-    uploaded_files = []
-    for root, _, files in os.walk(results_dir):
-        for fname in files:
-            local_path = os.path.join(root, fname)
-            rel_path = os.path.relpath(local_path, results_dir)
-            gcs_target = result_base.rstrip("/") + "/" + rel_path.replace("\\", "/")
-            bucket.blob(gcs_target[5 + len(bucket_name) + 1:]).upload_from_filename(local_path)
-            uploaded_files.append(gcs_target)
-            print(f"Uploaded {local_path} → {gcs_target}")
-    if not uploaded_files:
+    local_files = [os.path.join(root, fname) for root, _, files in os.walk(results_dir) for fname in files]
+    with ThreadPoolExecutor(max_workers=max(1, result_upload_concurrency)) as pool:
+        manifest["files"] = list(pool.map(_upload_result, local_files))
+    for local_path, entry in zip(local_files, manifest["files"]):
+        print(f"Uploaded {local_path} → {entry['path']}")
+    if not manifest["files"]:
         print("No files found inside results/ directory.")
 else:
     print("No results/ directory found; skipping upload.")
 
-# ---- Upload trained model as zip ----
+# ---- Stream trained model archive straight to GCS ----
+class _HashingWriter:
+    """ Passes archive bytes through to the upload stream, hashing and counting them. """
+    def __init__(self, dst):
+        self.dst, self.sha256, self.size = dst, hashlib.sha256(), 0
+    def write(self, data):
+        self.dst.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+    def flush(self):
+        pass
+
+def _write_archive(out, root_dir):
+    files = sorted(os.path.join(root, fname) for root, _, names in os.walk(root_dir) for fname in names)
+    if model_archive_format == "zip":
+        compression = zipfile.ZIP_DEFLATED if model_archive_compresslevel > 0 else zipfile.ZIP_STORED
+        with zipfile.ZipFile(out, "w", compression=compression, compresslevel=model_archive_compresslevel) as zf:
+            for path in files:
+                zf.write(path, os.path.relpath(path, root_dir))
+    elif model_archive_format in ("tar", "gztar"):
+        gz = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=model_archive_compresslevel) if model_archive_format == "gztar" else None
+        with tarfile.open(fileobj=gz or out, mode="w|") as tf:
+            for path in files:
+                tf.add(path, os.path.relpath(path, root_dir))
+        if gz:
+            gz.close()
+    else:
+        raise ValueError(f"Unsupported model archive format: {model_archive_format}")
+
 model_dir = "model"
 if os.path.isdir(model_dir) and os.listdir(model_dir):  # only if not empty
-    zip_name = "trained_model.zip"
-    shutil.make_archive("trained_model", "zip", model_dir)
-    gcs_model = result_base + "_model.zip"
-    bucket.blob(blob_path + "_model.zip").upload_from_filename(zip_name)
-    print(f"Uploaded model zip to {gcs_model}")
+    ext, content_type = {"zip": (".zip", "application/zip"), "tar": (".tar", "application/x-tar"),
+                         "gztar": (".tar.gz", "application/gzip")}.get(model_archive_format, (".zip", "application/zip"))
+    gcs_model = result_base + "_model" + ext
+    blob = bucket.blob(blob_path + "_model" + ext)
+    # Resumable upload in 8 MiB chunks: the archive is never materialised on disk
+    with blob.open("wb", chunk_size=8 * 1024 * 1024, content_type=content_type) as upload:
+        writer = _HashingWriter(upload)
+        _write_archive(writer, model_dir)
+    # Closing the writer does not refresh the blob's properties; fetch the stored checksum
+    blob.reload()
+    if blob.size != writer.size:
+        raise RuntimeError(f"Model archive upload size mismatch: wrote {writer.size} bytes, stored {blob.size}")
+    manifest["model"] = {"path": gcs_model, "size": writer.size, "content_type": content_type,
+                         "sha256": writer.sha256.hexdigest(), "crc32c": blob.crc32c}
+    print(f"Uploaded model archive to {gcs_model}")
 else:
     print("No model artifacts found to upload.")
+
+with open("result_manifest.json", "w") as f:  # read back by the executor (RESULT_MANIFEST_NAME)
+    json.dump(manifest, f)
 '''
     uploader_cell = nbformat.v4.new_code_cell(source=uploader_source)
     nb.cells.append(uploader_cell)
-
-    with open(output_nb, "w", encoding="utf-8") as f:
-        nbformat.write(nb, f)
+    return nb
+
+@app.get("/metrics")
+def metrics():
+    """ Prometheus exposition of the executor's phase histograms and counters. """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    """ Hit/miss counters of the executor's in-memory caches (never their contents). """
+    return {
+        "dek": DEK_CACHE.stats(),
+        "datasets": DATASET_CACHE.stats() if DATASET_CACHE else None,
+        "results": RESULT_MEMO.stats() if RESULT_MEMO else None,
+    }
 
 # Add this endpoint to executor.py
 @app.get("/logs/{workflow_id}")
-def get_workflow_logs(workflow_id: str):
-    with LOG_LOCK:
-        logs = WORKFLOW_LOGS.get(workflow_id, [])
-    return {"logs": logs}
+def get_workflow_logs(workflow_id: str, since: int = Query(0, ge=0, description="Cursor from a previous response")):
+    entries, cursor, truncated = LOG_STORE.read(workflow_id, since)
+    return {"logs": [line for _, line in entries], "cursor": cursor, "truncated": truncated}
+
+@app.get("/logs/{workflow_id}/stream")
+async def stream_workflow_logs(workflow_id: str, request: Request,
+                               since: int = Query(0, ge=0, description="Cursor from a previous response"),
+                               last_event_id: Optional[str] = Header(None)):
+    """ Server-Sent Events stream of workflow log lines; each event id is the line's cursor. """
+    if last_event_id and last_event_id.isdigit():
+        since = max(since, int(last_event_id))
+
+    async def events():
+        cursor = since
+        while not await request.is_disconnected():
+            entries, new_cursor, _ = LOG_STORE.read(workflow_id, cursor)
+            for seq, line in entries:
+                data = "".join(f"data: {part}\n" for part in line.split("\n"))
+                yield f"id: {seq}\n{data}\n"
+            cursor = new_cursor
+            if not await LOG_STORE.wait(workflow_id, cursor, timeout=15):
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # ---------- Run server ----------
 if __name__ == "__main__":
@@ -0,0 +1,564 @@
+"""
+Notebook execution entry point for the executor's worker processes.
+
+Runs are executed in spawn-context worker processes so every papermill run gets its own
+interpreter, working directory and kernel, and nothing here touches the executor's
+process-wide state. Keep this module's imports light: it is imported fresh by every worker.
+
+Each worker also keeps a small pool of pre-started kernels with the workload's heavy
+imports already loaded, so a run only pays for leasing a kernel instead of starting one.
+
+Runs can instead use the script engine (run_script): the prepared notebook's code cells are
+compiled once per worker and executed in a plain Python subprocess, with no kernel and no
+executed notebook, only a small JSON execution record.
+"""
+import io
+import os
+import sys
+import json
+import time
+import marshal
+import hashlib
+import tempfile
+import threading
+import subprocess
+import logging
+import datetime
+import multiprocessing.util
+from collections import deque, OrderedDict
+
+import nbformat
+import papermill as pm
+import psutil
+from jupyter_client import KernelManager
+
+log = logging.getLogger("tee-executor.worker")
+
+# Code run in every pooled kernel before it is leased. Kept inside a function so the
+# workload starts with a clean namespace; only sys.modules stays warm.
+_WARM_UP_TEMPLATE = """
+def _ccr_warm_up():
+    import importlib
+    for name in {modules!r}:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+_ccr_warm_up()
+del _ccr_warm_up
+"""
+
+# Used when a kernel is returned to the pool (KERNEL_MAX_USES > 1)
+_RESET_CODE = "get_ipython().run_line_magic('reset', '-f')"
+
+# Seconds between RSS samples of the kernel process tree while a notebook runs
+_MEMORY_SAMPLE_INTERVAL = 0.25
+# Slowest cells listed at the top of a run's profile
+_PROFILE_TOP_CELLS = 5
+# Compiled code cells kept per worker for the script engine
+_COMPILE_CACHE_SIZE = 512
+# Environment variables passed through to script-engine subprocesses (name or prefix)
+_SCRIPT_ENV_ALLOW = ("PATH", "HOME", "LANG", "LC_", "TZ", "TMPDIR", "PYTHON", "GOOGLE_", "GCE_",
+                     "SSL_CERT_", "REQUESTS_CA_BUNDLE", "HTTP_PROXY", "HTTPS_PROXY", "NO_PROXY")
+# Set to the worker's pid in the environment of every kernel and subprocess it starts, so the
+# executor can find and kill them if the worker itself is killed
+WORKER_PID_ENV = "CCR_NOTEBOOK_WORKER_PID"
+
+
+def _run_code(km: KernelManager, code: str, timeout: float):
+    """ Runs code in the kernel behind km and raises if it fails or times out. """
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=timeout)
+        reply = kc.execute_interactive(code, timeout=timeout, output_hook=lambda msg: None)
+        if reply["content"]["status"] != "ok":
+            raise RuntimeError(f"Kernel code failed: {reply['content'].get('evalue')}")
+    finally:
+        kc.stop_channels()
+
+
+class _PooledKernel:
+    def __init__(self, km: KernelManager):
+        self.km = km
+        self.started_at = time.monotonic()
+        self.uses = 0
+
+
+class KernelPool:
+    """
+    Pre-started, pre-warmed kernels for one worker process.
+
+    Recycling policy: a kernel is discarded after `max_uses` runs (1 by default, so
+    tenants never share interpreter state) or once it has been idle for `max_age`
+    seconds. Every lease is health-checked by running the run's setup code in the kernel;
+    dead or unresponsive kernels are replaced.
+    """
+
+    def __init__(self, size: int, kernel_name: str = "python3", warm_modules=(),
+                 max_uses: int = 1, max_age: float = 3600, health_timeout: float = 10):
+        self.size = size
+        self.kernel_name = kernel_name
+        self.warm_up_code = _WARM_UP_TEMPLATE.format(modules=list(warm_modules))
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.health_timeout = health_timeout
+        self._idle = deque()
+        self._lock = threading.Condition()
+        self._refilling = False
+
+    def _start_kernel(self) -> _PooledKernel:
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel(cwd=tempfile.gettempdir())
+        try:
+            _run_code(km, self.warm_up_code, timeout=300)
+        except Exception:
+            self._discard(_PooledKernel(km))
+            raise
+        return _PooledKernel(km)
+
+    def _discard(self, kernel: _PooledKernel):
+        try:
+            kernel.km.shutdown_kernel(now=True)
+        except Exception as e:
+            log.warning(f"Failed to shut down pooled kernel: {e}")
+
+    def _healthy(self, kernel: _PooledKernel, setup_code: str) -> bool:
+        if time.monotonic() - kernel.started_at > self.max_age or not kernel.km.is_alive():
+            return False
+        try:
+            _run_code(kernel.km, setup_code, timeout=self.health_timeout)
+            return True
+        except Exception:
+            return False
+
+    def fill(self):
+        """ Starts kernels until `size` are idle. """
+        while True:
+            with self._lock:
+                if len(self._idle) >= self.size:
+                    return
+            kernel = self._start_kernel()
+            with self._lock:
+                self._idle.append(kernel)
+                self._lock.notify()
+
+    def fill_in_background(self):
+        with self._lock:
+            if self._refilling or len(self._idle) >= self.size:
+                return
+            self._refilling = True
+
+        def _fill():
+            try:
+                self.fill()
+            except Exception as e:
+                log.warning(f"Failed to refill kernel pool: {e}")
+            finally:
+                with self._lock:
+                    self._refilling = False
+                    self._lock.notify_all()
+
+        threading.Thread(target=_fill, daemon=True).start()
+
+    def acquire(self, setup_code: str = "pass"):
+        """
+        Returns (kernel, warm) with a healthy kernel that has run setup_code. Waits for an
+        in-flight refill rather than racing it, and starts a cold kernel if none is coming.
+        """
+        while True:
+            with self._lock:
+                while not self._idle and self._refilling:
+                    self._lock.wait()
+                kernel = self._idle.popleft() if self._idle else None
+            if kernel is None:
+                kernel = self._start_kernel()
+                if not self._healthy(kernel, setup_code):
+                    self._discard(kernel)
+                    raise RuntimeError("Freshly started kernel failed its health check")
+                return kernel, False
+            if self._healthy(kernel, setup_code):
+                return kernel, True
+            self._discard(kernel)
+
+    def release(self, kernel: _PooledKernel):
+        kernel.uses += 1
+        recycle = kernel.uses < self.max_uses and kernel.km.is_alive()
+        if recycle:
+            try:
+                _run_code(kernel.km, _RESET_CODE, timeout=self.health_timeout)
+            except Exception:
+                recycle = False
+        if recycle:
+            with self._lock:
+                self._idle.append(kernel)
+        else:
+            self._discard(kernel)
+        self.fill_in_background()
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for kernel in idle:
+            self._discard(kernel)
+
+
+class _LogPipe:
+    """ Write end of the executor's log pipe; put() may be called from several threads. """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        with self._lock:
+            self._conn.send(item)
+
+
+class LogPipeWriter(io.TextIOBase):
+    """
+    papermill stdout_file that forwards every complete line to the executor process as
+    (run_id, workflow_id, line) on log_pipe. close() flushes a trailing partial line and
+    sends (run_id, workflow_id, None) so the executor knows the run's output is complete.
+    """
+
+    def __init__(self, log_pipe, run_id: str, workflow_id: str):
+        super().__init__()
+        self._queue = log_pipe
+        self._run_id = run_id
+        self._workflow_id = workflow_id
+        self._partial = ""
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        *lines, self._partial = (self._partial + text).split("\n")
+        for line in lines:
+            self._queue.put((self._run_id, self._workflow_id, line))
+        return len(text)
+
+    def close(self):
+        if not self.closed:
+            if self._partial:
+                self._queue.put((self._run_id, self._workflow_id, self._partial))
+                self._partial = ""
+            self._queue.put((self._run_id, self._workflow_id, None))
+        super().close()
+
+
+class _MemorySampler(threading.Thread):
+    """ Samples the RSS of the kernel behind km, or of process pid, (and its children) until stopped. """
+
+    def __init__(self, km: KernelManager = None, interval: float = _MEMORY_SAMPLE_INTERVAL, pid: int = None):
+        super().__init__(daemon=True)
+        self.km = km
+        self.pid = pid
+        self.interval = interval
+        self.samples = []   # (unix time, rss bytes)
+        self._stopped = threading.Event()
+
+    def run(self):
+        proc = None
+        while not self._stopped.wait(self.interval):
+            try:
+                if proc is None:
+                    pid = self.pid
+                    if pid is None and self.km is not None and self.km.has_kernel:
+                        pid = getattr(self.km.provisioner, "pid", None)
+                    if pid is None:
+                        continue   # papermill has not started the kernel yet
+                    proc = psutil.Process(pid)
+                rss = proc.memory_info().rss
+                for child in proc.children(recursive=True):
+                    try:
+                        rss += child.memory_info().rss
+                    except psutil.Error:
+                        pass
+                self.samples.append((time.time(), rss))
+            except psutil.Error:
+                proc = None
+            except Exception:
+                pass
+
+    def stop(self):
+        self._stopped.set()
+        self.join(timeout=5)
+
+
+def _parse_time(value):
+    try:
+        t = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return t.timestamp()
+
+
+def _first_line(source: str) -> str:
+    lines = source.strip().splitlines()
+    return lines[0][:80] if lines else ""
+
+
+def build_cell_profile(executed_nb_path: str, samples) -> dict:
+    """
+    Compact per-cell profile from the papermill metadata of an executed notebook: duration,
+    status and peak kernel RSS of every code cell, plus the run's overall peak and the
+    indexes of the slowest cells.
+    """
+    nb = nbformat.read(executed_nb_path, as_version=4)
+    timed_cells = []
+    for index, cell in enumerate(nb.cells):
+        if cell.cell_type != "code":
+            continue
+        meta = cell.metadata.get("papermill", {})
+        timed_cells.append((index, _parse_time(meta.get("start_time")), _parse_time(meta.get("end_time")),
+                            meta.get("duration"), meta.get("status"), _first_line(cell.source)))
+    return _summarize_profile(timed_cells, samples)
+
+
+def build_record_profile(record: dict, samples) -> dict:
+    """ The same profile as build_cell_profile, from a script-engine execution record. """
+    return _summarize_profile(
+        [(c["index"], c["start_time"], c["end_time"], c["duration"], c["status"], c["first_line"])
+         for c in record["cells"]],
+        samples,
+    )
+
+
+def _summarize_profile(timed_cells, samples) -> dict:
+    """ timed_cells: (index, start, end, duration, status, first_line) per code cell, times in unix seconds. """
+    cells = []
+    for index, start, end, duration, status, first_line in timed_cells:
+        window = [rss for t, rss in samples if start is not None and end is not None and start <= t <= end]
+        cells.append({
+            "index": index,
+            "duration": duration,
+            "status": status,
+            "peak_memory_bytes": max(window) if window else None,
+            "first_line": first_line,
+        })
+    timed = [c for c in cells if c["duration"] is not None]
+    return {
+        "total_seconds": round(sum(c["duration"] for c in timed), 3),
+        "peak_memory_bytes": max((rss for _, rss in samples), default=None),
+        "slowest_cells": [c["index"] for c in sorted(timed, key=lambda c: c["duration"], reverse=True)[:_PROFILE_TOP_CELLS]],
+        "cells": cells,
+    }
+
+
+# Runs the compiled cells of a prepared notebook in the script engine's subprocess:
+#   python -c _SCRIPT_DRIVER <compiled cells> <execution record> <address-space limit, 0 for none>
+# Cells share one module namespace; IPython magics are reduced to a minimal shell.
+_SCRIPT_DRIVER = r"""
+import sys, json, time, marshal, traceback, subprocess, resource
+
+# Applied here rather than in a preexec_fn, which is unsafe in the threaded worker
+_memory_limit = int(sys.argv[3])
+if _memory_limit > 0:
+    resource.setrlimit(resource.RLIMIT_AS, (_memory_limit, _memory_limit))
+
+class _ScriptShell:
+    # Stands in for get_ipython() in cells written for a kernel
+    def system(self, cmd):
+        return subprocess.call(cmd, shell=True)
+    def getoutput(self, cmd, split=True):
+        out = subprocess.getoutput(cmd)
+        return out.splitlines() if split else out
+    def run_line_magic(self, name, line, _stack_depth=None):
+        print(f"Script engine: skipping %{name} {line}")
+    def run_cell_magic(self, name, line, cell):
+        print(f"Script engine: skipping %%{name} cell")
+
+def main(code_path, record_path):
+    with open(code_path, "rb") as f:
+        cells = marshal.load(f)   # [(notebook cell index, first line, code object)]
+    shell = _ScriptShell()
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__, "get_ipython": lambda: shell}
+    record = {"engine": "script", "status": "ok", "start_time": time.time(), "cells": [], "error": None}
+    for index, first_line, code in cells:
+        start = time.time()
+        status = "completed"
+        try:
+            exec(code, namespace)
+        except BaseException as e:
+            status = "failed"
+            record["status"] = "failed"
+            record["error"] = {"cell_index": index, "ename": type(e).__name__, "evalue": str(e),
+                               "traceback": traceback.format_exc()}
+        finally:
+            sys.stdout.flush()
+            end = time.time()
+            record["cells"].append({"index": index, "start_time": start, "end_time": end,
+                                    "duration": round(end - start, 6), "status": status, "first_line": first_line})
+        if status == "failed":
+            break
+    record["end_time"] = time.time()
+    with open(record_path, "w", encoding="utf-8") as f:
+        json.dump(record, f)
+    return 0 if record["status"] == "ok" else 1
+
+sys.exit(main(sys.argv[1], sys.argv[2]))
+"""
+
+_kernel_pool = None
+_log_pipe = None
+_compiled_cells = OrderedDict()   # (cell index, sha256 of source) -> code object
+
+
+def init_worker(pool_size: int, kernel_name: str, warm_modules, max_uses: int, max_age: float,
+                log_conn=None):
+    """ ProcessPoolExecutor initializer: keeps the log pipe and pre-starts this worker's kernels. """
+    global _kernel_pool, _log_pipe
+    _log_pipe = _LogPipe(log_conn) if log_conn is not None else None
+    os.environ[WORKER_PID_ENV] = str(os.getpid())
+    if pool_size <= 0:
+        return
+    _kernel_pool = KernelPool(pool_size, kernel_name, warm_modules, max_uses, max_age)
+    _kernel_pool.fill_in_background()
+    # Pooled kernels run in their own sessions and would outlive the worker; atexit does not
+    # run in multiprocessing children, their finalizers do
+    multiprocessing.util.Finalize(_kernel_pool, _kernel_pool.shutdown, exitpriority=10)
+
+
+def warm_up():
+    """ No-op task used to make the executor spawn its workers ahead of the first run. """
+    return os.getpid()
+
+
+def run_notebook(prepared_nb_path: str, executed_nb_path: str, workdir: str,
+                 run_id: str, workflow_id: str, kernel_name: str = "python3"):
+    """
+    Executes prepared_nb_path with papermill inside workdir, streaming kernel stdout line by
+    line to the executor over the worker's log queue. Returns kernel-acquire and execution
+    timings and the run's per-cell profile.
+    """
+    # The worker process is exclusive to this run while it executes, so it may own its cwd
+    os.chdir(workdir)
+
+    t0 = time.perf_counter()
+    # Pooled kernels were started elsewhere; move them into this run's workdir
+    setup_code = f"import os; os.chdir({workdir!r}); del os"
+    kernel, warm = (_kernel_pool.acquire(setup_code) if _kernel_pool else (None, False))
+    t1 = time.perf_counter()
+
+    # Without a pooled kernel papermill starts this one; we own it so we can sample its memory
+    km = kernel.km if kernel else KernelManager(kernel_name=kernel_name)
+    sampler = _MemorySampler(km)
+    sampler.start()
+    try:
+        stdout_f = LogPipeWriter(_log_pipe, run_id, workflow_id) if _log_pipe is not None else None
+        try:
+            pm.execute_notebook(
+                input_path=prepared_nb_path,
+                output_path=executed_nb_path,
+                kernel_name=kernel_name,
+                cwd=workdir,
+                stdout_file=stdout_f,
+                km=km,
+            )
+        finally:
+            if stdout_f is not None:
+                stdout_f.close()
+    finally:
+        sampler.stop()
+        if kernel:
+            _kernel_pool.release(kernel)
+        elif km.has_kernel:
+            km.shutdown_kernel(now=True)
+    t2 = time.perf_counter()
+
+    return {
+        "kernel_acquire_seconds": round(t1 - t0, 3),
+        "execution_seconds": round(t2 - t1, 3),
+        "kernel_warm": warm,
+        "profile": build_cell_profile(executed_nb_path, sampler.samples),
+    }
+
+
+def _compile_cell(index: int, source: str):
+    key = (index, hashlib.sha256(source.encode("utf-8")).hexdigest())
+    code = _compiled_cells.get(key)
+    if code is None:
+        try:
+            from IPython.core.inputtransformer2 import TransformerManager
+            python_source = TransformerManager().transform_cell(source)
+        except ImportError:
+            python_source = source
+        code = compile(python_source, f"<cell {index}>", "exec")
+        _compiled_cells[key] = code
+        while len(_compiled_cells) > _COMPILE_CACHE_SIZE:
+            _compiled_cells.popitem(last=False)
+    else:
+        _compiled_cells.move_to_end(key)
+    return code
+
+
+def _script_env():
+    return {k: v for k, v in os.environ.items() if k.startswith(_SCRIPT_ENV_ALLOW) or k == WORKER_PID_ENV}
+
+
+def run_script(prepared_nb_path: str, record_path: str, workdir: str, run_id: str, workflow_id: str,
+               memory_limit: int = 0):
+    """
+    Script engine: executes the code cells of prepared_nb_path in a fresh Python subprocess
+    (own session, cwd workdir, allow-listed environment, optional address-space limit) and
+    writes a JSON execution record to record_path instead of an executed notebook. Cells are
+    compiled once per worker and cached. Returns the same shape as run_notebook.
+    """
+    os.chdir(workdir)
+
+    t0 = time.perf_counter()
+    nb = nbformat.read(prepared_nb_path, as_version=4)
+    cells = [(index, _first_line(cell.source), _compile_cell(index, cell.source))
+             for index, cell in enumerate(nb.cells) if cell.cell_type == "code"]
+    code_path = os.path.join(workdir, "compiled_cells.bin")
+    with open(code_path, "wb") as f:
+        marshal.dump(cells, f)
+    t1 = time.perf_counter()
+
+    stdout_f = LogPipeWriter(_log_pipe, run_id, workflow_id) if _log_pipe is not None else None
+    proc = subprocess.Popen(
+        [sys.executable, "-u", "-c", _SCRIPT_DRIVER, code_path, record_path, str(max(memory_limit, 0))],
+        cwd=workdir,
+        env=_script_env(),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        close_fds=True,
+        start_new_session=True,
+    )
+    sampler = _MemorySampler(pid=proc.pid)
+    sampler.start()
+    try:
+        for line in proc.stdout:
+            if stdout_f is not None:
+                stdout_f.write(line)
+        returncode = proc.wait()
+    finally:
+        sampler.stop()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if stdout_f is not None:
+            stdout_f.close()
+    t2 = time.perf_counter()
+
+    try:
+        with open(record_path, encoding="utf-8") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        raise RuntimeError(f"Script engine exited with code {returncode} without an execution record")
+    if record["error"]:
+        error = record["error"]
+        raise RuntimeError(f"Cell {error['cell_index']} failed: {error['ename']}: {error['evalue']}\n{error['traceback']}")
+
+    return {
+        "kernel_acquire_seconds": 0.0,
+        "compile_seconds": round(t1 - t0, 3),
+        "execution_seconds": round(t2 - t1, 3),
+        "kernel_warm": False,
+        "profile": build_record_profile(record, sampler.samples),
+    }
@@ -1,15 +1,28 @@
-from fastapi import FastAPI, HTTPException, Query, File, UploadFile, Form, Depends, Path
+from fastapi import FastAPI, HTTPException, Query, File, UploadFile, Form, Depends, Path, Body, Header
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 from google.cloud import bigquery, storage
-import uuid, datetime
+from google.api_core.exceptions import NotFound, GoogleAPIError
+import uuid, datetime, json
 import google.auth
 from google.auth.transport.requests import Request
 # import papermill as pm
 import tempfile
 import nbformat
-import requests
+import httpx
 from google.oauth2 import service_account
 import os
-from typing import List
+import time
+import random
+import secrets
+import asyncio
+import sqlite3
+import threading
+import contextlib
+from typing import List, Dict, Any, Optional, Literal
+from pydantic import BaseModel
+from collections import defaultdict, deque, OrderedDict
 
 app = FastAPI(title="Cleanroom Orchestrator")
 
@@ -22,6 +35,54 @@ DATASET = "cleanroom"
 BUCKET = f"{PROJECT_ID}-cleanroom"
 
 EXECUTOR_URL = "http://localhost:8443"
+# Public base URL of this orchestrator as seen from the executor; when set, the executor
+# POSTs finished runs to /runs/callback instead of waiting for a client to poll /runs/{run_id}
+ORCHESTRATOR_CALLBACK_URL = os.environ.get("ORCHESTRATOR_CALLBACK_URL")
+# Finished runs are dropped from the in-memory run table this long after they finish
+RUN_RETENTION_SECONDS = int(os.environ.get("RUN_RETENTION_SECONDS", 3600))
+# Every run this orchestrator starts is followed with long-polls of this many seconds (max 60)
+# until it finishes, so its results are recorded even if no client polls and no callback comes
+RUN_WATCH_WAIT_SECONDS = float(os.environ.get("RUN_WATCH_WAIT_SECONDS", 30))
+# Executor client: keep-alive pool size, cap on in-flight calls (callers beyond it wait here),
+# retries with jittered exponential backoff, and per-endpoint timeouts in seconds
+EXECUTOR_MAX_CONNECTIONS = int(os.environ.get("EXECUTOR_MAX_CONNECTIONS", 100))
+EXECUTOR_MAX_IN_FLIGHT = int(os.environ.get("EXECUTOR_MAX_IN_FLIGHT", 256))
+# Log streams and run long-polls hold a connection for up to a minute, so each gets its own
+# pool; a call that finds its pool full for EXECUTOR_POOL_WAIT_SECONDS is refused with a 503
+EXECUTOR_MAX_STREAMS = int(os.environ.get("EXECUTOR_MAX_STREAMS", 200))
+EXECUTOR_MAX_LONG_POLLS = int(os.environ.get("EXECUTOR_MAX_LONG_POLLS", 500))
+EXECUTOR_POOL_WAIT_SECONDS = float(os.environ.get("EXECUTOR_POOL_WAIT_SECONDS", 1))
+EXECUTOR_RETRIES = int(os.environ.get("EXECUTOR_RETRIES", 3))
+EXECUTOR_RETRY_BACKOFF = float(os.environ.get("EXECUTOR_RETRY_BACKOFF", 0.2))   # first retry waits up to this, then doubles
+EXECUTOR_CONNECT_TIMEOUT = float(os.environ.get("EXECUTOR_CONNECT_TIMEOUT", 5))
+EXECUTOR_TIMEOUTS = {
+    "execute": 30,
+    "resume": 30,
+    "run_status": 10,   # on top of the long-poll wait
+    "attestation": 10,
+    "logs": 10,
+    "log_stream": 60,   # read timeout; the executor sends a keep-alive at least every 15s
+}
+# Metadata backend: "bigquery" (per-client tables) or "sqlite" (local WAL database, exported
+# to the same BigQuery tables every METADATA_EXPORT_INTERVAL_SECONDS)
+METADATA_BACKEND = os.environ.get("METADATA_BACKEND", "bigquery")
+METADATA_SQLITE_PATH = os.environ.get("METADATA_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "cleanroom-metadata.db"))
+METADATA_EXPORT_INTERVAL_SECONDS = float(os.environ.get("METADATA_EXPORT_INTERVAL_SECONDS", 5))
+METADATA_EXPORT_BATCH_SIZE = int(os.environ.get("METADATA_EXPORT_BATCH_SIZE", 500))
+# BigQuery backend: streaming inserts go through a journaled write-behind buffer, flushed per
+# table at WRITE_BEHIND_MAX_ROWS rows or after WRITE_BEHIND_MAX_DELAY_SECONDS; flushed rows stay
+# visible to lookups from the buffer for WRITE_BEHIND_VISIBILITY_SECONDS. "0" writes through.
+METADATA_WRITE_BEHIND = os.environ.get("METADATA_WRITE_BEHIND", "1") == "1"
+WRITE_BEHIND_JOURNAL = os.environ.get("WRITE_BEHIND_JOURNAL", os.path.join(tempfile.gettempdir(), "cleanroom-write-behind.jsonl"))
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get("WRITE_BEHIND_MAX_ROWS", 500))
+WRITE_BEHIND_MAX_DELAY_SECONDS = float(os.environ.get("WRITE_BEHIND_MAX_DELAY_SECONDS", 2))
+WRITE_BEHIND_VISIBILITY_SECONDS = float(os.environ.get("WRITE_BEHIND_VISIBILITY_SECONDS", 60))
+# Signed URLs are cached per (object, method, content type) and handed out again while at least
+# SIGNED_URL_MIN_REMAINING_SECONDS of their validity is left; batch endpoints sign at most
+# SIGNED_URL_BATCH_MAX objects per request
+SIGNED_URL_CACHE_SIZE = int(os.environ.get("SIGNED_URL_CACHE_SIZE", 10000))
+SIGNED_URL_MIN_REMAINING_SECONDS = float(os.environ.get("SIGNED_URL_MIN_REMAINING_SECONDS", 300))
+SIGNED_URL_BATCH_MAX = int(os.environ.get("SIGNED_URL_BATCH_MAX", 1000))
 
 # 👇 Add the dedicated signer service account email
 
@@ -34,6 +95,568 @@ creds = service_account.Credentials.from_service_account_file(SA_KEY_PATH)
 
 FIXED_WORKLOAD_PATH = f"gs://yellowsense-technologies-cleanroom/workloads/model-1a.ipynb"
 
+
+# ---------------------------
+#  Executor client
+# ---------------------------
+class ExecutorClient:
+    """
+    Async HTTP client for every orchestrator -> executor call. Short calls share a keep-alive
+    connection pool with at most `max_in_flight` outstanding; log streams and long-polls
+    (extra_timeout > 0) each get a bounded pool of their own, so long-lived connections never
+    starve short calls, and a full stream / long-poll pool raises httpx.PoolTimeout at once
+    instead of retrying. Failures are retried with full-jitter exponential backoff: GETs on
+    transport errors and 502/503/504, POSTs only when the request never reached the
+    executor, so a run is never submitted twice.
+    """
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(self, base_url: str, max_connections: int, max_in_flight: int, retries: int, backoff: float,
+                 max_streams: int, max_long_polls: int):
+        def _limits(n):
+            return httpx.Limits(max_connections=n, max_keepalive_connections=n)
+        self._client = httpx.AsyncClient(base_url=base_url, limits=_limits(max_connections))
+        self._stream_client = httpx.AsyncClient(base_url=base_url, limits=_limits(max_streams))
+        self._long_poll_client = httpx.AsyncClient(base_url=base_url, limits=_limits(max_long_polls))
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.retries = retries
+        self.backoff = backoff
+
+    async def request(self, method: str, path: str, endpoint: str, extra_timeout: float = 0,
+                      stream: bool = False, **kwargs) -> httpx.Response:
+        """
+        Sends one call, retrying as described above. With stream=True the body is not read;
+        the caller must aclose() the response.
+        """
+        dedicated = stream or extra_timeout > 0
+        client = (self._stream_client if stream else self._long_poll_client) if dedicated else self._client
+        total = EXECUTOR_TIMEOUTS[endpoint] + extra_timeout
+        timeout = httpx.Timeout(total, connect=EXECUTOR_CONNECT_TIMEOUT,
+                                pool=EXECUTOR_POOL_WAIT_SECONDS if dedicated else total)
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                async with (contextlib.nullcontext() if dedicated else self._slots):
+                    request = client.build_request(method, path, timeout=timeout, **kwargs)
+                    resp = await client.send(request, stream=stream)
+                if resp.status_code not in self.RETRY_STATUS or method != "GET" or last:
+                    return resp
+                await resp.aclose()
+            except httpx.PoolTimeout:
+                if dedicated or last:
+                    raise
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if last:
+                    raise
+            except httpx.TransportError:
+                if method != "GET" or last:
+                    raise
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    async def aclose(self):
+        await self._client.aclose()
+        await self._stream_client.aclose()
+        await self._long_poll_client.aclose()
+
+executor_client = ExecutorClient(EXECUTOR_URL, EXECUTOR_MAX_CONNECTIONS, EXECUTOR_MAX_IN_FLIGHT,
+                                 EXECUTOR_RETRIES, EXECUTOR_RETRY_BACKOFF, EXECUTOR_MAX_STREAMS,
+                                 EXECUTOR_MAX_LONG_POLLS)
+
+@app.on_event("shutdown")
+async def _close_executor_client():
+    for task in list(_run_watchers):
+        task.cancel()
+    await executor_client.aclose()
+
+def _raise_passthrough(resp: httpx.Response, statuses):
+    """ Re-raises executor answers the caller should see as-is (with Retry-After, if any). """
+    if resp.status_code in statuses:
+        headers = {"Retry-After": resp.headers["Retry-After"]} if "Retry-After" in resp.headers else None
+        raise HTTPException(status_code=resp.status_code, detail=resp.json().get("detail"), headers=headers)
+
+
+# ---------------------------
+#  Metadata store
+# ---------------------------
+# Workflows, approvals, dataset/key files and results. "bigquery" keeps them in the per-client
+# BigQuery tables; "sqlite" keeps them in an indexed local SQLite database (WAL mode) and
+# exports every row to those same BigQuery tables in the background, for analytics.
+class WriteBehindBuffer:
+    """
+    Write-behind buffer for BigQuery streaming inserts. Rows are journaled to a local file
+    (fsync'ed, so they survive a crash and are replayed on start), coalesced per table and
+    flushed with one insert_rows_json call per table once `max_rows` are waiting or the
+    oldest has waited `max_delay` seconds. Rows BigQuery skips, or every row of a failed
+    call, are retried with backoff; rows it rejects as invalid are dropped. Buffered rows,
+    and flushed rows for `visibility` seconds, are served by pending() so lookups read
+    their own writes before BigQuery's streaming buffer shows them.
+    """
+
+    def __init__(self, journal_path: str, max_rows: int, max_delay: float, visibility: float,
+                 retry_backoff: float = 1.0):
+        self.journal_path = journal_path
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.visibility = visibility
+        self.retry_backoff = retry_backoff
+        self._pending: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()   # seq -> entry
+        self._recent = deque()   # (flushed_at, table_id, row)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._flusher = None
+        self._replay()
+        self._journal = open(journal_path, "a", encoding="utf-8")
+
+    def _replay(self):
+        """ Re-queues journaled rows that were never acknowledged by BigQuery. """
+        if not os.path.exists(self.journal_path):
+            return
+        entries, acked = OrderedDict(), set()
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue   # torn last line from a crash mid-write
+                if "ack" in record:
+                    acked.update(record["ack"])
+                else:
+                    entries[record["seq"]] = record
+        now = time.monotonic()
+        for seq, record in entries.items():
+            if seq not in acked:
+                self._pending[seq] = {"table": record["table"], "row": record["row"], "queued_at": now,
+                                      "attempts": 0, "retry_at": 0}
+        self._seq = max(entries, default=0)
+        # Rewrite the journal with just the rows still owed to BigQuery
+        with open(self.journal_path + ".tmp", "w", encoding="utf-8") as f:
+            for seq, entry in self._pending.items():
+                f.write(json.dumps({"seq": seq, "table": entry["table"], "row": entry["row"]}) + "\n")
+        os.replace(self.journal_path + ".tmp", self.journal_path)
+        if self._pending:
+            print(f"Write-behind: replaying {len(self._pending)} journaled row(s)")
+
+    def _write_journal(self, records):
+        self._journal.write("".join(json.dumps(r, default=str) + "\n" for r in records))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def append(self, table_id: str, rows: List[Dict[str, Any]]):
+        """ Queues rows for table_id; returns once they are durable in the journal. """
+        with self._cond:
+            now = time.monotonic()
+            records = []
+            for row in rows:
+                self._seq += 1
+                self._pending[self._seq] = {"table": table_id, "row": row, "queued_at": now, "attempts": 0, "retry_at": 0}
+                records.append({"seq": self._seq, "table": table_id, "row": row})
+            self._write_journal(records)
+            if sum(1 for e in self._pending.values() if e["table"] == table_id) >= self.max_rows:
+                self._cond.notify()
+        return []
+
+    def pending(self, table_id: str) -> List[Dict[str, Any]]:
+        """ Rows of table_id BigQuery queries may not return yet, oldest first. """
+        with self._cond:
+            cutoff = time.monotonic() - self.visibility
+            while self._recent and self._recent[0][0] < cutoff:
+                self._recent.popleft()
+            return ([row for _, table, row in self._recent if table == table_id] +
+                    [e["row"] for e in self._pending.values() if e["table"] == table_id])
+
+    def _due(self, now: float) -> Dict[str, List[int]]:
+        by_table = defaultdict(list)
+        for seq, entry in self._pending.items():
+            if entry["retry_at"] <= now and not entry.get("sending"):
+                by_table[entry["table"]].append(seq)
+        return {
+            table: seqs for table, seqs in by_table.items()
+            if len(seqs) >= self.max_rows or now - self._pending[seqs[0]]["queued_at"] >= self.max_delay
+        }
+
+    def flush(self, force: bool = False):
+        """ Sends every due row (every pending row with force) to BigQuery, max_rows per call. """
+        with self._cond:
+            due = self._due(float("inf") if force else time.monotonic())
+            batches = []
+            for table, seqs in due.items():
+                for seq in seqs:
+                    self._pending[seq]["sending"] = True
+                for i in range(0, len(seqs), self.max_rows):
+                    batches.append((table, [(seq, self._pending[seq]["row"]) for seq in seqs[i:i + self.max_rows]]))
+        for table_id, batch in batches:
+            try:
+                errors = bq_client.insert_rows_json(table_id, [row for _, row in batch])
+            except Exception as e:
+                print(f"Write-behind flush to {table_id} failed: {e}")
+                errors = [{"index": i, "errors": []} for i in range(len(batch))]
+            retry = {err["index"] for err in errors or []
+                     if not any(e.get("reason") == "invalid" for e in err.get("errors", []))}
+            if errors and len(retry) < len(errors):
+                print(f"Write-behind: {table_id} rejected {len(errors) - len(retry)} invalid row(s): {errors}")
+            with self._cond:
+                done = []
+                for i, (seq, row) in enumerate(batch):
+                    entry = self._pending.get(seq)
+                    if entry is None:
+                        continue
+                    entry["sending"] = False
+                    if i in retry:
+                        entry["attempts"] += 1
+                        entry["retry_at"] = time.monotonic() + min(60, self.retry_backoff * 2 ** entry["attempts"])
+                    else:
+                        del self._pending[seq]
+                        done.append(seq)
+                        self._recent.append((time.monotonic(), table_id, row))
+                if done:
+                    self._write_journal([{"ack": done}])
+                if not self._pending:
+                    self._journal.truncate(0)   # append mode: the next write starts a fresh journal
+
+    def start(self):
+        with self._cond:
+            if self._flusher is not None:
+                return
+
+            def _flush_forever():
+                while True:
+                    with self._cond:
+                        self._cond.wait(timeout=self.max_delay)
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        print(f"Write-behind flush failed: {e}")
+
+            self._flusher = threading.Thread(target=_flush_forever, name="write-behind", daemon=True)
+            self._flusher.start()
+
+class BigQueryMetadataStore:
+    """
+    Metadata in per-client BigQuery tables: {creator}_workflows, {client}_workflow_approvals, ...
+    With a WriteBehindBuffer, streaming inserts are buffered and lookups merge in the rows
+    BigQuery may not return yet.
+    """
+
+    def __init__(self, buffer: Optional[WriteBehindBuffer] = None):
+        self.buffer = buffer
+
+    def _table(self, name: str) -> str:
+        return f"{PROJECT_ID}.{DATASET}.{name}"
+
+    def _insert(self, table: str, rows: List[Dict[str, Any]]) -> list:
+        if self.buffer:
+            return self.buffer.append(self._table(table), rows)
+        return bq_client.insert_rows_json(self._table(table), rows)
+
+    def _buffered(self, table: str, **match) -> List[Dict[str, Any]]:
+        """ Buffered rows of table matching every field in match, newest first. """
+        if not self.buffer:
+            return []
+        rows = self.buffer.pending(self._table(table))
+        return [row for row in reversed(rows) if all(row.get(k) == v for k, v in match.items())]
+
+    def start(self):
+        if self.buffer:
+            self.buffer.start()
+
+    def close(self):
+        if self.buffer:
+            self.buffer.flush(force=True)
+
+    def add_workflow(self, creator: str, row: Dict[str, Any]) -> list:
+        return self._insert(f"{creator}_workflows", [row])
+
+    def get_workflow(self, creator: str, workflow_id: str) -> Optional[Dict[str, Any]]:
+        query = f"""
+        SELECT * FROM `{self._table(f"{creator}_workflows")}`
+        WHERE workflow_id = @workflow_id
+        """
+        job = bq_client.query(query, job_config=bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id)]
+        ))
+        rows = list(job.result()) or self._buffered(f"{creator}_workflows", workflow_id=workflow_id)
+        return dict(rows[0]) if rows else None
+
+    def add_approval(self, client_id: str, workflow_id: str, approved: bool) -> list:
+        query = f"""
+        INSERT INTO `{self._table(f"{client_id}_workflow_approvals")}`
+        (workflow_id, approver, approved, approved_at)
+        VALUES (@workflow_id, @approver, @approved, CURRENT_TIMESTAMP())
+        """
+        job = bq_client.query(query, job_config=bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id),
+                              bigquery.ScalarQueryParameter("approver", "STRING", client_id),
+                              bigquery.ScalarQueryParameter("approved", "BOOL", approved)]
+        ))
+        job.result()
+        return []
+
+    def add_file(self, owner: str, file_type: str, row: Dict[str, Any]) -> list:
+        return self._insert(f"{owner}_{file_type}s", [row])
+
+    def run_input_rows(self, workflow_id: str, owners: List[str], collaborators: List[str]):
+        """
+        One query returning everything /run needs, tagged by `kind`: the latest approval of each
+        collaborator ('approval'), the workflow's workload ('workflow'), and every client's
+        datasets ('dataset') and wrapped keys ('key'), newest first. owners[0] is the creator.
+        """
+        creator = owners[0]
+        params = [bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id)]
+        params += [bigquery.ScalarQueryParameter(f"owner_{i}", "STRING", owner) for i, owner in enumerate(owners)]
+        owner_param = {owner: f"@owner_{i}" for i, owner in enumerate(owners)}
+
+        approvals = [f"""
+        SELECT 'approval' AS kind, {owner_param[c]} AS owner,
+               ARRAY_AGG(approved ORDER BY approved_at DESC LIMIT 1)[SAFE_OFFSET(0)] AS approved,
+               CAST(NULL AS STRING) AS workload_path, CAST(NULL AS STRING) AS dataset_id,
+               CAST(NULL AS STRING) AS gcs_path, CAST(NULL AS STRING) AS created_at
+        FROM `{self._table(f"{c}_workflow_approvals")}`
+        WHERE workflow_id = @workflow_id""" for c in collaborators]
+        workflow = [f"""
+        SELECT 'workflow' AS kind, {owner_param[creator]} AS owner, CAST(NULL AS BOOL) AS approved, workload_path,
+               CAST(NULL AS STRING) AS dataset_id, CAST(NULL AS STRING) AS gcs_path, CAST(NULL AS STRING) AS created_at
+        FROM `{self._table(f"{creator}_workflows")}`
+        WHERE workflow_id = @workflow_id"""]
+        files = [f"""
+        SELECT '{kind}', owner, CAST(NULL AS BOOL), CAST(NULL AS STRING), dataset_id, gcs_path,
+               CAST(created_at AS STRING)
+        FROM `{self._table(f"{owner}_{table}")}`
+        WHERE workflow_id = @workflow_id AND owner = {owner_param[owner]}"""
+            for owner in owners for kind, table in (("dataset", "datasets"), ("key", "keys"))]
+        sql = "\n        UNION ALL".join(workflow + approvals + files) + "\n        ORDER BY created_at DESC"
+        job = bq_client.query(sql, job_config=bigquery.QueryJobConfig(query_parameters=params))
+        rows = list(job.result())
+        if not self.buffer:
+            return rows
+
+        # Read-your-writes: buffered rows are newer than anything BigQuery returned
+        overlay = []
+        if not any(row["kind"] == "workflow" for row in rows):
+            overlay += [{"kind": "workflow", "owner": creator, "workload_path": row["workload_path"]}
+                        for row in self._buffered(f"{creator}_workflows", workflow_id=workflow_id)[:1]]
+        seen = {(row["kind"], row["owner"], row["gcs_path"]) for row in rows if row["kind"] in ("dataset", "key")}
+        for owner in owners:
+            for kind, table in (("dataset", "datasets"), ("key", "keys")):
+                for row in self._buffered(f"{owner}_{table}", workflow_id=workflow_id, owner=owner):
+                    if (kind, owner, row["gcs_path"]) not in seen:
+                        overlay.append({"kind": kind, "owner": owner, "dataset_id": row["dataset_id"],
+                                        "gcs_path": row["gcs_path"], "created_at": row["created_at"]})
+        return overlay + rows
+
+    def add_results(self, rows: List[Dict[str, Any]]) -> list:
+        return self._insert("results", rows)
+
+    def list_results(self, workflow_id: str) -> list:
+        """ result_path, executed_notebook_path, created_at of the workflow's results, newest first. """
+        query = f"""
+            SELECT id, result_path, executed_notebook_path, created_at
+            FROM `{self._table("results")}`
+            WHERE workflow_id = @workflow_id
+            ORDER BY created_at DESC
+        """
+        job = bq_client.query(
+            query,
+            job_config=bigquery.QueryJobConfig(
+                query_parameters=[
+                    bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id)
+                ]
+            ),
+        )
+        rows = list(job.result())
+        known = {row["id"] for row in rows}
+        overlay = [dict(row, created_at=datetime.datetime.fromisoformat(row["created_at"]))
+                   for row in self._buffered("results", workflow_id=workflow_id) if row["id"] not in known]
+        return overlay + rows
+
+
+class SqliteMetadataStore:
+    """
+    Metadata in one local SQLite database (WAL, indexed by workflow). Every write also lands
+    in an outbox table in the same transaction; a background thread exports the outbox to
+    the per-client BigQuery tables in batches and deletes what was accepted, so exports
+    survive restarts and BigQuery outages without slowing down requests.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS workflows (
+            creator TEXT NOT NULL, workflow_id TEXT NOT NULL, collaborator TEXT, workload_path TEXT,
+            status TEXT, created_at TEXT, PRIMARY KEY (creator, workflow_id));
+        CREATE TABLE IF NOT EXISTS approvals (
+            client_id TEXT NOT NULL, workflow_id TEXT NOT NULL, approver TEXT, approved INTEGER NOT NULL,
+            approved_at TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS approvals_by_workflow ON approvals (workflow_id, client_id, approved_at);
+        CREATE TABLE IF NOT EXISTS files (
+            owner TEXT NOT NULL, file_type TEXT NOT NULL, workflow_id TEXT NOT NULL, dataset_id TEXT,
+            gcs_path TEXT NOT NULL, created_at TEXT);
+        CREATE INDEX IF NOT EXISTS files_by_workflow ON files (workflow_id, owner, file_type, created_at);
+        CREATE TABLE IF NOT EXISTS results (
+            id TEXT PRIMARY KEY, workflow_id TEXT NOT NULL, executed_notebook_path TEXT, result_path TEXT,
+            created_at TEXT);
+        CREATE INDEX IF NOT EXISTS results_by_workflow ON results (workflow_id, created_at);
+        CREATE TABLE IF NOT EXISTS export_outbox (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, table_id TEXT NOT NULL, row TEXT NOT NULL);
+    """
+
+    def __init__(self, path: str, export_interval: float, export_batch_size: int):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(self.SCHEMA)
+        self.export_interval = export_interval
+        self.export_batch_size = export_batch_size
+        self._bq = BigQueryMetadataStore()
+        self._exporter = None
+
+    def _write(self, sql: str, values, exports):
+        """ Runs one insert and queues its BigQuery export rows [(table name, row)] atomically. """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(sql, values)
+                self._db.executemany(
+                    "INSERT INTO export_outbox (table_id, row) VALUES (?, ?)",
+                    [(self._bq._table(table), json.dumps(row, default=str)) for table, row in exports],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return []
+
+    def _read(self, sql: str, values=()) -> list:
+        with self._lock:
+            return self._db.execute(sql, values).fetchall()
+
+    def add_workflow(self, creator: str, row: Dict[str, Any]) -> list:
+        return self._write(
+            "INSERT OR REPLACE INTO workflows VALUES (?, ?, ?, ?, ?, ?)",
+            [(creator, row["workflow_id"], json.dumps(row["collaborator"]), row["workload_path"], row["status"],
+              row["created_at"])],
+            [(f"{creator}_workflows", row)],
+        )
+
+    def get_workflow(self, creator: str, workflow_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._read("SELECT * FROM workflows WHERE creator = ? AND workflow_id = ?", (creator, workflow_id))
+        if not rows:
+            return None
+        workflow = dict(rows[0])
+        workflow["collaborator"] = json.loads(workflow["collaborator"] or "[]")
+        return workflow
+
+    def add_approval(self, client_id: str, workflow_id: str, approved: bool) -> list:
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        row = {"workflow_id": workflow_id, "approver": client_id, "approved": approved, "approved_at": now}
+        return self._write(
+            "INSERT INTO approvals VALUES (?, ?, ?, ?, ?)",
+            [(client_id, workflow_id, client_id, int(approved), now)],
+            [(f"{client_id}_workflow_approvals", row)],
+        )
+
+    def add_file(self, owner: str, file_type: str, row: Dict[str, Any]) -> list:
+        return self._write(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            [(owner, file_type, row["workflow_id"], row["dataset_id"], row["gcs_path"], row["created_at"])],
+            [(f"{owner}_{file_type}s", row)],
+        )
+
+    def run_input_rows(self, workflow_id: str, owners: List[str], collaborators: List[str]):
+        """ Same rows as BigQueryMetadataStore.run_input_rows, from the local indexes. """
+        rows = [{"kind": "workflow", "owner": owners[0], "workload_path": r["workload_path"]}
+                for r in self._read("SELECT workload_path FROM workflows WHERE creator = ? AND workflow_id = ?",
+                                    (owners[0], workflow_id))]
+        for client_id in collaborators:
+            latest = self._read(
+                "SELECT approved FROM approvals WHERE workflow_id = ? AND client_id = ? ORDER BY approved_at DESC LIMIT 1",
+                (workflow_id, client_id),
+            )
+            rows.append({"kind": "approval", "owner": client_id, "approved": bool(latest[0]["approved"]) if latest else None})
+        marks = ",".join("?" * len(owners))
+        for r in self._read(
+            f"SELECT file_type, owner, dataset_id, gcs_path, created_at FROM files "
+            f"WHERE workflow_id = ? AND owner IN ({marks}) AND file_type IN ('dataset', 'key') ORDER BY created_at DESC",
+            (workflow_id, *owners),
+        ):
+            rows.append({"kind": r["file_type"], "owner": r["owner"], "dataset_id": r["dataset_id"],
+                         "gcs_path": r["gcs_path"], "created_at": r["created_at"]})
+        return rows
+
+    def add_results(self, rows: List[Dict[str, Any]]) -> list:
+        return self._write(
+            "INSERT INTO results VALUES (?, ?, ?, ?, ?)",
+            [(r["id"], r["workflow_id"], r["executed_notebook_path"], r["result_path"], r["created_at"]) for r in rows],
+            [("results", r) for r in rows],
+        )
+
+    def list_results(self, workflow_id: str) -> list:
+        rows = self._read(
+            "SELECT result_path, executed_notebook_path, created_at FROM results "
+            "WHERE workflow_id = ? ORDER BY created_at DESC",
+            (workflow_id,),
+        )
+        return [dict(r, created_at=datetime.datetime.fromisoformat(r["created_at"])) for r in rows]
+
+    def export_once(self) -> int:
+        """ Exports one batch of the outbox to BigQuery; returns the number of rows done with. """
+        batch = self._read("SELECT seq, table_id, row FROM export_outbox ORDER BY seq LIMIT ?", (self.export_batch_size,))
+        by_table = defaultdict(list)
+        for entry in batch:
+            by_table[entry["table_id"]].append(entry)
+        exported = []
+        for table_id, entries in by_table.items():
+            try:
+                errors = bq_client.insert_rows_json(table_id, [json.loads(e["row"]) for e in entries])
+            except Exception as e:
+                print(f"Metadata export to {table_id} failed: {e}")
+                continue
+            # Rows BigQuery rejects as invalid are dropped; rows it only skipped are retried
+            retry = {err["index"] for err in errors or []
+                     if not any(e.get("reason") == "invalid" for e in err.get("errors", []))}
+            if errors:
+                print(f"Metadata export to {table_id} rejected {len(errors)} row(s): {errors}")
+            exported += [e["seq"] for i, e in enumerate(entries) if i not in retry]
+        if exported:
+            with self._lock:
+                self._db.executemany("DELETE FROM export_outbox WHERE seq = ?", [(seq,) for seq in exported])
+        return len(exported)
+
+    def close(self):
+        pass   # the outbox is durable; export resumes on the next start
+
+    def start(self):
+        if self._exporter is not None:
+            return
+
+        def _export_forever():
+            while True:
+                try:
+                    while self.export_once() >= self.export_batch_size:
+                        pass
+                except Exception as e:
+                    print(f"Metadata export failed: {e}")
+                time.sleep(self.export_interval)
+
+        self._exporter = threading.Thread(target=_export_forever, name="metadata-export", daemon=True)
+        self._exporter.start()
+
+
+if METADATA_BACKEND == "sqlite":
+    METADATA = SqliteMetadataStore(METADATA_SQLITE_PATH, METADATA_EXPORT_INTERVAL_SECONDS, METADATA_EXPORT_BATCH_SIZE)
+elif METADATA_WRITE_BEHIND:
+    METADATA = BigQueryMetadataStore(WriteBehindBuffer(WRITE_BEHIND_JOURNAL, WRITE_BEHIND_MAX_ROWS,
+                                                       WRITE_BEHIND_MAX_DELAY_SECONDS, WRITE_BEHIND_VISIBILITY_SECONDS))
+else:
+    METADATA = BigQueryMetadataStore()
+
+@app.on_event("startup")
+def _start_metadata_background():
+    METADATA.start()
+
+@app.on_event("shutdown")
+def _flush_metadata():
+    METADATA.close()
+
 @app.post("/workflows")
 def create_workflow(workflow_id: str = Query(...), 
                     creator: str = Query(...), 
@@ -48,8 +671,7 @@ def create_workflow(workflow_id: str = Query(...),
             "created_at": f"{datetime.datetime.now()}"
         }
     ]
-    TABLE_ID = f"{PROJECT_ID}.cleanroom.{creator}_workflows"
-    errors = bq_client.insert_rows_json(TABLE_ID, rows)
+    errors = METADATA.add_workflow(creator, rows[0])
     if errors:
         raise HTTPException(status_code=500, detail=f"Insert failed: {errors}")
     return {"workflow_id": workflow_id, "status": "PENDING_APPROVAL"}
@@ -57,65 +679,65 @@ def create_workflow(workflow_id: str = Query(...),
 
 @app.get("/workflows/{workflow_id}")
 def get_workflow(workflow_id: str, creator: str = Query(...)):
-    query = f"""
-    SELECT * FROM `{PROJECT_ID}.cleanroom.{creator}_workflows`
-    WHERE workflow_id = @workflow_id
-    """
-    job = bq_client.query(query, job_config=bigquery.QueryJobConfig(
-        query_parameters=[bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id)]
-    ))
-    rows = list(job.result())
-    if not rows:
+    workflow = METADATA.get_workflow(creator, workflow_id)
+    if workflow is None:
         raise HTTPException(status_code=404, detail="Workflow not found")
-    return dict(rows[0])
+    return workflow
 
 
 @app.post("/workflows/{workflow_id}/approve")
 def approve_workflow(workflow_id: str, client_id: str = Query(...)):
-    APPROVAL_TABLE_ID = f"{PROJECT_ID}.{DATASET}.{client_id}_workflow_approvals"
-    query = f"""
-    INSERT INTO `{APPROVAL_TABLE_ID}`
-    (workflow_id, approver, approved, approved_at)
-    VALUES (@workflow_id, @approver, @approved, CURRENT_TIMESTAMP())
-    """
-    job = bq_client.query(query, job_config=bigquery.QueryJobConfig(
-        query_parameters=[bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id),
-                          bigquery.ScalarQueryParameter("approver", "STRING", client_id),
-                          bigquery.ScalarQueryParameter("approved", "BOOL", True)]        
-    ))
-    job.result()
+    METADATA.add_approval(client_id, workflow_id, approved=True)
     return {"workflow_id": workflow_id, "status": f"APPROVED_BY {client_id}"}
 
 
 @app.post("/workflows/{workflow_id}/reject")
 def reject_workflow(workflow_id: str, client_id: str = Query(...)):
-    APPROVAL_TABLE_ID = f"{PROJECT_ID}.{DATASET}.{client_id}_workflow_approvals"
-    query = f"""
-    INSERT INTO `{APPROVAL_TABLE_ID}`
-    (workflow_id, approver, approved, approved_at)
-    VALUES (@workflow_id, @client_id, @False, CURRENT_TIMESTAMP())
-    """
-    job = bq_client.query(query, job_config=bigquery.QueryJobConfig(
-        query_parameters=[bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id)]
-    ))
-    job.result()
+    METADATA.add_approval(client_id, workflow_id, approved=False)
     return {"workflow_id": workflow_id, "status": "REJECTED"}
 
 
 # -------------------------
 # Generate Signed URL
 # -------------------------
-@app.post("/upload-url")
-def generate_upload_url(
-    workflow_id: str = Query(...),
-    dataset_id: str = Query(...),
-    filename: str = Query(...),
-    file_type: str = Query(..., regex="^(dataset|workload|key)$"),
-    owner: str = Query(...)
-):
-    object_name = f"{file_type}s/{owner}/{workflow_id}/{dataset_id}/{filename}"
-    bucket = storage_client.bucket(BUCKET)
-    blob = bucket.blob(object_name)
+class SignedUrlCache:
+    """
+    LRU of V4 signed URLs keyed by (bucket, object, method, content type). A URL is reused while
+    at least `min_remaining` seconds of its validity are left, so repeated listings of the same
+    objects skip the RSA signature. Signing happens outside the lock.
+    """
+    def __init__(self, max_entries: int, min_remaining: float):
+        self.max_entries = max_entries
+        self.min_remaining = min_remaining
+        self._entries = OrderedDict()   # key -> (url, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bucket_name: str, object_name: str, method: str, expiration: datetime.timedelta,
+            content_type: Optional[str] = None) -> str:
+        key = (bucket_name, object_name, method, content_type)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] - now >= min(self.min_remaining, expiration.total_seconds()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        url = _sign_url(bucket_name, object_name, method, expiration, content_type)
+        with self._lock:
+            self._entries[key] = (url, now + expiration.total_seconds())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return url
+
+SIGNED_URLS = SignedUrlCache(SIGNED_URL_CACHE_SIZE, SIGNED_URL_MIN_REMAINING_SECONDS)
+
+def _sign_url(bucket_name: str, object_name: str, method: str, expiration: datetime.timedelta,
+              content_type: Optional[str] = None) -> str:
+    blob = storage_client.bucket(bucket_name).blob(object_name)
 
 #---------------------------CHANGES FOR LOCAL TESTING---------------------------
     # ✅ IAM API signing (no JSON key needed)                                   
@@ -127,21 +749,34 @@ def generate_upload_url(
     #     access_token = None
 #--------------------------------------------------------------------------------
 
-    url = blob.generate_signed_url(
+    return blob.generate_signed_url(
         version="v4",
-        expiration=datetime.timedelta(minutes=15),
-        method="PUT",
+        expiration=expiration,
+        method=method,
 #---------------------------CHANGES FOR LOCAL TESTING---------------------------
         # service_account_email=SIGNER_EMAIL, <- for cloud run
         # access_token=access_token,   # <-- important <- for cloud run
 
-        content_type="application/octet-stream", # <- for local testing
+        content_type=content_type, # <- for local testing
         credentials=creds,               # <- for local testing
 #--------------------------------------------------------------------------------
     )
 
-    # Insert metadata in BigQuery
-    table = f"{PROJECT_ID}.{DATASET}.{owner}_{file_type}s"
+def _split_gcs_path(gcs_path: str):
+    if not gcs_path.startswith("gs://"):
+        raise HTTPException(status_code=400, detail="Invalid GCS path format")
+    parts = gcs_path[5:].split("/", 1)
+    if len(parts) != 2:
+        raise HTTPException(status_code=400, detail="Invalid GCS path format")
+    return parts
+
+def _upload_url(workflow_id: str, dataset_id: str, filename: str, file_type: str, owner: str):
+    """ Signs a PUT for one upload and records its metadata; returns (response, errors). """
+    object_name = f"{file_type}s/{owner}/{workflow_id}/{dataset_id}/{filename}"
+    url = SIGNED_URLS.get(BUCKET, object_name, "PUT", datetime.timedelta(minutes=15),
+                          content_type="application/octet-stream")
+
+    # Insert metadata (into {owner}_{file_type}s)
     row = {
         "workflow_id": workflow_id,
         "owner": owner,
@@ -149,183 +784,259 @@ def generate_upload_url(
         "created_at": datetime.datetime.now().isoformat(),
         "dataset_id": dataset_id
     }
-    errors = bq_client.insert_rows_json(table, [row])
+    errors = METADATA.add_file(owner, file_type, row)
+    return {"upload_url": url, "gcs_path": row["gcs_path"], "id": row["workflow_id"]}, errors
+
+def _check_batch_size(items: list):
+    if len(items) > SIGNED_URL_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {SIGNED_URL_BATCH_MAX} objects per request")
+
+@app.post("/upload-url")
+def generate_upload_url(
+    workflow_id: str = Query(...),
+    dataset_id: str = Query(...),
+    filename: str = Query(...),
+    file_type: str = Query(..., regex="^(dataset|workload|key)$"),
+    owner: str = Query(...)
+):
+    response, errors = _upload_url(workflow_id, dataset_id, filename, file_type, owner)
     if errors:
         return {"error": errors}
-
-    return {"upload_url": url, "gcs_path": row["gcs_path"], "id": row["workflow_id"]}
+    return response
+
+
+class UploadUrlItem(BaseModel):
+    workflow_id: str
+    dataset_id: str
+    filename: str
+    file_type: Literal["dataset", "workload", "key"]
+    owner: str
+
+@app.post("/upload-urls")
+def generate_upload_urls(items: List[UploadUrlItem] = Body(...)):
+    """ Batch form of /upload-url: one signed PUT per item, returned in request order. """
+    _check_batch_size(items)
+    urls, errors = [], []
+    for item in items:
+        response, item_errors = _upload_url(item.workflow_id, item.dataset_id, item.filename, item.file_type, item.owner)
+        urls.append(response)
+        errors.extend(item_errors or [])
+    if errors:
+        return {"error": errors}
+    return {"urls": urls}
 
 
 @app.get("/download-url")
 def generate_download_url(
     gcs_path: str = Query(..., description="Full GCS path, e.g. gs://bucket-name/object-name")
 ):
-    if not gcs_path.startswith("gs://"):
-        raise HTTPException(status_code=400, detail="Invalid GCS path format")
-
-    parts = gcs_path[5:].split("/", 1)
-    if len(parts) != 2:
-        raise HTTPException(status_code=400, detail="Invalid GCS path format")
-
-    bucket_name, object_name = parts
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(object_name)
-
-#---------------------------CHANGES FOR LOCAL TESTING---------------------------
-    # credentials, _ = google.auth.default()
-    # try:
-    #     credentials.refresh(Request())
-    #     access_token = credentials.token
-    # except Exception:
-    #     access_token = None
-#--------------------------------------------------------------------------------
-
-    url = blob.generate_signed_url(
-        version="v4",
-        expiration=datetime.timedelta(minutes=15),
-        method="GET",
-#---------------------------CHANGES FOR LOCAL TESTING---------------------------
-        # service_account_email=SIGNER_EMAIL, <- for cloud run
-        # access_token=access_token,   # <-- important <- for cloud run
-
-        # content_type="application/octet-stream", # <- for local testing
-        credentials=creds,               # <- for local testing
-#--------------------------------------------------------------------------------
-    )
-
+    bucket_name, object_name = _split_gcs_path(gcs_path)
+    url = SIGNED_URLS.get(bucket_name, object_name, "GET", datetime.timedelta(minutes=15))
     return {"download_url": url}
 
+@app.post("/download-urls")
+def generate_download_urls(gcs_paths: List[str] = Body(..., embed=True)):
+    """ Batch form of /download-url: {"gcs_paths": [...]} -> signed GETs in request order. """
+    _check_batch_size(gcs_paths)
+    objects = [_split_gcs_path(gcs_path) for gcs_path in gcs_paths]
+    return {"urls": [
+        {"gcs_path": gcs_path, "download_url": SIGNED_URLS.get(bucket_name, object_name, "GET", datetime.timedelta(minutes=15))}
+        for gcs_path, (bucket_name, object_name) in zip(gcs_paths, objects)
+    ]}
+
 # ---------------------------
 #  Runner Endpoint
 # ---------------------------
 
-def get_all_datasets(workflow_id: str, owner: str) -> list:
-    query = f"""
-        SELECT dataset_id, gcs_path
-        FROM `{PROJECT_ID}.{DATASET}.{owner}_datasets`
-        WHERE workflow_id = @workflow_id AND owner = @owner
-        ORDER BY created_at DESC
-    """
-    job = bq_client.query(
-        query,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id),
-                bigquery.ScalarQueryParameter("owner", "STRING", owner),
-            ]
-        ),
-    )
-    return list(job.result())
-
-def get_all_keys(workflow_id: str, owner: str) -> list:
-    query = f"""
-        SELECT dataset_id, gcs_path
-        FROM `{PROJECT_ID}.{DATASET}.{owner}_keys`
-        WHERE workflow_id = @workflow_id AND owner = @owner
-        ORDER BY created_at DESC
-    """
-    job = bq_client.query(
-        query,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id),
-                bigquery.ScalarQueryParameter("owner", "STRING", owner),
-            ]
-        ),
-    )
-    return list(job.result())
-
-@app.post("/workflows/{workflow_id}/run")
-def run_notebook(workflow_id: str, creator: str=Query(...), collaborators: List[str]=Query(...)):
-    print(collaborators)
-    for collaborator in collaborators:
-        # if not collaborator.startswith("Client"):
-        #     raise HTTPException(status_code=400, detail=f"Invalid collaborator ID: {collaborator}")
-        
-        query = f"""
-            SELECT *
-            FROM `{PROJECT_ID}.{DATASET}.{collaborator}_workflow_approvals`
-            WHERE workflow_id = @workflow_id
-            ORDER BY approved_at DESC
-            LIMIT 1
-        """
-        job = bq_client.query(
-            query,
-            job_config=bigquery.QueryJobConfig(
-                query_parameters=[bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id)]
-            )
-        )
-        rows = list(job.result())
-        if not rows or not rows[0]["approved"] == True:
-            raise HTTPException(status_code=403, detail="Workflow not approved yet")
-
-    # 1. Get workflow details from BigQuery
-    query = f"""
-        SELECT * EXCEPT(created_at) FROM `{PROJECT_ID}.{DATASET}.{creator}_workflows`
-        WHERE workflow_id = @workflow_id
-    """
-    job = bq_client.query(
-        query,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id)]
-        ),
-    )
-
-    rows = list(job.result())
-    if not rows:
-        raise HTTPException(status_code=404, detail="Workflow not found")
-    workflow = rows[0]
-
-    # creator = workflow["creator"]
-    # collaborators = workflow["collaborator"]
-    workload_path = workflow["workload_path"]
+@app.post("/workflows/{workflow_id}/run", status_code=202)
+async def run_notebook(workflow_id: str, creator: str=Query(...), collaborators: List[str]=Query(...),
+                 priority: int = Query(0, description="Higher runs first if the executor queues by priority"),
+                 checkpoint: bool = Query(False, description="Snapshot state at the workload's checkpoint cells so a failed run can resume"),
+                 force: bool = Query(False, description="Re-execute even if an identical earlier run's results can be reused"),
+                 engine: Optional[str] = Query(None, description="Executor engine: papermill (executed notebook) or script (faster, execution record only)")):
+    workload_path, datasets = await run_in_threadpool(_resolve_run_inputs, workflow_id, creator, collaborators)
 
-    creator_datasets = get_all_datasets(workflow_id, creator)
-    creator_keys = get_all_keys(workflow_id, creator)
-
-    datasets = []
-    for ds in creator_datasets:
-        for key in creator_keys:
-            if ds["dataset_id"] == key["dataset_id"]:
-                datasets.append({"owner": creator, "ciphertext_gcs": ds["gcs_path"], "wrapped_dek_gcs": key["gcs_path"]})
-    # for ds, key in zip(creator_datasets, creator_keys):
-    #     datasets.append({"owner": creator, "ciphertext_gcs": ds, "wrapped_dek_gcs": key})
-
-    for collaborator in collaborators:
-        collab_datasets = get_all_datasets(workflow_id, collaborator)
-        collab_keys = get_all_keys(workflow_id, collaborator)
-        for ds in collab_datasets:
-            for key in collab_keys:
-                if ds["dataset_id"] == key["dataset_id"]:
-                    datasets.append({"owner": creator, "ciphertext_gcs": ds["gcs_path"], "wrapped_dek_gcs": key["gcs_path"]})
-        # for ds, key in zip(collab_datasets, collab_keys):
-        #     datasets.append({"owner": collaborator, "ciphertext_gcs": ds, "wrapped_dek_gcs": key})
-
-
-    if not all([creator_datasets, creator_keys, collab_datasets, collab_keys]):
-        raise HTTPException(status_code=400, detail="Missing dataset or key for one of the clients")
-    
     result_base = f"gs://{BUCKET}/results/{workflow_id}/result"
     executed_base = f"gs://{BUCKET}/results/{workflow_id}/executed"
 
     print("Datasets to be sent to executor:", datasets)
 
+    run_id = str(uuid.uuid4())
     exec_payload = {
         "workflow_id": workflow_id,
-        "workload_gcs": workflow.workload_path,
+        "workload_gcs": workload_path,
         "datasets": datasets,
         "result_base": result_base,
-        "executed_notebook_base": executed_base
+        "executed_notebook_base": executed_base,
+        "run_id": run_id,
+        "priority": priority,
+        "checkpoint": checkpoint,
+        "force": force,
+        "engine": engine,
     }
+    callback_url = _register_run(run_id, workflow_id, result_base)
+    if callback_url:
+        exec_payload["callback_url"] = callback_url
 
     try:
-        resp = requests.post(f"{EXECUTOR_URL}/execute", json=exec_payload, timeout=600)
+        resp = await executor_client.request("POST", "/execute", "execute", json=exec_payload)
+        # Bad run options and executor admission control (with Retry-After) go back to the caller
+        _raise_passthrough(resp, (400, 413, 429))
         resp.raise_for_status()
+    except HTTPException:
+        with RUNS_LOCK:
+            RUNS.pop(run_id, None)
+        raise
     except Exception as e:
+        with RUNS_LOCK:
+            RUNS.pop(run_id, None)
         raise HTTPException(status_code=502, detail=f"Executor failed: {e}")
 
-    result_info = resp.json()
+    # DONE right away when the executor reused the results of an identical earlier run
+    status = resp.json().get("status", "QUEUED")
+    _watch_run(run_id)
+    return {"run_id": run_id, "workflow_id": workflow_id, "status": status, "status_url": f"/runs/{run_id}"}
 
+def _resolve_run_inputs(workflow_id: str, creator: str, collaborators: List[str]):
+    """
+    Checks every collaborator's approval and returns (workload path, executor dataset specs),
+    from a single metadata lookup (one BigQuery job). Datasets are matched to their wrapped keys with a hash join
+    on (owner, dataset_id); newest first, as before.
+    """
+    print(collaborators)
+    owners = [creator] + [c for c in collaborators if c != creator]
+    approvals, workload_paths = {}, []
+    files = {"dataset": defaultdict(list), "key": defaultdict(list)}
+    for row in METADATA.run_input_rows(workflow_id, owners, collaborators):
+        if row["kind"] == "approval":
+            approvals[row["owner"]] = row["approved"]
+        elif row["kind"] == "workflow":
+            workload_paths.append(row["workload_path"])
+        else:
+            files[row["kind"]][row["owner"]].append(row)
+
+    if any(approvals.get(collaborator) is not True for collaborator in collaborators):
+        raise HTTPException(status_code=403, detail="Workflow not approved yet")
+    if not workload_paths:
+        raise HTTPException(status_code=404, detail="Workflow not found")
+    workload_path = workload_paths[0]
+
+    if not all(files["dataset"][owner] and files["key"][owner] for owner in owners):
+        raise HTTPException(status_code=400, detail="Missing dataset or key for one of the clients")
+
+    datasets = []
+    for owner in owners:
+        keys_by_dataset = defaultdict(list)
+        for key in files["key"][owner]:
+            keys_by_dataset[key["dataset_id"]].append(key["gcs_path"])
+        for ds in files["dataset"][owner]:
+            for key_path in keys_by_dataset.get(ds["dataset_id"], ()):
+                # every dataset is sent under the creator, as the workload expects
+                datasets.append({"owner": creator, "ciphertext_gcs": ds["gcs_path"], "wrapped_dek_gcs": key_path})
+    return workload_path, datasets
+
+
+# ---------------------------
+#  Run status
+# ---------------------------
+# Runs are tracked in memory; the executor owns the authoritative state until a run
+# finishes, at which point its results are recorded in BigQuery exactly once. Every run
+# started here is followed until then (_follow_run); polls and callbacks only make it sooner.
+RUN_TERMINAL_STATES = ("DONE", "FAILED")
+RUNS: Dict[str, Dict[str, Any]] = {}
+RUNS_LOCK = threading.Lock()
+
+def _public_run(run: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in run.items() if not k.startswith("_") and k != "result_base"}
+
+def _register_run(run_id: str, workflow_id: str, result_base: str, **fields) -> Optional[str]:
+    """
+    Adds a QUEUED run to the run table and returns the callback URL to hand to the executor
+    (None without ORCHESTRATOR_CALLBACK_URL). The URL carries a token issued for this run
+    only; /runs/callback accepts nothing else.
+    """
+    token = secrets.token_urlsafe(32)
+    _prune_runs()
+    with RUNS_LOCK:
+        RUNS[run_id] = {"run_id": run_id, "workflow_id": workflow_id, "status": "QUEUED", "result_base": result_base,
+                        **fields, "_callback_token": token, "_updated_at": time.time()}
+    if not ORCHESTRATOR_CALLBACK_URL:
+        return None
+    return f"{ORCHESTRATOR_CALLBACK_URL.rstrip('/')}/runs/callback?token={token}"
+
+_run_watchers = set()   # follow-up tasks of unfinished runs
+
+def _watch_run(run_id: str):
+    task = asyncio.create_task(_follow_run(run_id))
+    _run_watchers.add(task)
+    task.add_done_callback(_run_watchers.discard)
+
+async def _follow_run(run_id: str):
+    """
+    Long-polls the executor until run_id finishes, so completion (and the result rows written
+    by record_run_result) never depends on a client polling or on ORCHESTRATOR_CALLBACK_URL.
+    """
+    failures = 0
+    while True:
+        with RUNS_LOCK:
+            run = RUNS.get(run_id)
+            if run is None or run.get("status") in RUN_TERMINAL_STATES:
+                return
+        try:
+            await get_run_status(run_id, wait=RUN_WATCH_WAIT_SECONDS)
+            failures = 0
+        except HTTPException as e:
+            if e.status_code == 404:
+                # The executor no longer knows the run (restarted or pruned): it will never finish
+                with RUNS_LOCK:
+                    if run_id in RUNS and RUNS[run_id].get("status") not in RUN_TERMINAL_STATES:
+                        RUNS[run_id].update(status="FAILED", error="Run lost by the executor", _updated_at=time.time())
+                return
+            failures += 1
+            print(f"Following run {run_id} failed (attempt {failures}): {e.detail}")
+            await asyncio.sleep(min(60, 2 ** failures))
+
+def _prune_runs():
+    cutoff = time.time() - RUN_RETENTION_SECONDS
+    with RUNS_LOCK:
+        for run_id in [r for r, run in RUNS.items()
+                       if run.get("status") in RUN_TERMINAL_STATES and run["_updated_at"] < cutoff]:
+            RUNS.pop(run_id, None)
+
+def record_run_result(executor_run: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Folds an executor run record into the local run table. When the run has just
+    finished, records its result files in BigQuery and resolves the model zip path.
+    """
+    run_id = executor_run["run_id"]
+    workflow_id = executor_run["workflow_id"]
+    with RUNS_LOCK:
+        run = RUNS.setdefault(run_id, {
+            "run_id": run_id,
+            "workflow_id": workflow_id,
+            "result_base": f"gs://{BUCKET}/results/{workflow_id}/result",
+        })
+        if run.get("status") in RUN_TERMINAL_STATES or run.get("_finalizing"):
+            return _public_run(run)
+        run["_updated_at"] = time.time()
+        if executor_run["status"] not in RUN_TERMINAL_STATES:
+            run["status"] = executor_run["status"]
+            return _public_run(run)
+        run["_finalizing"] = True
+
+    final = {"status": executor_run["status"], "error": executor_run.get("error")}
+    if executor_run["status"] == "DONE":
+        try:
+            final.update(_record_results(workflow_id, run["result_base"], executor_run.get("result") or {}))
+        except HTTPException as e:
+            final.update(status="FAILED", error=e.detail)
+
+    with RUNS_LOCK:
+        run.update(final, _updated_at=time.time())
+        run.pop("_finalizing", None)
+        return _public_run(run)
+
+def _record_results(workflow_id: str, result_base: str, result_info: Dict[str, Any]) -> Dict[str, Any]:
     # 5. Record result in BigQuery
     # table = f"{PROJECT_ID}.cleanroom.results"
 
@@ -340,7 +1051,6 @@ def run_notebook(workflow_id: str, creator: str=Query(...), collaborators: List[
     # if errors:
     #     raise HTTPException(status_code=500, detail=f"Failed to insert result metadata: {errors}")
 
-    table = f"{PROJECT_ID}.cleanroom.results"
     rows_to_insert = []
 
     # Get the list of paths from the executor's response
@@ -359,36 +1069,109 @@ def run_notebook(workflow_id: str, creator: str=Query(...), collaborators: List[
         rows_to_insert.append(row)
 
     if rows_to_insert:
-        errors = bq_client.insert_rows_json(table, rows_to_insert)
+        errors = METADATA.add_results(rows_to_insert)
         if errors:
             raise HTTPException(status_code=500, detail=f"Failed to insert result metadata: {errors}")
 
-    # return {
-    #     "status": "success",
-    #     "executed_notebook": result_info["executed_notebook_path"],
-    #     "result_json_path": result_info["result_path"]
-    # }
-    # Check if a trained model zip exists
-    model_gcs_path = None
-    bucket_name, prefix = result_base[5:].split("/", 1)
-    model_blob = storage_client.bucket(bucket_name).blob(prefix + "_model.zip")
-    if model_blob.exists():
-        model_gcs_path = f"gs://{bucket_name}/{prefix}_model.zip"
-
-    # return {
-    #     "status": "success",
-    #     "executed_notebook": result_info["executed_notebook_path"],
-    #     "result_json_path": result_info["result_paths"],
-    #     "model_gcs_path": model_gcs_path   # <--- new field
-    # }
+    # The executor reports the model zip in its result manifest; only older executors need a lookup
+    if "result_manifest" in result_info:
+        model_gcs_path = result_info.get("model_gcs_path")
+    else:
+        model_gcs_path = None
+        bucket_name, prefix = result_base[5:].split("/", 1)
+        model_blob = storage_client.bucket(bucket_name).blob(prefix + "_model.zip")
+        if model_blob.exists():
+            model_gcs_path = f"gs://{bucket_name}/{prefix}_model.zip"
 
     return {
-        "status": "success",
         "executed_notebook": result_info.get("executed_notebook_path"),
         "result_json_paths": result_info.get("result_paths", []), # Use the new plural key
-        "model_gcs_path": model_gcs_path
+        "model_gcs_path": model_gcs_path,
+        "result_files": (result_info.get("result_manifest") or {}).get("files", []),
+        "timings": result_info.get("timings"),
+        "profile": result_info.get("profile"),
     }
 
+@app.get("/runs/{run_id}")
+async def get_run_status(run_id: str, wait: float = Query(0, ge=0, le=60, description="Seconds to long-poll for completion")):
+    """
+    Status of a run started through /workflows/{id}/run. Once DONE, the response carries
+    executed_notebook, result_json_paths and model_gcs_path.
+    """
+    with RUNS_LOCK:
+        run = RUNS.get(run_id)
+        if run and run.get("status") in RUN_TERMINAL_STATES:
+            return _public_run(run)
+
+    try:
+        resp = await executor_client.request("GET", f"/runs/{run_id}", "run_status", extra_timeout=wait,
+                                             params={"wait": wait})
+    except httpx.PoolTimeout:
+        raise HTTPException(status_code=503, detail="Too many long-polls open to the executor", headers={"Retry-After": "1"})
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Failed to fetch run status from executor: {e}")
+    if resp.status_code == 404:
+        raise HTTPException(status_code=404, detail="Run not found")
+    try:
+        resp.raise_for_status()
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Failed to fetch run status from executor: {e}")
+    # Finishing a run writes its results to BigQuery
+    return await run_in_threadpool(record_run_result, resp.json())
+
+@app.post("/runs/{run_id}/resume", status_code=202)
+async def resume_run(run_id: str):
+    """
+    Restarts failed checkpointed run `run_id` from its last good checkpoint. The executor
+    keeps the checkpoint and the original request; the resumed run gets a new run_id.
+    """
+    await get_run_status(run_id, wait=0)   # raises 404 for unknown runs; picks up runs this process has not seen
+    with RUNS_LOCK:
+        run = RUNS[run_id]
+    if run.get("status") != "FAILED":
+        raise HTTPException(status_code=409, detail="Only failed runs can be resumed")
+    workflow_id = run["workflow_id"]
+
+    new_run_id = str(uuid.uuid4())
+    payload = {"run_id": new_run_id}
+    callback_url = _register_run(new_run_id, workflow_id, run["result_base"], resumed_from=run_id)
+    if callback_url:
+        payload["callback_url"] = callback_url
+    try:
+        resp = await executor_client.request("POST", f"/runs/{run_id}/resume", "resume", json=payload)
+        _raise_passthrough(resp, (404, 409, 413, 429))
+        resp.raise_for_status()
+    except HTTPException:
+        with RUNS_LOCK:
+            RUNS.pop(new_run_id, None)
+        raise
+    except Exception as e:
+        with RUNS_LOCK:
+            RUNS.pop(new_run_id, None)
+        raise HTTPException(status_code=502, detail=f"Executor failed: {e}")
+
+    _watch_run(new_run_id)
+    return {"run_id": new_run_id, "workflow_id": workflow_id, "status": "QUEUED",
+            "resumed_from": run_id, "status_url": f"/runs/{new_run_id}"}
+
+@app.post("/runs/callback")
+def run_callback(executor_run: Dict[str, Any] = Body(...), token: str = Query(...)):
+    """
+    Completion callback from the executor (see ORCHESTRATOR_CALLBACK_URL). Only accepted for
+    a run this orchestrator started and has not finished, with the token issued for it.
+    """
+    if "run_id" not in executor_run or "workflow_id" not in executor_run or "status" not in executor_run:
+        raise HTTPException(status_code=400, detail="Invalid run record")
+    with RUNS_LOCK:
+        run = RUNS.get(executor_run["run_id"])
+        if run is None or "_callback_token" not in run:
+            raise HTTPException(status_code=404, detail="Run not found")
+        if not secrets.compare_digest(run["_callback_token"], token) or run["workflow_id"] != executor_run["workflow_id"]:
+            raise HTTPException(status_code=403, detail="Invalid callback token")
+        if run.get("status") in RUN_TERMINAL_STATES:
+            raise HTTPException(status_code=409, detail="Run already finished")
+    return record_run_result(executor_run)
+
 
 # @app.get("/workflows/{workflow_id}/result")
 # def get_result(workflow_id: str):
@@ -416,23 +1199,8 @@ def get_all_results(workflow_id: str):
     It queries BigQuery to find all result entries (paths), then generates signed URLs for each file.
     """
 
-    # Query BigQuery for all result entries associated with this workflow
-    query = f"""
-        SELECT result_path, executed_notebook_path, created_at
-        FROM `{PROJECT_ID}.cleanroom.results`
-        WHERE workflow_id = @workflow_id
-        ORDER BY created_at DESC
-    """
-    job = bq_client.query(
-        query,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("workflow_id", "STRING", workflow_id)
-            ]
-        ),
-    )
-
-    rows = list(job.result())
+    # Query the metadata store for all result entries associated with this workflow
+    rows = METADATA.list_results(workflow_id)
     if not rows:
         raise HTTPException(status_code=404, detail="No results found for this workflow")
 
@@ -443,14 +1211,7 @@ def get_all_results(workflow_id: str):
         if not result_gcs_path.startswith("gs://"):
             continue
         bucket_name, blob_path = result_gcs_path[5:].split("/", 1)
-        blob = storage_client.bucket(bucket_name).blob(blob_path)
-
-        signed_url = blob.generate_signed_url(
-            version="v4",
-            expiration=datetime.timedelta(minutes=30),
-            method="GET",
-            credentials=creds
-        )
+        signed_url = SIGNED_URLS.get(bucket_name, blob_path, "GET", datetime.timedelta(minutes=30))
 
         results_with_urls.append({
             "result_path": result_gcs_path,
@@ -459,16 +1220,33 @@ def get_all_results(workflow_id: str):
             "download_url": signed_url
         })
 
-    return {"workflow_id": workflow_id, "results": results_with_urls}
+    # Per-cell profile of the latest run, stored by the executor next to its executed notebook
+    # (null when it is missing or unreadable)
+    profile = _load_profile(rows[0]["executed_notebook_path"])
+
+    return {"workflow_id": workflow_id, "results": results_with_urls, "profile": profile}
+
+def _load_profile(executed_notebook_path: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not executed_notebook_path or not executed_notebook_path.startswith("gs://"):
+        return None
+    bucket_name, blob_path = executed_notebook_path[5:].split("/", 1)
+    blob = storage_client.bucket(bucket_name).blob(os.path.splitext(blob_path)[0] + "_profile.json")
+    try:
+        return json.loads(blob.download_as_bytes())
+    except (GoogleAPIError, ValueError) as e:
+        # A missing or unreadable profile must not fail the caller
+        if not isinstance(e, NotFound):
+            print(f"Failed to load profile for {executed_notebook_path}: {e}")
+        return None
 
 @app.get("/executor-pubkey")
-def get_executor_pubkey():
+async def get_executor_pubkey():
     """
     Proxy endpoint: fetches enclave's public key + attestation evidence
     from the executor (running inside TEE) and returns it to clients.
     """
     try:
-        resp = requests.get(f"{EXECUTOR_URL}/attestation", timeout=10)
+        resp = await executor_client.request("GET", "/attestation", "attestation")
         resp.raise_for_status()
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Failed to fetch from executor: {e}")
@@ -476,12 +1254,30 @@ def get_executor_pubkey():
     return resp.json()
 
 @app.get("/logs/{workflow_id}")
-def workflow_logs(workflow_id: str):
-    # forward the request to executor
-    executor_url = f"{EXECUTOR_URL}/logs/{workflow_id}"
+async def workflow_logs(workflow_id: str, since: int = Query(0, ge=0, description="Cursor from a previous response")):
+    # forward the request to executor; only lines after `since` are returned
     try:
-        resp = requests.get(executor_url)
-        # return resp.text, resp.status_code
+        resp = await executor_client.request("GET", f"/logs/{workflow_id}", "logs", params={"since": since})
+        resp.raise_for_status()
         return resp.json()
     except Exception as e:
-        return f"Error contacting executor: {e}", 500
+        raise HTTPException(status_code=502, detail=f"Error contacting executor: {e}")
+
+@app.get("/logs/{workflow_id}/stream")
+async def stream_workflow_logs(workflow_id: str, since: int = Query(0, ge=0), last_event_id: Optional[str] = Header(None)):
+    """ Pass-through of the executor's Server-Sent Events log stream. """
+    headers = {"Last-Event-ID": last_event_id} if last_event_id else {}
+    try:
+        # the executor sends a keep-alive at least every 15s, so the read timeout only trips on a dead stream
+        resp = await executor_client.request("GET", f"/logs/{workflow_id}/stream", "log_stream", stream=True,
+                                             params={"since": since}, headers=headers)
+    except httpx.PoolTimeout:
+        raise HTTPException(status_code=503, detail="Too many log streams open to the executor", headers={"Retry-After": "5"})
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Error contacting executor: {e}")
+    if resp.is_error:
+        await resp.aclose()
+        raise HTTPException(status_code=502, detail=f"Error contacting executor: HTTP {resp.status_code}")
+    return StreamingResponse(resp.aiter_raw(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background=BackgroundTask(resp.aclose))